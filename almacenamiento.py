@@ -0,0 +1,1378 @@
+"""Almacenamiento de clientes y pagos: Google Sheets (con cuota, handles y cola de escritura) o SQLite.
+
+Está fuera de viaje_san_juan_v3.py para poder importarlo (y probarlo con SQLite) sin
+ejecutar la app; la app crea los motores una vez por proceso con @st.cache_resource.
+"""
+import bisect
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import gspread
+
+from saldos import COLUMNAS_CLIENTES, COLUMNAS_PAGOS, TIPO_REVERSO, tabla_desde_filas, tabla_desde_matriz
+
+# ============================================
+# CUOTA Y HANDLES DE GOOGLE SHEETS
+# ============================================
+# Prioridades del limitador: las lecturas que necesita la pantalla pasan antes que las escrituras
+PRIORIDAD_LECTURA = 0
+PRIORIDAD_ESCRITURA = 1
+
+class LimitadorCuota:
+    """Cubeta de fichas compartida por todas las llamadas a la API de Google Sheets.
+
+    Google admite unas 60 peticiones por minuto por usuario. Cada llamada toma una ficha y,
+    si no hay, espera su turno; mientras haya lecturas esperando, las escrituras no toman
+    fichas. Los 429 y los errores 5xx se reintentan con espera exponencial con jitter.
+    """
+
+    def __init__(self, por_minuto=60, rafaga=10, max_intentos=5, espera_base=1.0, espera_maxima=32.0):
+        self.tasa = por_minuto / 60.0
+        self.capacidad = rafaga
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self._fichas = float(rafaga)
+        self._ultima_recarga = time.monotonic()
+        self._cond = threading.Condition()
+        self._esperando = [0, 0]
+        self.reintentos = 0
+
+    def en_espera(self):
+        """Cantidad de llamadas detenidas esperando ficha."""
+        with self._cond:
+            return sum(self._esperando)
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultima_recarga) * self.tasa)
+        self._ultima_recarga = ahora
+
+    def adquirir(self, prioridad=PRIORIDAD_LECTURA):
+        """Bloquea hasta obtener una ficha, respetando la prioridad de las llamadas en espera."""
+        with self._cond:
+            self._esperando[prioridad] += 1
+            try:
+                while True:
+                    self._recargar()
+                    hay_prioritarias = any(self._esperando[:prioridad])
+                    if self._fichas >= 1 and not hay_prioritarias:
+                        self._fichas -= 1
+                        return
+                    self._cond.wait(timeout=max(0.05, (1 - self._fichas) / self.tasa))
+            finally:
+                self._esperando[prioridad] -= 1
+                self._cond.notify_all()
+
+    def llamar(self, funcion, *args, prioridad=PRIORIDAD_LECTURA, **kwargs):
+        """Ejecuta una llamada a gspread dentro de la cuota, reintentando los rechazos por cuota o del servidor."""
+        for intento in range(self.max_intentos):
+            self.adquirir(prioridad)
+            try:
+                return funcion(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                codigo = e.response.status_code
+                if codigo not in (429, 500, 502, 503) or intento == self.max_intentos - 1:
+                    raise
+                with self._cond:
+                    self.reintentos += 1
+                    if codigo == 429:
+                        # La cuota se agotó: vaciar la cubeta para que las demás llamadas también esperen
+                        self._fichas = 0.0
+                tope = min(self.espera_maxima, self.espera_base * 2 ** intento)
+                time.sleep(tope / 2 + random.uniform(0, tope / 2))
+
+def es_error_de_handle(error):
+    """Indica si un error de gspread se corrige volviendo a abrir el libro (credenciales vencidas o recurso no encontrado)."""
+    if isinstance(error, (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound)):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code in (401, 404)
+    return False
+
+class CacheHojas:
+    """Conserva abiertos el Spreadsheet y sus Worksheet para todo el proceso.
+
+    conectar() devuelve el cliente de gspread y desconectar() olvida el que tenga guardado,
+    para que la siguiente llamada se autentique de nuevo.
+    """
+
+    def __init__(self, nombre_libro, limitador, conectar, desconectar):
+        self.nombre_libro = nombre_libro
+        self.limitador = limitador
+        self._conectar = conectar
+        self._desconectar = desconectar
+        self._lock = threading.Lock()
+        self._libro = None
+        self._hojas = {}
+
+    def libro(self):
+        """Devuelve el Spreadsheet, abriéndolo solo la primera vez."""
+        with self._lock:
+            if self._libro is None:
+                self._libro = self.llamar(self._conectar().open, self.nombre_libro)
+            return self._libro
+
+    def hoja(self, nombre):
+        """Devuelve la Worksheet indicada sin volver a consultar los metadatos del libro."""
+        libro = self.libro()
+        with self._lock:
+            if nombre not in self._hojas:
+                self._hojas[nombre] = self.llamar(libro.worksheet, nombre)
+            return self._hojas[nombre]
+
+    def llamar(self, funcion, *args, prioridad=PRIORIDAD_LECTURA, **kwargs):
+        """Toda llamada a gspread pasa por aquí para respetar la cuota compartida."""
+        return self.limitador.llamar(funcion, *args, prioridad=prioridad, **kwargs)
+
+    def invalidar(self, reautenticar=False):
+        """Descarta los handles guardados; con reautenticar=True también renueva el cliente de gspread."""
+        with self._lock:
+            self._libro = None
+            self._hojas = {}
+        if reautenticar:
+            self._desconectar()
+
+    def ejecutar(self, operacion, *args):
+        """Ejecuta la operación y, si falla por un handle vencido, refresca y reintenta una sola vez."""
+        try:
+            return operacion(*args)
+        except Exception as e:
+            if not es_error_de_handle(e):
+                raise
+            reautenticar = isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 401
+            self.invalidar(reautenticar=reautenticar)
+            return operacion(*args)
+
+# ============================================
+# IDS E ÍNDICES DE FILAS
+# ============================================
+def numero_de_cliente(cliente_id):
+    """Parte numérica de un ID 'CLI042' (42), o None si el ID no sigue ese formato."""
+    coincidencia = re.fullmatch(r"CLI(\d+)", str(cliente_id))
+    return int(coincidencia.group(1)) if coincidencia else None
+
+def siguiente_de(cliente_ids):
+    """Primer número libre después del mayor ID numérico existente (para iniciar el contador)."""
+    return max((n for n in map(numero_de_cliente, cliente_ids) if n is not None), default=0) + 1
+
+def generar_pago_id():
+    """Genera un identificador de pago único y estable (no depende de la posición en la hoja)."""
+    return f"PAG{uuid.uuid4().hex[:10].upper()}"
+
+def marca_actualizacion():
+    """Marca de tiempo que se guarda en updated_at en cada escritura de un cliente."""
+    return datetime.now().isoformat(timespec='microseconds')
+
+def fila_inicial_de_rango(rango):
+    """Extrae el número de la primera fila de un rango A1 como 'clientes!A15:M15'."""
+    return int(re.search(r"[A-Z]+(\d+)", rango.split('!')[-1]).group(1))
+
+class IndiceFilas:
+    """Índice en memoria clave → número de fila de una hoja, mantenido en altas y bajas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filas = {}
+
+    def reconstruir(self, claves, primera_fila=2):
+        """Reconstruye el índice a partir de los valores de la columna clave, en orden de fila."""
+        with self._lock:
+            self._filas = {str(c): i for i, c in enumerate(claves, start=primera_fila) if c != ''}
+
+    def obtener(self, clave):
+        with self._lock:
+            return self._filas.get(clave)
+
+    def asignar(self, clave, fila):
+        with self._lock:
+            self._filas[clave] = fila
+
+    def quitar(self, clave):
+        """Quita la clave y recorre una posición hacia arriba las filas que estaban debajo."""
+        fila = self.obtener(clave)
+        if fila is not None:
+            self.quitar_filas([fila])
+        return fila
+
+    def quitar_filas(self, filas):
+        """Quita las filas borradas de la hoja y recorre hacia arriba las que estaban debajo."""
+        borradas = sorted(filas)
+        if not borradas:
+            return
+        conjunto = set(borradas)
+        with self._lock:
+            self._filas = {
+                k: f - bisect.bisect_left(borradas, f)
+                for k, f in self._filas.items() if f not in conjunto
+            }
+
+class IndiceFilasPorGrupo:
+    """Índice en memoria clave → filas ordenadas, para hojas con varias filas por clave (pagos por cliente)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filas = {}
+
+    def reconstruir(self, claves, primera_fila=2):
+        with self._lock:
+            self._filas = {}
+            for fila, clave in enumerate(claves, start=primera_fila):
+                if clave != '':
+                    self._filas.setdefault(str(clave), []).append(fila)
+
+    def obtener(self, clave):
+        with self._lock:
+            return list(self._filas.get(clave, []))
+
+    def asignar(self, clave, fila):
+        with self._lock:
+            filas = self._filas.setdefault(clave, [])
+            posicion = bisect.bisect_left(filas, fila)
+            # La misma fila puede llegar por el alta propia y por la lectura del libro
+            if posicion == len(filas) or filas[posicion] != fila:
+                filas.insert(posicion, fila)
+
+def agrupar_filas_contiguas(filas):
+    """Convierte [2, 3, 4, 9, 10] en [(2, 4), (9, 10)]."""
+    rangos = []
+    for fila in sorted(filas):
+        if rangos and fila == rangos[-1][1] + 1:
+            rangos[-1] = (rangos[-1][0], fila)
+        else:
+            rangos.append((fila, fila))
+    return rangos
+
+def solicitud_borrar_filas(sheet_id, inicio, fin):
+    """Petición deleteDimension de batchUpdate para las filas inicio..fin (base 1, inclusivas)."""
+    return {
+        'deleteDimension': {
+            'range': {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': inicio - 1, 'endIndex': fin}
+        }
+    }
+
+# ============================================
+# COLA DE ESCRITURA
+# ============================================
+class EscrituraFallida(Exception):
+    """Una operación encolada no se pudo escribir; ya salió de la cola y no se reintentará."""
+
+class ColaEscrituras:
+    """Cola de escritura diferida: junta las altas y actualizaciones pendientes de cada hoja.
+
+    Al vaciarse, cada hoja recibe un solo append_rows con todas sus altas y un solo
+    batch_update con todas sus actualizaciones. Se vacía en segundo plano al llegar a
+    max_pendientes operaciones o a los max_espera segundos de la primera operación
+    encolada, o cuando se llama vaciar() explícitamente (al terminar cada acción de la interfaz).
+    Los lotes salen de la cola con el lock tomado y se envían ya sin él: encolar nunca
+    espera a la red ni al limitador de cuota.
+
+    Cada operación encolada devuelve un comprobante. Un lote que falla sale de la cola
+    (nunca se reintenta: la interfaz ya le dijo al usuario que no se guardó) y su error
+    queda guardado para los comprobantes del lote; solo quien confirme uno de ellos lo ve.
+    """
+
+    def __init__(self, cache_hojas, indices=None, max_pendientes=20, max_espera=2.0, max_fallidas=1000,
+                 al_terminar_lote=None):
+        # indices: hoja -> [(columna, índice)], para registrar el número de fila de cada alta al escribirse
+        self._cache = cache_hojas
+        self._indices = indices or {}
+        # al_terminar_lote(comprobantes, error): tras enviar cada lote, con error None si se escribió.
+        # Se llama durante el envío, sin el lock de la cola
+        self._al_terminar_lote = al_terminar_lote
+        self.max_pendientes = max_pendientes
+        self.max_espera = max_espera
+        self.max_fallidas = max_fallidas
+        self._lock = threading.RLock()
+        # Un solo envío a la vez: quien vacía espera al envío en curso, así al volver ya está escrito lo suyo
+        self._lock_envio = threading.Lock()
+        self._altas = {}            # hoja -> lista de (comprobante, fila)
+        self._actualizaciones = {}  # hoja -> {rango: valores}, en orden de llegada
+        self._comprobantes_actualizaciones = {}  # hoja -> comprobantes de sus actualizaciones en cola
+        # comprobante -> error, de los lotes que fallaron y aún nadie confirmó; las más viejas se olvidan
+        self._fallidas = OrderedDict()
+        self._siguiente_comprobante = 0
+        self._temporizador = None
+
+    def pendientes(self):
+        with self._lock:
+            return self._pendientes()
+
+    def _pendientes(self):
+        """Con el lock tomado."""
+        return (sum(len(a) for a in self._altas.values()) +
+                sum(len(a) for a in self._actualizaciones.values()))
+
+    def _comprobante(self):
+        """Con el lock tomado."""
+        self._siguiente_comprobante += 1
+        return self._siguiente_comprobante
+
+    def encolar_alta(self, hoja, fila):
+        """Encola una fila nueva y devuelve su comprobante; sus claves se registran en los índices al escribirse."""
+        with self._lock:
+            comprobante = self._comprobante()
+            self._altas.setdefault(hoja, []).append((comprobante, list(fila)))
+        self._revisar_umbral()
+        return comprobante
+
+    def encolar_actualizaciones(self, hoja, actualizaciones):
+        """Encola varias escrituras {rango: valores} de una vez y devuelve su comprobante.
+
+        Una escritura posterior al mismo rango reemplaza a la anterior. El umbral se revisa
+        al final, así viajan juntas.
+        """
+        with self._lock:
+            comprobante = self._comprobante()
+            pendientes = self._actualizaciones.setdefault(hoja, {})
+            for rango, valores in actualizaciones.items():
+                pendientes.pop(rango, None)
+                pendientes[rango] = valores
+            self._comprobantes_actualizaciones.setdefault(hoja, []).append(comprobante)
+        self._revisar_umbral()
+        return comprobante
+
+    def corregir_alta(self, hoja, clave, corregir):
+        """Aplica corregir(fila) al alta aún no enviada cuya primera columna es clave, con el lock tomado.
+
+        Devuelve el comprobante del alta, o None si no hay ninguna en cola (puede estar enviándose:
+        ver esperar_envio). Quien corrige la fila confirma el comprobante del alta: si el lote
+        falla, su cambio tampoco se guardó. Las excepciones de corregir dejan la fila sin tocar.
+        """
+        with self._lock:
+            for comprobante, fila in self._altas.get(hoja, []):
+                if str(fila[0]) == clave:
+                    corregida = list(fila)
+                    corregir(corregida)
+                    fila[:] = corregida
+                    return comprobante
+        return None
+
+    def esperar_envio(self):
+        """Espera a que termine el envío en curso, si hay uno; no envía nada."""
+        with self._lock_envio:
+            pass
+
+    def _revisar_umbral(self):
+        with self._lock:
+            lleno = self._pendientes() >= self.max_pendientes
+            if self._temporizador is not None and not lleno:
+                return
+            if self._temporizador is not None:
+                self._temporizador.cancel()
+            # Lleno: se vacía ya, pero en otro hilo, para que quien encola no espere al envío
+            self._temporizador = threading.Timer(0 if lleno else self.max_espera, self.vaciar)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+
+    def _lote_terminado(self, comprobantes, error=None):
+        """Guarda el error para los comprobantes de un lote que falló y avisa a al_terminar_lote."""
+        if error is not None:
+            with self._lock:
+                for comprobante in comprobantes:
+                    self._fallidas[comprobante] = error
+                while len(self._fallidas) > self.max_fallidas:
+                    self._fallidas.popitem(last=False)
+        if self._al_terminar_lote is not None:
+            self._al_terminar_lote(comprobantes, error)
+
+    def vaciar(self):
+        """Escribe todo lo pendiente, un lote por hoja y tipo de operación.
+
+        No lanza errores de escritura: un lote que falla sale de la cola y su error queda
+        para quien confirme alguno de sus comprobantes, así no bloquea a las demás sesiones.
+        """
+        with self._lock_envio:
+            with self._lock:
+                if self._temporizador is not None:
+                    self._temporizador.cancel()
+                    self._temporizador = None
+                altas, self._altas = self._altas, {}
+                actualizaciones, self._actualizaciones = self._actualizaciones, {}
+                comprobantes_actualizaciones, self._comprobantes_actualizaciones = self._comprobantes_actualizaciones, {}
+
+            for titulo, lote in altas.items():
+                filas = [fila for _, fila in lote]
+                comprobantes = [comprobante for comprobante, _ in lote]
+                try:
+                    respuesta = self._cache.ejecutar(
+                        lambda: self._cache.llamar(self._cache.hoja(titulo).append_rows, filas, prioridad=PRIORIDAD_ESCRITURA)
+                    )
+                except Exception as e:
+                    self._lote_terminado(comprobantes, e)
+                    continue
+                primera = fila_inicial_de_rango(respuesta['updates']['updatedRange'])
+                for columna, indice in self._indices.get(titulo, []):
+                    for desplazamiento, fila in enumerate(filas):
+                        indice.asignar(str(fila[columna]), primera + desplazamiento)
+                self._lote_terminado(comprobantes)
+            for titulo, pendientes in actualizaciones.items():
+                datos = [{'range': r, 'values': v} for r, v in pendientes.items()]
+                comprobantes = comprobantes_actualizaciones.get(titulo, [])
+                try:
+                    self._cache.ejecutar(
+                        lambda: self._cache.llamar(self._cache.hoja(titulo).batch_update, datos, prioridad=PRIORIDAD_ESCRITURA)
+                    )
+                except Exception as e:
+                    self._lote_terminado(comprobantes, e)
+                    continue
+                self._lote_terminado(comprobantes)
+
+    def confirmar(self, comprobantes):
+        """Vacía la cola y lanza EscrituraFallida si alguno de estos comprobantes no se pudo escribir.
+
+        Cada error se entrega una sola vez: el comprobante se olvida al confirmarlo.
+        """
+        self.vaciar()
+        with self._lock:
+            errores = [self._fallidas.pop(c) for c in comprobantes if c in self._fallidas]
+        if errores:
+            raise EscrituraFallida(errores[0]) from errores[0]
+
+# ============================================
+# MOTORES DE ALMACENAMIENTO
+# ============================================
+COLUMNA_VERSION = COLUMNAS_CLIENTES.index('version')
+
+class ConflictoVersion(Exception):
+    """Otra sesión modificó (o eliminó) el cliente después de que esta sesión lo leyó."""
+
+class TurnoOcupado(Exception):
+    """Otro proceso tiene el turno de conciliación y todavía no vence."""
+
+class LibroDesfasado(Exception):
+    """El libro de pagos ya no coincide con una marca (se borraron o movieron filas a mano)."""
+
+def version_de(valor):
+    """Versión guardada en una celda; las filas anteriores a la columna version cuentan como 0."""
+    return int(valor) if valor not in ('', None) else 0
+
+class Almacenamiento:
+    """Interfaz común de los motores de almacenamiento de clientes y pagos.
+
+    Las escrituras de clientes son de comparar y asignar: version_leida es la versión que
+    tenía el cliente cuando la sesión lo leyó (None para un alta) y, si la guardada ya es
+    otra, se lanza ConflictoVersion sin escribir nada. Los pagos nunca se modifican ni se
+    borran: registrar o anular un pago es agregar un evento al libro.
+
+    total_pagado y saldo_pendiente de la fila del cliente son una instantánea que solo escribe
+    guardar_instantanea, junto con la marca del libro hasta la que llega. Una marca es
+    (posición, pago_id del último evento incluido); con la instantánea y los eventos
+    posteriores a su marca se tienen los saldos al día sin leer el libro completo.
+    """
+    nombre = ""
+
+    def leer_registros(self):
+        """Lee todo: devuelve (tabla_clientes, tabla_pagos, marca del libro leído).
+
+        Una tabla es {columna: lista de valores}, en el orden de las filas.
+        """
+        raise NotImplementedError
+
+    def leer_clientes(self):
+        """Devuelve (tabla_clientes, marca de la instantánea de saldos o None si nunca se escribió)."""
+        raise NotImplementedError
+
+    def leer_cliente(self, cliente_id):
+        """Registro de un solo cliente, o None si ya no existe."""
+        raise NotImplementedError
+
+    def leer_pagos_cliente(self, cliente_id):
+        """Eventos del libro de pagos de un solo cliente, en el orden en que se agregaron."""
+        raise NotImplementedError
+
+    def leer_pagos_desde(self, marca):
+        """Devuelve (eventos agregados después de marca, marca nueva, revertidos hasta marca).
+
+        revertidos son los pago_id que anulan los reversos del libro hasta marca, ya descontados
+        en la instantánea. Lanza LibroDesfasado si marca ya no es válida.
+        """
+        raise NotImplementedError
+
+    def iterar_pagos(self, tam_bloque=2000):
+        """Recorre el libro de pagos completo en orden, en listas de hasta tam_bloque registros.
+
+        Cada bloque se lee al pedirlo, así que el libro nunca está entero en memoria.
+        """
+        raise NotImplementedError
+
+    def guardar_cliente(self, fila, version_leida):
+        """Inserta o actualiza la fila de un cliente (ordenada según COLUMNAS_CLIENTES).
+
+        Al actualizar no se tocan total_pagado ni saldo_pendiente: son de la instantánea.
+        Devuelve el comprobante para confirmar(), o None si ya quedó escrito.
+        """
+        raise NotImplementedError
+
+    def eliminar_cliente(self, cliente_id):
+        """Elimina un cliente; sus eventos se quedan en el libro de pagos."""
+        raise NotImplementedError
+
+    def agregar_pago(self, fila):
+        """Agrega un evento (pago o reverso) al libro de pagos; fila ordenada según COLUMNAS_PAGOS.
+
+        Devuelve el comprobante para confirmar(), o None si ya quedó escrito.
+        """
+        raise NotImplementedError
+
+    def reservar_ids(self, cantidad):
+        """Reserva de forma atómica cantidad números de cliente consecutivos y devuelve el primero."""
+        raise NotImplementedError
+
+    def guardar_instantanea(self, saldos, marca):
+        """Escribe en un solo lote la instantánea de saldos y la marca del libro que cubre.
+
+        saldos es {cliente_id: (total_pagado, saldo_pendiente)} calculado desde el libro hasta
+        marca. No cambia version ni updated_at: la instantánea no es algo que edite una sesión.
+        """
+        raise NotImplementedError
+
+    def tomar_turno_conciliacion(self, titular, duracion):
+        """Toma por duracion segundos el turno de escribir la instantánea entre todos los procesos.
+
+        Devuelve False si lo tiene otro titular y no ha vencido; el mismo titular lo renueva.
+        Dos instantáneas escritas a la vez pueden dejar la marca de una con saldos de la otra.
+        """
+        raise NotImplementedError
+
+    def soltar_turno_conciliacion(self, titular):
+        """Suelta el turno si todavía es de titular."""
+        raise NotImplementedError
+
+    def leer_cambios(self, marcas_clientes, marca_libro):
+        """Devuelve lo que cambió respecto a lo que ya conoce una sesión.
+
+        marcas_clientes es {cliente_id: updated_at} y marca_libro la marca hasta la que la sesión
+        leyó el libro de pagos. El resultado es un diccionario con 'clientes' (registros nuevos
+        o modificados), 'clientes_eliminados', 'pagos' (eventos posteriores a marca_libro),
+        'marca' (la marca nueva) e 'instantanea' (la marca de la instantánea guardada, como en
+        leer_clientes). Lanza LibroDesfasado si marca_libro ya no es válida.
+        """
+        raise NotImplementedError
+
+    def vaciar(self):
+        """Envía las escrituras diferidas; los motores que escriben al momento no hacen nada."""
+        pass
+
+    def confirmar(self, comprobantes):
+        """Envía las escrituras diferidas y lanza EscrituraFallida si alguna de estas no se guardó."""
+        self.vaciar()
+
+    def pendientes(self):
+        """Operaciones aún no enviadas (en cola o esperando cuota)."""
+        return 0
+
+class AlmacenamientoSheets(Almacenamiento):
+    """Motor que guarda los datos en la hoja de cálculo de Google Sheets.
+
+    La posición de una marca es el número de eventos del libro (el último está en la fila
+    posición + 1); el pago_id de la marca se compara con esa fila antes de leer lo posterior.
+    """
+    nombre = "Google Sheets"
+    # Segundos entre escribir el turno de conciliación y releerlo para ver quién se quedó con él
+    espera_turno = 5
+
+    def _ejecutar(self, operacion, *args):
+        return self._cache.ejecutar(operacion, *args)
+
+    def _api(self, funcion, *args, prioridad=PRIORIDAD_LECTURA, **kwargs):
+        return self._cache.llamar(funcion, *args, prioridad=prioridad, **kwargs)
+
+    def _hojas(self):
+        """Hojas de clientes y pagos."""
+        return self._cache.hoja("clientes"), self._cache.hoja("pagos")
+
+    def pendientes(self):
+        return self._cola.pendientes() + self._cache.limitador.en_espera()
+
+    def leer_registros(self):
+        return self._ejecutar(self._leer_registros)
+
+    def leer_clientes(self):
+        return self._ejecutar(self._leer_clientes)
+
+    def leer_cliente(self, cliente_id):
+        return self._ejecutar(self._leer_cliente, cliente_id)
+
+    def leer_pagos_cliente(self, cliente_id):
+        return self._ejecutar(self._leer_pagos_cliente, cliente_id)
+
+    def leer_pagos_desde(self, marca):
+        return self._ejecutar(self._leer_pagos_desde, marca)
+
+    def iterar_pagos(self, tam_bloque=2000):
+        inicio = 2
+        while True:
+            bloque = self._ejecutar(self._leer_bloque_pagos, inicio, tam_bloque)
+            if bloque:
+                yield bloque
+            # La API omite las filas vacías del final: un bloque incompleto es el último
+            if len(bloque) < tam_bloque:
+                return
+            inicio += tam_bloque
+
+    def guardar_cliente(self, fila, version_leida):
+        return self._ejecutar(self._guardar_cliente, fila, version_leida)
+
+    def eliminar_cliente(self, cliente_id):
+        self._ejecutar(self._eliminar_cliente, cliente_id)
+
+    def agregar_pago(self, fila):
+        return self._ejecutar(self._agregar_pago, fila)
+
+    def leer_cambios(self, marcas_clientes, marca_libro):
+        return self._ejecutar(self._leer_cambios, marcas_clientes, marca_libro)
+
+    def reservar_ids(self, cantidad):
+        return self._ejecutar(self._reservar_ids, cantidad)
+
+    def guardar_instantanea(self, saldos, marca):
+        self._ejecutar(self._guardar_instantanea, saldos, marca)
+
+    def tomar_turno_conciliacion(self, titular, duracion):
+        return self._ejecutar(self._tomar_turno_conciliacion, titular, duracion)
+
+    def soltar_turno_conciliacion(self, titular):
+        self._ejecutar(self._soltar_turno_conciliacion, titular)
+
+    def vaciar(self):
+        self._cola.vaciar()
+
+    def confirmar(self, comprobantes):
+        self._cola.confirmar(comprobantes)
+
+    def __init__(self, cache_hojas):
+        self._cache = cache_hojas
+        # Comprobar la versión y encolar la escritura es un solo paso para todas las sesiones
+        self._lock_versiones = threading.Lock()
+        # cliente_id -> (versión, comprobante) de las escrituras encoladas que la hoja todavía no
+        # refleja; cada una se olvida al terminar su lote, se haya escrito o no
+        self._versiones = {}
+        self._lock_encoladas = threading.Lock()
+        self._filas_clientes = IndiceFilas()
+        # Las filas de pagos por cliente solo se conocen tras leer la columna A completa una vez
+        self._filas_pagos = IndiceFilasPorGrupo()
+        self._indice_pagos_completo = False
+        self._cola = ColaEscrituras(
+            self._cache,
+            indices={
+                'clientes': [(0, self._filas_clientes)],
+                'pagos': [(0, self._filas_pagos)],
+            },
+            al_terminar_lote=self._olvidar_versiones
+        )
+
+    def _olvidar_versiones(self, comprobantes, error):
+        """Tras cada lote la hoja tiene la versión escrita, o la anterior si el lote falló: ya no hace falta recordarla."""
+        comprobantes = set(comprobantes)
+        with self._lock_encoladas:
+            for cliente_id, (_, comprobante) in list(self._versiones.items()):
+                if comprobante in comprobantes:
+                    del self._versiones[cliente_id]
+
+    def _fila_cliente(self, hoja_clientes, cliente_id):
+        """Número de fila del cliente según el índice; si la celda de ID no coincide, reconstruye el índice."""
+        fila = self._filas_clientes.obtener(cliente_id)
+        if fila is not None and str(self._api(hoja_clientes.cell, fila, 1).value) == cliente_id:
+            return fila
+        if fila is None:
+            return None
+        # El índice se desfasó (cambios desde otra sesión o a mano en la hoja)
+        self._filas_clientes.reconstruir(self._api(hoja_clientes.col_values, 1)[1:])
+        return self._filas_clientes.obtener(cliente_id)
+
+    def _fila_y_valores(self, hoja_clientes, cliente_id):
+        """Número de fila y valores A:O del cliente con una sola lectura; (None, None) si no está en la hoja."""
+        fila = self._filas_clientes.obtener(cliente_id)
+        for _ in range(2):
+            if fila is None:
+                return None, None
+            leidos = self._api(hoja_clientes.get, f"A{fila}:O{fila}", value_render_option='UNFORMATTED_VALUE')
+            valores = list(leidos[0]) if leidos else []
+            if valores and str(valores[0]) == cliente_id:
+                return fila, valores + [''] * (len(COLUMNAS_CLIENTES) - len(valores))
+            # El índice se desfasó (cambios desde otra sesión o a mano en la hoja)
+            self._filas_clientes.reconstruir(self._api(hoja_clientes.col_values, 1)[1:])
+            fila = self._filas_clientes.obtener(cliente_id)
+        return None, None
+
+    def _comprobar_version(self, cliente_id, en_hoja, version_leida):
+        """Lanza ConflictoVersion si el cliente ya no está en la versión que leyó la sesión."""
+        with self._lock_encoladas:
+            encolada, _ = self._versiones.get(cliente_id, (0, None))
+        actual = max(version_de(en_hoja), encolada)
+        if version_leida is None or actual != version_leida:
+            raise ConflictoVersion(cliente_id)
+
+    def _filas_pagos_cliente(self, hoja_pagos, cliente_id):
+        """Filas de pagos del cliente según el índice, comprobadas con una sola lectura de sus celdas de ID."""
+        if not self._indice_pagos_completo:
+            self._filas_pagos.reconstruir(self._api(hoja_pagos.col_values, 1)[1:])
+            self._indice_pagos_completo = True
+        filas = self._filas_pagos.obtener(cliente_id)
+        if not filas:
+            return filas
+        rangos = agrupar_filas_contiguas(filas)
+        valores = self._api(hoja_pagos.batch_get, [f"A{inicio}:A{fin}" for inicio, fin in rangos])
+        leidos = [str(celda[0]) if celda else '' for bloque in valores for celda in bloque]
+        if leidos == [cliente_id] * len(filas):
+            return filas
+        self._filas_pagos.reconstruir(self._api(hoja_pagos.col_values, 1)[1:])
+        return self._filas_pagos.obtener(cliente_id)
+
+    def _migrar_encabezados_clientes(self, hoja_clientes, matriz_clientes):
+        if len(matriz_clientes) > 1 and 'version' not in matriz_clientes[0]:
+            # Hoja creada antes de las columnas N y O: agregar sus encabezados
+            self._api(
+                hoja_clientes.update, range_name="N1:O1", values=[['updated_at', 'version']],
+                prioridad=PRIORIDAD_ESCRITURA
+            )
+
+    def _leer_registros(self):
+        # Lo que siga en cola debe estar en la hoja antes de leerla
+        self._cola.vaciar()
+        hoja_clientes, hoja_pagos = self._hojas()
+
+        # Ambas hojas en una sola petición, con valores sin formato (sin numericise celda por celda)
+        respuesta = self._api(
+            self._cache.libro().values_batch_get,
+            ["clientes", "pagos"], params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        matriz_clientes, matriz_pagos = [rango.get('values', []) for rango in respuesta['valueRanges']]
+        tabla_clientes = tabla_desde_matriz(matriz_clientes, COLUMNAS_CLIENTES)
+        tabla_pagos = tabla_desde_matriz(matriz_pagos, COLUMNAS_PAGOS)
+        self._migrar_encabezados_clientes(hoja_clientes, matriz_clientes)
+        if matriz_pagos and 'tipo' not in matriz_pagos[0]:
+            # Hoja creada antes del libro de eventos: sus filas son pagos (tipo vacío cuenta como pago)
+            self._api(
+                hoja_pagos.update, range_name="I1:J1", values=[['tipo', 'revierte']],
+                prioridad=PRIORIDAD_ESCRITURA
+            )
+        self._completar_pago_ids(hoja_pagos, tabla_pagos['pago_id'])
+        self._filas_clientes.reconstruir(tabla_clientes['cliente_id'])
+        self._filas_pagos.reconstruir(tabla_pagos['cliente_id'])
+        self._indice_pagos_completo = True
+        pago_ids = tabla_pagos['pago_id']
+        marca = (len(pago_ids), str(pago_ids[-1]) if pago_ids else '')
+        return tabla_clientes, tabla_pagos, marca
+
+    def _completar_pago_ids(self, hoja_pagos, pago_ids):
+        """Asigna pago_id a los pagos registrados antes de existir la columna y lo guarda en la hoja."""
+        if all(pago_ids):
+            return
+        for i, pago_id in enumerate(pago_ids):
+            if not pago_id:
+                pago_ids[i] = generar_pago_id()
+        columna = chr(ord('A') + COLUMNAS_PAGOS.index('pago_id'))
+        valores = [['pago_id']] + [[pago_id] for pago_id in pago_ids]
+        self._api(
+            hoja_pagos.update, range_name=f"{columna}1:{columna}{len(valores)}", values=valores,
+            prioridad=PRIORIDAD_ESCRITURA
+        )
+
+    def _leer_clientes(self):
+        self._cola.vaciar()
+        hoja_clientes, _ = self._hojas()
+        self._hoja_contadores()
+
+        # Clientes y marca de la instantánea en una sola petición; el libro de pagos no se descarga
+        respuesta = self._api(
+            self._cache.libro().values_batch_get,
+            ["clientes", "contadores!B2:B3"], params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        matriz_clientes, matriz_marca = [rango.get('values', []) for rango in respuesta['valueRanges']]
+        tabla_clientes = tabla_desde_matriz(matriz_clientes, COLUMNAS_CLIENTES)
+        self._migrar_encabezados_clientes(hoja_clientes, matriz_clientes)
+        self._filas_clientes.reconstruir(tabla_clientes['cliente_id'])
+
+        return tabla_clientes, self._marca_instantanea(matriz_marca)
+
+    @staticmethod
+    def _marca_instantanea(matriz):
+        """Marca guardada en contadores!B2:B3, o None si todavía no se escribió ninguna instantánea."""
+        valores = [fila[0] if fila else '' for fila in matriz] + ['', '']
+        if valores[0] in ('', None):
+            return None
+        return (int(valores[0]), str(valores[1]))
+
+    def _leer_cliente(self, cliente_id):
+        self._cola.vaciar()
+        hoja_clientes, _ = self._hojas()
+
+        fila, valores = self._fila_y_valores(hoja_clientes, cliente_id)
+        return None if fila is None else dict(zip(COLUMNAS_CLIENTES, valores))
+
+    def _leer_pagos_cliente(self, cliente_id):
+        self._cola.vaciar()
+        _, hoja_pagos = self._hojas()
+
+        filas = self._filas_pagos_cliente(hoja_pagos, cliente_id)
+        registros_pagos = []
+        if filas:
+            bloques = self._api(
+                hoja_pagos.batch_get, [f"A{inicio}:J{fin}" for inicio, fin in agrupar_filas_contiguas(filas)],
+                value_render_option='UNFORMATTED_VALUE'
+            )
+            for bloque in bloques:
+                for pago in bloque:
+                    pago = list(pago) + [''] * (len(COLUMNAS_PAGOS) - len(pago))
+                    registros_pagos.append(dict(zip(COLUMNAS_PAGOS, pago)))
+        return registros_pagos
+
+    @staticmethod
+    def _rango_libro(marca):
+        """Rango A1 desde la fila del último evento de la marca (para comprobarla) hasta el final."""
+        posicion, _ = marca
+        return f"pagos!A{posicion + 1}:J" if posicion else "pagos!A2:J"
+
+    def _eventos_desde(self, filas, marca):
+        """Comprueba la primera fila contra la marca y convierte las siguientes en registros."""
+        posicion, pago_id = marca
+        if posicion:
+            primera = list(filas[0]) if filas else []
+            columna = COLUMNAS_PAGOS.index('pago_id')
+            if len(primera) <= columna or str(primera[columna]) != pago_id:
+                raise LibroDesfasado(marca)
+            filas = filas[1:]
+        registros = []
+        for numero, valores in enumerate(filas, start=posicion + 2):
+            valores = list(valores) + [''] * (len(COLUMNAS_PAGOS) - len(valores))
+            registro = dict(zip(COLUMNAS_PAGOS, valores))
+            registros.append(registro)
+            if self._indice_pagos_completo and registro['cliente_id'] != '':
+                # Eventos de otros procesos: el índice de filas por cliente sigue completo
+                self._filas_pagos.asignar(str(registro['cliente_id']), numero)
+        if not registros:
+            return registros, marca
+        return registros, (posicion + len(registros), str(registros[-1]['pago_id']))
+
+    def _leer_bloque_pagos(self, inicio, cantidad):
+        """Registros de las filas inicio a inicio + cantidad - 1 del libro de pagos."""
+        self._cola.vaciar()
+        respuesta = self._api(
+            self._cache.libro().values_get,
+            f"pagos!A{inicio}:J{inicio + cantidad - 1}", params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        relleno = [''] * len(COLUMNAS_PAGOS)
+        return [
+            dict(zip(COLUMNAS_PAGOS, list(fila) + relleno[len(fila):]))
+            for fila in respuesta.get('values', [])
+        ]
+
+    def _leer_pagos_desde(self, marca):
+        self._cola.vaciar()
+        posicion, _ = marca
+        # Del tramo ya contado solo hacen falta tipo y revierte (columnas I:J), en la misma petición
+        rangos = [self._rango_libro(marca)] + ([f"pagos!I2:J{posicion + 1}"] if posicion else [])
+        respuesta = self._api(
+            self._cache.libro().values_batch_get,
+            rangos, params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        leidos = [rango.get('values', []) for rango in respuesta['valueRanges']]
+        eventos, marca_nueva = self._eventos_desde(leidos[0], marca)
+        contados = leidos[1] if posicion else []
+        revertidos = {str(fila[1]) for fila in contados if len(fila) > 1 and fila[0] == TIPO_REVERSO}
+        return eventos, marca_nueva, revertidos
+
+    def _guardar_cliente(self, fila, version_leida):
+        """Comprueba la versión y encola la escritura del cliente en un solo paso.
+
+        La comparación y asignación es atómica solo dentro de este proceso (_lock_versiones y
+        _versiones viven en memoria): la hoja no tiene un comparar y asignar propio, así que
+        dos procesos que escriben al mismo cliente a la vez pueden pisarse. Para eso el
+        almacenamiento SQLite compara la versión en la misma sentencia UPDATE.
+        """
+        hoja_clientes, _ = self._hojas()
+        cliente_id = str(fila[0])
+
+        def corregir_en_cola(en_cola):
+            # El alta todavía no se envía: basta con corregir la fila en cola (sin tocar J:K)
+            self._comprobar_version(cliente_id, en_cola[COLUMNA_VERSION], version_leida)
+            en_cola[:] = list(fila[:9]) + en_cola[9:11] + list(fila[11:])
+
+        with self._lock_versiones:
+            comprobante = self._cola.corregir_alta("clientes", cliente_id, corregir_en_cola)
+            if comprobante is not None:
+                return comprobante
+
+            # Un alta que se está enviando aún no tiene fila en el índice
+            self._cola.esperar_envio()
+            numero_fila, valores = self._fila_y_valores(hoja_clientes, cliente_id)
+            if numero_fila is not None:
+                self._comprobar_version(cliente_id, valores[COLUMNA_VERSION], version_leida)
+            elif version_leida is not None:
+                # Otra sesión eliminó al cliente
+                raise ConflictoVersion(cliente_id)
+
+            # La versión se registra antes de que su lote pueda terminar y olvidarla
+            with self._lock_encoladas:
+                if numero_fila is not None:
+                    # Actualizar fila existente sin J:K, que son de la instantánea de saldos
+                    comprobante = self._cola.encolar_actualizaciones("clientes", {
+                        f"A{numero_fila}:I{numero_fila}": [fila[:9]],
+                        f"L{numero_fila}:O{numero_fila}": [fila[11:]],
+                    })
+                else:
+                    # Agregar nueva fila
+                    comprobante = self._cola.encolar_alta("clientes", fila)
+                self._versiones[cliente_id] = (fila[COLUMNA_VERSION], comprobante)
+            return comprobante
+
+    def _eliminar_cliente(self, cliente_id):
+        # Los borrados recorren filas: primero se escribe lo que esté en cola
+        self._cola.vaciar()
+        hoja_clientes, _ = self._hojas()
+
+        fila_cliente = self._fila_cliente(hoja_clientes, cliente_id)
+        if fila_cliente is None:
+            return
+
+        self._api(
+            self._cache.libro().batch_update,
+            {'requests': [solicitud_borrar_filas(hoja_clientes.id, fila_cliente, fila_cliente)]},
+            prioridad=PRIORIDAD_ESCRITURA
+        )
+        with self._lock_encoladas:
+            self._versiones.pop(cliente_id, None)
+        self._filas_clientes.quitar(cliente_id)
+
+    def _agregar_pago(self, fila):
+        return self._cola.encolar_alta("pagos", fila)
+
+    def _guardar_instantanea(self, saldos, marca):
+        # Filas según el índice que dejó la lectura completa de la conciliación; sin releer cada fila
+        self._cola.vaciar()
+        self._hoja_contadores()
+        datos = []
+        for cliente_id, (total_pagado, saldo_pendiente) in saldos.items():
+            fila = self._filas_clientes.obtener(cliente_id)
+            if fila is not None:
+                datos.append({'range': f"clientes!J{fila}:K{fila}", 'values': [[total_pagado, saldo_pendiente]]})
+        datos.append({
+            'range': "contadores!A2:B3",
+            'values': [['pagos_en_instantanea', marca[0]], ['ultimo_pago_instantanea', marca[1]]],
+        })
+        # Saldos y marca en una sola petición: una instantánea a medias sumaría eventos dos veces
+        self._api(
+            self._cache.libro().values_batch_update,
+            {'valueInputOption': 'RAW', 'data': datos}, prioridad=PRIORIDAD_ESCRITURA
+        )
+
+    def _leer_turno(self, hoja_contadores):
+        """(titular, vence) del turno de conciliación; ('', 0) si nunca se tomó."""
+        leidos = self._api(hoja_contadores.get, "B4:B5", value_render_option='UNFORMATTED_VALUE')
+        valores = [fila[0] if fila else '' for fila in leidos] + ['', '']
+        return str(valores[0]), float(valores[1] or 0)
+
+    def _escribir_turno(self, titular, vence):
+        self._api(
+            self._cache.libro().values_batch_update,
+            {'valueInputOption': 'RAW', 'data': [{
+                'range': "contadores!A4:B5",
+                'values': [['conciliacion_titular', titular], ['conciliacion_vence', vence]],
+            }]},
+            prioridad=PRIORIDAD_ESCRITURA
+        )
+
+    def _tomar_turno_conciliacion(self, titular, duracion):
+        # Sheets no tiene comparar y asignar: se escribe el turno solo si está libre y, tras
+        # espera_turno, se relee. Si otro proceso escribió a la vez, gana el último en escribir
+        # y los demás lo ven al releer
+        contadores = self._hoja_contadores()
+        actual, vence = self._leer_turno(contadores)
+        if actual not in ('', titular) and vence > time.time():
+            return False
+        self._escribir_turno(titular, time.time() + duracion)
+        time.sleep(self.espera_turno)
+        return self._leer_turno(contadores)[0] == titular
+
+    def _soltar_turno_conciliacion(self, titular):
+        if self._leer_turno(self._hoja_contadores())[0] == titular:
+            self._escribir_turno('', 0)
+
+    def _hoja_contadores(self):
+        """Hoja 'contadores' (B2:B3 marca de la instantánea; B4:B5 turno de conciliación; B1 es el
+        contador de IDs anterior a 'reservas_ids', que solo se lee para migrarlo); se crea si no existe."""
+        cache = self._cache
+        try:
+            return cache.hoja("contadores")
+        except gspread.exceptions.WorksheetNotFound:
+            self._api(cache.libro().add_worksheet, "contadores", rows=10, cols=2, prioridad=PRIORIDAD_ESCRITURA)
+            return cache.hoja("contadores")
+
+    def _hoja_reservas(self):
+        """Hoja 'reservas_ids': una fila por bloque reservado, con su cantidad en la columna A.
+
+        La primera fila tras los encabezados reserva los números ya usados antes de existir la
+        hoja (el contador B1 de 'contadores', o los IDs de clientes y del libro de pagos, que
+        conserva los de clientes eliminados: un ID reutilizado heredaría sus pagos). Hoja, encabezados
+        y esa fila se crean en un solo batchUpdate, que Sheets aplica completo o nada: si dos
+        procesos la crean a la vez, al segundo le falla la petición y usa la del primero.
+        """
+        cache = self._cache
+        try:
+            return cache.hoja("reservas_ids")
+        except gspread.exceptions.WorksheetNotFound:
+            pass
+        anterior = self._api(self._hoja_contadores().acell, "B1", value_render_option='UNFORMATTED_VALUE').value
+        if anterior in (None, ''):
+            hoja_clientes, hoja_pagos = self._hojas()
+            anterior = siguiente_de(
+                self._api(hoja_clientes.col_values, 1)[1:] + self._api(hoja_pagos.col_values, 1)[1:]
+            )
+        sheet_id = random.randint(1, 2**31 - 1)
+        filas = [['cantidad', 'reservado'], [int(anterior) - 1, 'anteriores']]
+        celda = lambda v: {'userEnteredValue': {'numberValue': v} if isinstance(v, int) else {'stringValue': v}}
+        try:
+            self._api(
+                cache.libro().batch_update,
+                {'requests': [
+                    {'addSheet': {'properties': {
+                        'sheetId': sheet_id, 'title': 'reservas_ids',
+                        'gridProperties': {'rowCount': 100, 'columnCount': 2},
+                    }}},
+                    {'updateCells': {
+                        'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                        'rows': [{'values': [celda(v) for v in fila]} for fila in filas],
+                        'fields': 'userEnteredValue',
+                    }},
+                ]},
+                prioridad=PRIORIDAD_ESCRITURA
+            )
+        except gspread.exceptions.APIError as e:
+            # Otro proceso la creó primero; si tampoco existe, el error era otro
+            try:
+                return cache.hoja("reservas_ids")
+            except gspread.exceptions.WorksheetNotFound:
+                raise e
+        return cache.hoja("reservas_ids")
+
+    def _reservar_ids(self, cantidad):
+        # Sheets no tiene transacciones, pero cada append cae en su propia fila aunque lleguen
+        # a la vez desde varios procesos: la fila decide el bloque, sin leer y escribir un contador
+        hoja = self._hoja_reservas()
+        respuesta = self._api(
+            hoja.append_rows, [[cantidad, marca_actualizacion()]], value_input_option='RAW',
+            insert_data_option='INSERT_ROWS', table_range="A1", prioridad=PRIORIDAD_ESCRITURA
+        )
+        fila = fila_inicial_de_rango(respuesta['updates']['updatedRange'])
+        # El bloque empieza después de todo lo reservado en las filas de arriba, que ya no cambian
+        anteriores = self._api(hoja.get, f"A2:A{fila - 1}", value_render_option='UNFORMATTED_VALUE')
+        return 1 + sum(int(valores[0]) for valores in anteriores if valores and valores[0] != '')
+
+    def _leer_cambios(self, marcas_clientes, marca_libro):
+        self._cola.vaciar()
+        libro = self._cache.libro()
+        self._hoja_contadores()
+
+        # 1) Columnas de control de clientes (IDs y updated_at), la marca de la instantánea
+        #    y el tramo del libro posterior a la marca de la sesión
+        leidos = self._api(
+            libro.values_batch_get,
+            ["clientes!A2:A", "clientes!N2:N", "contadores!B2:B3", self._rango_libro(marca_libro)],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )['valueRanges']
+        ids_clientes, marcas = [
+            [str(celda[0]) if celda else '' for celda in rango.get('values', [])] for rango in leidos[:2]
+        ]
+        marcas += [''] * (len(ids_clientes) - len(marcas))
+        eventos, marca = self._eventos_desde(leidos[3].get('values', []), marca_libro)
+
+        # Las columnas leídas sirven además para dejar al día el índice de filas
+        self._filas_clientes.reconstruir(ids_clientes)
+
+        # 2) Una segunda lectura trae solo las filas de clientes nuevas o modificadas
+        filas_clientes = [
+            i for i, (cid, marca_cliente) in enumerate(zip(ids_clientes, marcas), start=2)
+            if cid and marcas_clientes.get(cid) != marca_cliente
+        ]
+        registros = []
+        if filas_clientes:
+            rangos = [f"clientes!A{i}:O{f}" for i, f in agrupar_filas_contiguas(filas_clientes)]
+            for rango in self._api(
+                libro.values_batch_get, rangos, params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+            )['valueRanges']:
+                for valores in rango.get('values', []):
+                    valores = list(valores) + [''] * (len(COLUMNAS_CLIENTES) - len(valores))
+                    registros.append(dict(zip(COLUMNAS_CLIENTES, valores)))
+
+        vigentes = set(ids_clientes)
+        return {
+            'clientes': registros,
+            'clientes_eliminados': [cid for cid in marcas_clientes if cid not in vigentes],
+            'pagos': eventos,
+            'marca': marca,
+            'instantanea': self._marca_instantanea(leidos[2].get('values', [])),
+        }
+
+class AlmacenamientoSQLite(Almacenamiento):
+    """Motor local en SQLite (modo WAL); también sirve como respaldo sin conexión para pruebas.
+
+    La posición de una marca es el id autoincremental del último evento; los id no se reutilizan,
+    así que la marca nunca se desfasa y su pago_id no hace falta.
+    """
+    nombre = "SQLite"
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        # Streamlit atiende cada sesión en su propio hilo: una sola conexión protegida por candado
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS clientes ("
+            "cliente_id TEXT PRIMARY KEY, nombre TEXT, telefono TEXT, email TEXT, "
+            "asientos INTEGER, hab_sencillas INTEGER, hab_dobles INTEGER, hab_triples INTEGER, "
+            "total_a_pagar REAL, total_pagado REAL, saldo_pendiente REAL, notas TEXT, fecha_registro TEXT, "
+            "updated_at TEXT, version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columnas_clientes = [r['name'] for r in self._conn.execute("PRAGMA table_info(clientes)")]
+        if 'updated_at' not in columnas_clientes:
+            self._conn.execute("ALTER TABLE clientes ADD COLUMN updated_at TEXT")
+        if 'version' not in columnas_clientes:
+            self._conn.execute("ALTER TABLE clientes ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pagos ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, cliente_id TEXT, fecha TEXT, monto REAL, "
+            "metodo TEXT, referencia TEXT, notas TEXT, timestamp TEXT, pago_id TEXT, "
+            "tipo TEXT NOT NULL DEFAULT 'pago', revierte TEXT NOT NULL DEFAULT '')"
+        )
+        # Bases creadas antes de existir pago_id: agregar la columna y completar los pagos viejos
+        columnas_pagos = [r['name'] for r in self._conn.execute("PRAGMA table_info(pagos)")]
+        if 'pago_id' not in columnas_pagos:
+            self._conn.execute("ALTER TABLE pagos ADD COLUMN pago_id TEXT")
+        if 'tipo' not in columnas_pagos:
+            self._conn.execute("ALTER TABLE pagos ADD COLUMN tipo TEXT NOT NULL DEFAULT 'pago'")
+            self._conn.execute("ALTER TABLE pagos ADD COLUMN revierte TEXT NOT NULL DEFAULT ''")
+        for (rowid,) in self._conn.execute("SELECT id FROM pagos WHERE pago_id IS NULL").fetchall():
+            self._conn.execute("UPDATE pagos SET pago_id = ? WHERE id = ?", (generar_pago_id(), rowid))
+        self._conn.execute("CREATE TABLE IF NOT EXISTS secuencias (nombre TEXT PRIMARY KEY, valor INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS turnos (nombre TEXT PRIMARY KEY, titular TEXT, vence REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pagos_cliente ON pagos (cliente_id)")
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pagos_pago_id ON pagos (pago_id)")
+
+    def _marca_actual(self):
+        (ultimo,) = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM pagos").fetchone()
+        return (ultimo, '')
+
+    def leer_registros(self):
+        with self._lock:
+            clientes = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_CLIENTES)} FROM clientes ORDER BY rowid"
+            ).fetchall()
+            pagos = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_PAGOS)} FROM pagos ORDER BY id"
+            ).fetchall()
+            marca = self._marca_actual()
+        return tabla_desde_filas(clientes, COLUMNAS_CLIENTES), tabla_desde_filas(pagos, COLUMNAS_PAGOS), marca
+
+    def _marca_instantanea(self):
+        fila = self._conn.execute("SELECT valor FROM secuencias WHERE nombre = 'instantanea_pagos'").fetchone()
+        return None if fila is None else (fila[0], '')
+
+    def leer_clientes(self):
+        with self._lock:
+            clientes = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_CLIENTES)} FROM clientes ORDER BY rowid"
+            ).fetchall()
+            instantanea = self._marca_instantanea()
+        return tabla_desde_filas(clientes, COLUMNAS_CLIENTES), instantanea
+
+    def leer_cliente(self, cliente_id):
+        with self._lock:
+            cliente = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_CLIENTES)} FROM clientes WHERE cliente_id = ?", (cliente_id,)
+            ).fetchone()
+        return dict(cliente) if cliente else None
+
+    def leer_pagos_cliente(self, cliente_id):
+        with self._lock:
+            pagos = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_PAGOS)} FROM pagos WHERE cliente_id = ? ORDER BY id", (cliente_id,)
+            ).fetchall()
+        return [dict(r) for r in pagos]
+
+    def _eventos_desde(self, marca):
+        filas = self._conn.execute(
+            f"SELECT id, {', '.join(COLUMNAS_PAGOS)} FROM pagos WHERE id > ? ORDER BY id", (marca[0],)
+        ).fetchall()
+        registros = [{c: fila[c] for c in COLUMNAS_PAGOS} for fila in filas]
+        return registros, ((filas[-1]['id'], '') if filas else marca)
+
+    def leer_pagos_desde(self, marca):
+        with self._lock:
+            eventos, marca_nueva = self._eventos_desde(marca)
+            revertidos = self._conn.execute(
+                "SELECT DISTINCT revierte FROM pagos WHERE tipo = ? AND id <= ?", (TIPO_REVERSO, marca[0])
+            ).fetchall()
+        return eventos, marca_nueva, {r[0] for r in revertidos}
+
+    def iterar_pagos(self, tam_bloque=2000):
+        ultimo_id = 0
+        while True:
+            # Paginado por id y sin el lock entre bloques: las escrituras no esperan al recorrido
+            with self._lock:
+                filas = self._conn.execute(
+                    f"SELECT id, {', '.join(COLUMNAS_PAGOS)} FROM pagos WHERE id > ? ORDER BY id LIMIT ?",
+                    (ultimo_id, tam_bloque)
+                ).fetchall()
+            if not filas:
+                return
+            yield [{c: fila[c] for c in COLUMNAS_PAGOS} for fila in filas]
+            ultimo_id = filas[-1]['id']
+
+    def guardar_cliente(self, fila, version_leida):
+        with self._lock:
+            if version_leida is None:
+                try:
+                    self._conn.execute(
+                        f"INSERT INTO clientes ({', '.join(COLUMNAS_CLIENTES)}) "
+                        f"VALUES ({', '.join('?' * len(COLUMNAS_CLIENTES))})",
+                        fila
+                    )
+                except sqlite3.IntegrityError:
+                    raise ConflictoVersion(fila[0])
+                return
+            # Comparar y asignar en una sola sentencia: solo escribe si nadie cambió la versión;
+            # total_pagado y saldo_pendiente son de la instantánea y no se tocan
+            columnas = [c for c in COLUMNAS_CLIENTES[1:] if c not in ('total_pagado', 'saldo_pendiente')]
+            asignaciones = ', '.join(f"{c} = ?" for c in columnas)
+            valores = [v for c, v in zip(COLUMNAS_CLIENTES, fila) if c in columnas]
+            cursor = self._conn.execute(
+                f"UPDATE clientes SET {asignaciones} WHERE cliente_id = ? AND version = ?",
+                valores + [fila[0], version_leida]
+            )
+            if cursor.rowcount == 0:
+                raise ConflictoVersion(fila[0])
+
+    def eliminar_cliente(self, cliente_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM clientes WHERE cliente_id = ?", (cliente_id,))
+
+    def agregar_pago(self, fila):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO pagos ({', '.join(COLUMNAS_PAGOS)}) VALUES ({', '.join('?' * len(COLUMNAS_PAGOS))})",
+                fila
+            )
+
+    def reservar_ids(self, cantidad):
+        with self._lock:
+            # BEGIN IMMEDIATE toma el candado de escritura: otro proceso no puede leer el mismo valor
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._conn.execute("SELECT valor FROM secuencias WHERE nombre = 'clientes'").fetchone()
+                if fila is None:
+                    # También los IDs del libro: los de clientes eliminados no se reutilizan
+                    primero = siguiente_de(r[0] for r in self._conn.execute(
+                        "SELECT cliente_id FROM clientes UNION SELECT cliente_id FROM pagos"
+                    ))
+                else:
+                    primero = fila[0]
+                self._conn.execute(
+                    "INSERT INTO secuencias (nombre, valor) VALUES ('clientes', ?) "
+                    "ON CONFLICT(nombre) DO UPDATE SET valor = excluded.valor",
+                    (primero + cantidad,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return primero
+
+    def guardar_instantanea(self, saldos, marca):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE clientes SET total_pagado = ?, saldo_pendiente = ? WHERE cliente_id = ?",
+                    [(pagado, saldo, cliente_id) for cliente_id, (pagado, saldo) in saldos.items()]
+                )
+                self._conn.execute(
+                    "INSERT INTO secuencias (nombre, valor) VALUES ('instantanea_pagos', ?) "
+                    "ON CONFLICT(nombre) DO UPDATE SET valor = excluded.valor",
+                    (marca[0],)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def tomar_turno_conciliacion(self, titular, duracion):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._conn.execute("SELECT titular, vence FROM turnos WHERE nombre = 'conciliacion'").fetchone()
+                ahora = time.time()
+                if fila is not None and fila['titular'] not in ('', titular) and fila['vence'] > ahora:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._conn.execute(
+                    "INSERT INTO turnos (nombre, titular, vence) VALUES ('conciliacion', ?, ?) "
+                    "ON CONFLICT(nombre) DO UPDATE SET titular = excluded.titular, vence = excluded.vence",
+                    (titular, ahora + duracion)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def soltar_turno_conciliacion(self, titular):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE turnos SET titular = '', vence = 0 WHERE nombre = 'conciliacion' AND titular = ?", (titular,)
+            )
+
+    def leer_cambios(self, marcas_clientes, marca_libro):
+        with self._lock:
+            clientes = self._conn.execute(
+                f"SELECT {', '.join(COLUMNAS_CLIENTES)} FROM clientes ORDER BY rowid"
+            ).fetchall()
+            eventos, marca = self._eventos_desde(marca_libro)
+            instantanea = self._marca_instantanea()
+        vigentes = {r['cliente_id'] for r in clientes}
+        return {
+            'clientes': [
+                dict(r) for r in clientes
+                if marcas_clientes.get(r['cliente_id']) != (r['updated_at'] or '')
+            ],
+            'clientes_eliminados': [cid for cid in marcas_clientes if cid not in vigentes],
+            'pagos': eventos,
+            'marca': marca,
+            'instantanea': instantanea,
+        }
+
+# ============================================
+# RESERVA DE IDS
+# ============================================
+class ReservaIds:
+    """Bloque de IDs de cliente ya reservados en el almacenamiento, repartido entre las sesiones.
+
+    Solo se consulta el almacenamiento cuando se agota el bloque; los números que queden sin
+    usar al reiniciar el proceso se pierden, así que los IDs son crecientes pero pueden tener huecos.
+    """
+
+    def __init__(self, almacenamiento, tam_bloque=20):
+        self._almacenamiento = almacenamiento
+        self.tam_bloque = tam_bloque
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._limite = 0
+
+    def siguiente(self):
+        with self._lock:
+            if self._siguiente >= self._limite:
+                self._siguiente = self._almacenamiento.reservar_ids(self.tam_bloque)
+                self._limite = self._siguiente + self.tam_bloque
+            numero = self._siguiente
+            self._siguiente += 1
+        return f"CLI{numero:03d}"
@@ -0,0 +1,553 @@
+"""Kardex de clientes en PDF y Excel.
+
+Está fuera de viaje_san_juan_v3.py porque la generación masiva reparte el trabajo entre
+procesos: cada proceso necesita importar las funciones que ejecuta, y el script de
+Streamlit se vuelve a ejecutar como __main__ en cada interacción.
+"""
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.forkserver
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+from io import BytesIO
+from types import SimpleNamespace
+
+import pandas as pd
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib.enums import TA_CENTER
+
+# ============================================
+# ESTILOS DEL KARDEX PDF
+# ============================================
+# Se arman una sola vez por proceso, al importar el módulo, y se comparten entre documentos
+ESTILOS = getSampleStyleSheet()
+
+ESTILO_TITULO = ParagraphStyle(
+    'CustomTitle',
+    parent=ESTILOS['Heading1'],
+    fontSize=18,
+    textColor=colors.HexColor('#1f4788'),
+    spaceAfter=20,
+    alignment=TA_CENTER,
+    fontName='Helvetica-Bold'
+)
+
+ESTILO_SUBTITULO = ParagraphStyle(
+    'CustomSubtitle',
+    parent=ESTILOS['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#2c5aa0'),
+    spaceAfter=12,
+    fontName='Helvetica-Bold'
+)
+
+ESTILO_NORMAL = ESTILOS['Normal']
+
+ESTILO_PIE = ParagraphStyle(
+    'Footer',
+    parent=ESTILOS['Normal'],
+    fontSize=8,
+    textColor=colors.grey,
+    alignment=TA_CENTER
+)
+
+def estilo_tabla(tamano_encabezado, *comandos):
+    """TableStyle con el encabezado azul y la cuadrícula comunes a todas las tablas del kardex."""
+    return TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), tamano_encabezado),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+        *comandos
+    ])
+
+# Cuerpo de las tablas de datos: fondo beige con renglones alternados
+CUERPO_ALTERNADO = (
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey]),
+)
+
+ESTILO_TABLA_INFO = estilo_tabla(
+    11,
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
+    *CUERPO_ALTERNADO
+)
+
+ESTILO_TABLA_RESERVAS = estilo_tabla(
+    10,
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('ALIGN', (0, 1), (0, -1), 'LEFT'),
+    *CUERPO_ALTERNADO
+)
+
+ESTILO_TABLA_CUENTA = estilo_tabla(
+    10,
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('ALIGN', (0, 1), (0, -1), 'LEFT'),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 1), (-1, -1), 11),
+    ('BACKGROUND', (0, 1), (0, 1), colors.lightblue),
+    ('BACKGROUND', (0, 2), (0, 2), colors.lightgreen),
+    ('BACKGROUND', (0, 3), (0, 3), colors.lightyellow)
+)
+
+ESTILO_TABLA_PAGOS = estilo_tabla(
+    9,
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTSIZE', (0, 1), (-1, -1), 8),
+    *CUERPO_ALTERNADO
+)
+
+TITULO_VIAJE = "Viaje San Juan de los Lagos dia Miercoles 01 abril 2026"
+
+# Función para generar PDF de kardex
+def generar_kardex_pdf(cliente_id, cliente, pagos, tarifas):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
+    
+    story = []
+    
+    story.append(Paragraph("🚌 KARDEX DE CLIENTE", ESTILO_TITULO))
+    story.append(Spacer(1, 0.2*inch))
+    
+    story.append(Paragraph(TITULO_VIAJE, ESTILO_SUBTITULO))
+    story.append(Spacer(1, 0.1*inch))
+    
+    fecha_generacion = Paragraph(f"<i>Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</i>", ESTILO_NORMAL)
+    story.append(fecha_generacion)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # SECCIÓN 1: INFORMACIÓN GENERAL
+    story.append(Paragraph("📋 INFORMACIÓN GENERAL", ESTILO_SUBTITULO))
+    story.append(Spacer(1, 0.1*inch))
+    
+    info_data = [
+        ['Campo', 'Información'],
+        ['ID Cliente:', cliente_id],
+        ['Nombre:', cliente.nombre],
+        ['Teléfono:', cliente.telefono],
+        ['Email:', cliente.email],
+        ['Fecha de Registro:', cliente.fecha_registro]
+    ]
+    story.append(Table(info_data, colWidths=[2*inch, 4*inch], style=ESTILO_TABLA_INFO))
+    story.append(Spacer(1, 0.3*inch))
+    
+    # SECCIÓN 2: RESERVAS Y COSTOS
+    story.append(Paragraph("🎫 RESERVAS Y COSTOS", ESTILO_SUBTITULO))
+    story.append(Spacer(1, 0.1*inch))
+    
+    reservas_data = [['Concepto', 'Cantidad', 'Precio Unitario', 'Subtotal']]
+    for concepto, cantidad, tarifa in (
+        ('Asientos de Transporte', cliente.asientos, tarifas['transporte']),
+        ('Habitaciones Sencillas', cliente.hab_sencillas, tarifas['habitacion_sencilla']),
+        ('Habitaciones Dobles', cliente.hab_dobles, tarifas['habitacion_doble']),
+        ('Habitaciones Triples', cliente.hab_triples, tarifas['habitacion_triple']),
+    ):
+        reservas_data.append([concepto, str(cantidad), f"${tarifa:,.2f}", f"${cantidad * tarifa:,.2f}"])
+    story.append(Table(reservas_data, colWidths=[2.5*inch, 1*inch, 1.5*inch, 1.5*inch], style=ESTILO_TABLA_RESERVAS))
+    story.append(Spacer(1, 0.3*inch))
+    
+    # SECCIÓN 3: ESTADO DE CUENTA
+    story.append(Paragraph("💰 ESTADO DE CUENTA", ESTILO_SUBTITULO))
+    story.append(Spacer(1, 0.1*inch))
+    
+    porcentaje_pagado = (cliente.total_pagado/cliente.total_a_pagar*100) if cliente.total_a_pagar > 0 else 0
+    porcentaje_pendiente = (cliente.saldo_pendiente/cliente.total_a_pagar*100) if cliente.total_a_pagar > 0 else 0
+    cuenta_data = [
+        ['Concepto', 'Monto', 'Porcentaje'],
+        ['Total a Pagar', f"${cliente.total_a_pagar:,.2f}", '100%'],
+        ['Total Pagado', f"${cliente.total_pagado:,.2f}", f"{porcentaje_pagado:.1f}%"],
+        ['Saldo Pendiente', f"${cliente.saldo_pendiente:,.2f}", f"{porcentaje_pendiente:.1f}%"]
+    ]
+    story.append(Table(cuenta_data, colWidths=[2.5*inch, 2*inch, 1.5*inch], style=ESTILO_TABLA_CUENTA))
+    story.append(Spacer(1, 0.3*inch))
+    
+    # SECCIÓN 4: HISTORIAL DE PAGOS
+    if pagos:
+        story.append(Paragraph("📜 HISTORIAL DE PAGOS", ESTILO_SUBTITULO))
+        story.append(Spacer(1, 0.1*inch))
+        
+        pagos_data = [['No.', 'Fecha', 'Monto', 'Método', 'Referencia', 'Saldo Restante']]
+        saldo_acumulado = cliente.total_a_pagar
+        for i, pago in enumerate(pagos, 1):
+            saldo_acumulado -= pago.monto
+            pagos_data.append([
+                str(i),
+                pago.fecha,
+                f"${pago.monto:,.2f}",
+                pago.metodo,
+                pago.referencia or '-',
+                f"${saldo_acumulado:,.2f}"
+            ])
+        story.append(Table(pagos_data, colWidths=[0.4*inch, 1*inch, 1.2*inch, 1.2*inch, 1.2*inch, 1.2*inch],
+                           style=ESTILO_TABLA_PAGOS))
+        story.append(Spacer(1, 0.2*inch))
+    
+    # Notas del cliente
+    if cliente.notas:
+        story.append(Spacer(1, 0.2*inch))
+        story.append(Paragraph("📝 NOTAS DEL CLIENTE", ESTILO_SUBTITULO))
+        story.append(Spacer(1, 0.1*inch))
+        story.append(Paragraph(cliente.notas, ESTILO_NORMAL))
+    
+    # Footer
+    story.append(Spacer(1, 0.5*inch))
+    story.append(Paragraph("_______________________________________________", ESTILO_PIE))
+    story.append(Paragraph(f"Sistema de Gestión de Viajes - {TITULO_VIAJE} ", ESTILO_PIE))
+    
+    doc.build(story)
+    buffer.seek(0)
+    return buffer
+
+# Función para generar Kardex de cliente en Excel
+def generar_kardex_cliente(cliente_id, cliente, pagos, tarifas):
+    output = BytesIO()
+    
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # Hoja 1: Información General
+        info_general = {
+            'Campo': ['ID Cliente', 'Nombre', 'Teléfono', 'Email', 'Fecha de Registro'],
+            'Valor': [
+                cliente_id,
+                cliente.nombre,
+                cliente.telefono,
+                cliente.email,
+                cliente.fecha_registro
+            ]
+        }
+        pd.DataFrame(info_general).to_excel(writer, sheet_name='Información General', index=False)
+        
+        # Hoja 2: Resumen de Reservas
+        reservas = {
+            'Concepto': ['Asientos de Transporte', 'Habitaciones Sencillas', 'Habitaciones Dobles', 'Habitaciones Triples'],
+            'Cantidad': [
+                cliente.asientos,
+                cliente.hab_sencillas,
+                cliente.hab_dobles,
+                cliente.hab_triples
+            ],
+            'Precio Unitario': [
+                f"${tarifas['transporte']:,.2f}",
+                f"${tarifas['habitacion_sencilla']:,.2f}",
+                f"${tarifas['habitacion_doble']:,.2f}",
+                f"${tarifas['habitacion_triple']:,.2f}"
+            ],
+            'Subtotal': [
+                f"${cliente.asientos * tarifas['transporte']:,.2f}",
+                f"${cliente.hab_sencillas * tarifas['habitacion_sencilla']:,.2f}",
+                f"${cliente.hab_dobles * tarifas['habitacion_doble']:,.2f}",
+                f"${cliente.hab_triples * tarifas['habitacion_triple']:,.2f}"
+            ]
+        }
+        pd.DataFrame(reservas).to_excel(writer, sheet_name='Reservas y Costos', index=False)
+        
+        # Hoja 3: Estado de Cuenta
+        estado_cuenta = {
+            'Concepto': ['Total a Pagar', 'Total Pagado', 'Saldo Pendiente'],
+            'Monto': [
+                f"${cliente.total_a_pagar:,.2f}",
+                f"${cliente.total_pagado:,.2f}",
+                f"${cliente.saldo_pendiente:,.2f}"
+            ],
+            'Porcentaje': [
+                '100%',
+                f"{(cliente.total_pagado/cliente.total_a_pagar*100):.1f}%" if cliente.total_a_pagar > 0 else '0%',
+                f"{(cliente.saldo_pendiente/cliente.total_a_pagar*100):.1f}%" if cliente.total_a_pagar > 0 else '0%'
+            ]
+        }
+        pd.DataFrame(estado_cuenta).to_excel(writer, sheet_name='Estado de Cuenta', index=False)
+        
+        # Hoja 4: Historial de Pagos
+        if pagos:
+            pagos_detalle = []
+            saldo_acumulado = cliente.total_a_pagar
+            
+            for i, pago in enumerate(pagos, 1):
+                saldo_acumulado -= pago.monto
+                pagos_detalle.append({
+                    'No.': i,
+                    'Fecha': pago.fecha,
+                    'Monto Pagado': f"${pago.monto:,.2f}",
+                    'Método': pago.metodo,
+                    'Referencia': pago.referencia,
+                    'Saldo Restante': f"${saldo_acumulado:,.2f}",
+                    'Notas': pago.notas
+                })
+            
+            pd.DataFrame(pagos_detalle).to_excel(writer, sheet_name='Historial de Pagos', index=False)
+        
+        # Hoja 5: Notas del Cliente
+        if cliente.notas:
+            notas_df = pd.DataFrame({
+                'Notas del Cliente': [cliente.notas]
+            })
+            notas_df.to_excel(writer, sheet_name='Notas', index=False)
+    
+    output.seek(0)
+    return output
+
+# ============================================
+# GENERACIÓN MASIVA
+# ============================================
+# Formato -> (función que lo genera, extensión del archivo)
+FORMATOS = {
+    'pdf': (generar_kardex_pdf, 'pdf'),
+    'excel': (generar_kardex_cliente, 'xlsx'),
+}
+
+def nombre_kardex(cliente_id, nombre, extension, fecha=None):
+    """Nombre del archivo de un kardex, el mismo que usan las descargas individuales."""
+    fecha = fecha or datetime.now().strftime('%d-%m-%Y')
+    return f"kardex_{cliente_id}_{nombre.replace(' ', '_')}_{fecha}.{extension}"
+
+def kardex_bytes(formato, cliente_id, cliente, pagos, tarifas):
+    """Bytes del kardex de un cliente en formato ('pdf' o 'excel').
+
+    Puede correr en otro proceso: cliente y pagos llegan como diccionarios de campos (los
+    dataclasses del script no se pueden importar desde aquí) y se leen como atributos.
+    """
+    funcion, _ = FORMATOS[formato]
+    return funcion(
+        cliente_id, SimpleNamespace(**cliente), [SimpleNamespace(**p) for p in pagos], tarifas
+    ).getvalue()
+
+def renderizar_kardex(cliente_id, cliente, pagos, tarifas, formatos):
+    """Genera los formatos pedidos de un cliente; devuelve [(nombre de archivo, bytes)]."""
+    return [
+        (nombre_kardex(cliente_id, cliente['nombre'], FORMATOS[formato][1]),
+         kardex_bytes(formato, cliente_id, cliente, pagos, tarifas))
+        for formato in formatos
+    ]
+
+def _contexto_procesos():
+    """Contexto forkserver para los pools de procesos, o None donde no existe (Windows).
+
+    Con fork cada trabajador sería una copia del proceso de Streamlit, que ya tiene hilos
+    corriendo: un lock que otro hilo tuviera tomado al hacer fork quedaría tomado para siempre
+    en el hijo. El servidor de forkserver arranca como un proceso nuevo, sin hilos, importa solo
+    este módulo y de él salen los trabajadores.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return None
+    contexto = multiprocessing.get_context('forkserver')
+    contexto.set_forkserver_preload(['kardex'])
+    return contexto
+
+# Se configura una sola vez al importar; el servidor arranca con el primer pool del proceso.
+# El script de Streamlit declara su __spec__ para que los trabajadores no lo vuelvan a ejecutar
+_CONTEXTO = _contexto_procesos()
+
+def _pool(procesos):
+    """Pool de procesos de forkserver; donde no hay forkserver (Windows) se usan hilos."""
+    if _CONTEXTO is not None:
+        return ProcessPoolExecutor(max_workers=procesos, mp_context=_CONTEXTO)
+    return ThreadPoolExecutor(max_workers=procesos)
+
+def generar_en_paralelo(funcion, trabajos, procesos=None):
+    """Ejecuta funcion(*trabajo) para cada trabajo en un pool y entrega los resultados conforme terminan.
+
+    Nunca hay más de dos trabajos en vuelo por proceso: lo ya entregado no se queda
+    guardado en los futures, así que la memoria no crece con el número de trabajos.
+    """
+    procesos = procesos or os.cpu_count() or 1
+    with _pool(procesos) as pool:
+        pendientes = set()
+        for trabajo in trabajos:
+            pendientes.add(pool.submit(funcion, *trabajo))
+            if len(pendientes) >= 2 * procesos:
+                listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    yield futuro.result()
+        while pendientes:
+            listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                yield futuro.result()
+
+def crear_pool_render(procesos=None):
+    """Pool de procesos para dejar abierto y pasarlo a ejecutar_a_la_vez(), o None si no serviría.
+
+    El primer arranque cuesta mucho más que generar un kardex (el servidor de forkserver importa
+    reportlab y openpyxl), así que para exportaciones de pocos archivos se crea una vez y se
+    reutiliza; el servidor arranca aquí mismo y no con la primera exportación. Cada exportación
+    manda a lo más un trabajo por formato, así que nunca tiene más procesos que formatos. Con un
+    solo núcleo o sin forkserver devuelve None: reportlab y openpyxl son Python puro y con hilos
+    solo se turnarían el GIL.
+    """
+    procesos = min(procesos or os.cpu_count() or 1, len(FORMATOS))
+    if procesos <= 1 or _CONTEXTO is None:
+        return None
+    multiprocessing.forkserver.ensure_running()
+    return ProcessPoolExecutor(max_workers=procesos, mp_context=_CONTEXTO)
+
+def ejecutar_a_la_vez(trabajos, pool=None):
+    """Ejecuta trabajos de render [(funcion, args)] al mismo tiempo; devuelve sus resultados en el mismo orden.
+
+    Para exportaciones de pocos archivos que se esperan juntos (la masiva usa generar_en_paralelo).
+    funcion debe estar definida en un módulo importable y args ser datos simples, porque viajan
+    a otro proceso. Sin pool, o con un solo trabajo, se ejecutan aquí mismo uno tras otro.
+    """
+    trabajos = list(trabajos)
+    if pool is None or len(trabajos) <= 1:
+        return [funcion(*args) for funcion, args in trabajos]
+    futuros = [pool.submit(funcion, *args) for funcion, args in trabajos]
+    return [futuro.result() for futuro in futuros]
+
+def kardex_zip(destino, trabajos, total, progreso=None, procesos=None):
+    """Escribe en destino (archivo abierto en modo binario) un ZIP con los kardex de todos los trabajos.
+
+    trabajos son tuplas con los argumentos de renderizar_kardex; cada archivo se agrega al
+    ZIP en cuanto su proceso termina y se suelta. progreso(hechos, total) se llama tras cada cliente.
+    """
+    # PDF y XLSX ya vienen comprimidos: comprimirlos otra vez solo gasta CPU
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as archivo_zip:
+        for hechos, archivos in enumerate(generar_en_paralelo(renderizar_kardex, trabajos, procesos), 1):
+            for nombre, contenido in archivos:
+                archivo_zip.writestr(nombre, contenido)
+            if progreso is not None:
+                progreso(hechos, total)
+
+# ============================================
+# CACHÉ DE KARDEX
+# ============================================
+# Súbela al cambiar el contenido de los kardex: así las entradas ya guardadas en disco dejan de coincidir
+VERSION_KARDEX = 1
+
+def clave_kardex(formato, cliente_id, cliente, pagos, tarifas):
+    """Hash del contenido de un kardex; cliente y pagos son diccionarios de campos (asdict).
+
+    Cualquier edición del cliente cambia updated_at y version, y cualquier pago o reverso cambia
+    la lista de pagos y el total pagado, así que la clave cambia sola y no hay que invalidar nada.
+    """
+    contenido = json.dumps([VERSION_KARDEX, formato, cliente_id, cliente, pagos, tarifas],
+                           sort_keys=True, default=str)
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+class CacheKardex:
+    """Kardex ya generados (bytes) por clave de contenido, en un LRU acotado por tamaño total.
+
+    Con directorio, cada kardex se guarda también en disco y sobrevive a los reinicios del
+    proceso; el disco tiene su propio límite y se poda del archivo usado hace más tiempo.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directorio=None, max_bytes_disco=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_bytes_disco = max_bytes_disco
+        self._directorio = directorio
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._bytes = 0
+        # clave -> tamaño del archivo, del usado hace más tiempo al más reciente
+        self._disco = OrderedDict()
+        self._bytes_disco = 0
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            archivos = []
+            for entrada in os.scandir(directorio):
+                if entrada.name.endswith('.kardex'):
+                    info = entrada.stat()
+                    archivos.append((info.st_mtime, entrada.name[:-len('.kardex')], info.st_size))
+            for _, clave, tamano in sorted(archivos):
+                self._disco[clave] = tamano
+                self._bytes_disco += tamano
+
+    def _ruta(self, clave):
+        return os.path.join(self._directorio, f"{clave}.kardex")
+
+    def _guardar_en_memoria(self, clave, contenido):
+        """Con el lock tomado. Un kardex más grande que todo el caché no se guarda."""
+        if clave in self._memoria:
+            self._bytes -= len(self._memoria.pop(clave))
+        if len(contenido) > self.max_bytes:
+            return
+        self._memoria[clave] = contenido
+        self._bytes += len(contenido)
+        while self._bytes > self.max_bytes:
+            _, viejo = self._memoria.popitem(last=False)
+            self._bytes -= len(viejo)
+
+    def obtener(self, clave):
+        """Bytes guardados con esta clave, o None."""
+        with self._lock:
+            contenido = self._memoria.get(clave)
+            if contenido is not None:
+                self._memoria.move_to_end(clave)
+                return contenido
+            if clave not in self._disco:
+                return None
+        try:
+            with open(self._ruta(clave), 'rb') as archivo:
+                contenido = archivo.read()
+            # La fecha de modificación ordena el LRU del disco cuando el proceso se reinicia
+            os.utime(self._ruta(clave))
+        except OSError:
+            # Otro proceso lo podó: se trata como si no estuviera
+            with self._lock:
+                if clave in self._disco:
+                    self._bytes_disco -= self._disco.pop(clave)
+            return None
+        with self._lock:
+            self._guardar_en_memoria(clave, contenido)
+            if clave in self._disco:
+                self._disco.move_to_end(clave)
+        return contenido
+
+    def guardar(self, clave, contenido):
+        """Guarda los bytes en memoria y, si hay directorio, en disco."""
+        with self._lock:
+            self._guardar_en_memoria(clave, contenido)
+        if not self._directorio:
+            return
+        ruta = self._ruta(clave)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # Se escribe aparte y se renombra: nadie lee nunca un archivo a medias
+            with open(temporal, 'wb') as archivo:
+                archivo.write(contenido)
+            os.replace(temporal, ruta)
+        except OSError:
+            # El disco es opcional: si falla, el kardex sigue en memoria
+            with contextlib.suppress(OSError):
+                os.remove(temporal)
+            return
+        podados = []
+        with self._lock:
+            if clave in self._disco:
+                self._bytes_disco -= self._disco.pop(clave)
+            self._disco[clave] = len(contenido)
+            self._bytes_disco += len(contenido)
+            while self._bytes_disco > self.max_bytes_disco and len(self._disco) > 1:
+                viejo, tamano = self._disco.popitem(last=False)
+                self._bytes_disco -= tamano
+                podados.append(viejo)
+        for viejo in podados:
+            with contextlib.suppress(OSError):
+                os.remove(self._ruta(viejo))
+
+def kardex_cacheados(cache, formatos, cliente_id, cliente, pagos, tarifas, pool=None):
+    """{formato: bytes} del kardex de un cliente: del caché los que no cambiaron desde la última
+    vez; los demás se generan a la vez en pool con ejecutar_a_la_vez() y se guardan.
+    cliente y pagos son diccionarios (asdict).
+    """
+    claves = {formato: clave_kardex(formato, cliente_id, cliente, pagos, tarifas) for formato in formatos}
+    resultado = {formato: cache.obtener(clave) for formato, clave in claves.items()}
+    faltantes = [formato for formato, contenido in resultado.items() if contenido is None]
+    generados = ejecutar_a_la_vez(
+        ((kardex_bytes, (formato, cliente_id, cliente, pagos, tarifas)) for formato in faltantes), pool
+    )
+    for formato, contenido in zip(faltantes, generados):
+        cache.guardar(claves[formato], contenido)
+        resultado[formato] = contenido
+    return resultado
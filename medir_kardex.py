@@ -0,0 +1,63 @@
+"""Mediciones de la generación de kardex, fuera del código de la app.
+
+Uso: python medir_kardex.py
+"""
+import os
+import time
+import timeit
+from types import SimpleNamespace
+
+from kardex import crear_pool_render, ejecutar_a_la_vez, generar_kardex_pdf, kardex_bytes
+
+# Las mismas tarifas que viaje_san_juan_v3.py
+TARIFAS = {'transporte': 400, 'habitacion_sencilla': 900, 'habitacion_doble': 1100, 'habitacion_triple': 1300}
+
+def cliente_de_ejemplo(num_pagos=5):
+    """(cliente, pagos) de ejemplo con num_pagos pagos de $300."""
+    cliente = SimpleNamespace(
+        nombre='Cliente de Prueba', telefono='3312345678', email='prueba@ejemplo.com',
+        fecha_registro='01/01/2026 10:00:00', asientos=2, hab_sencillas=0, hab_dobles=1, hab_triples=0,
+        total_a_pagar=1900.0, total_pagado=300.0 * num_pagos, saldo_pendiente=1900.0 - 300.0 * num_pagos,
+        notas='Asiento junto a la ventana'
+    )
+    pagos = [
+        SimpleNamespace(fecha=f'{dia:02d}/02/2026', monto=300.0, metodo='Efectivo', referencia='', notas='')
+        for dia in range(1, num_pagos + 1)
+    ]
+    return cliente, pagos
+
+def medir_kardex_pdf(documentos=200, num_pagos=5, repeticiones=5):
+    """Milisegundos por documento de generar_kardex_pdf (el mejor de varias rondas) con un cliente de ejemplo."""
+    cliente, pagos = cliente_de_ejemplo(num_pagos)
+    generar_kardex_pdf('CLI001', cliente, pagos, TARIFAS)
+    mejor = min(
+        timeit.timeit(lambda: generar_kardex_pdf('CLI001', cliente, pagos, TARIFAS), number=documentos)
+        for _ in range(repeticiones)
+    )
+    return mejor / documentos * 1000
+
+def medir_render_a_la_vez(rondas=20, num_pagos=20):
+    """(arranque del pool, ms en serie, ms en pool) de generar PDF y Excel del mismo cliente.
+
+    Igual que el botón "PDF y Excel" de la app: dos trabajos en un pool de crear_pool_render(2).
+    El pool se fuerza aunque haya un solo núcleo; ahí no puede ganar nada.
+    """
+    cliente, pagos = cliente_de_ejemplo(num_pagos)
+    cliente, pagos = vars(cliente), [vars(pago) for pago in pagos]
+    trabajos = [(kardex_bytes, (formato, 'CLI001', cliente, pagos, TARIFAS)) for formato in ('pdf', 'excel')]
+    inicio = time.perf_counter()
+    pool = crear_pool_render(2)
+    ejecutar_a_la_vez(trabajos, pool)
+    arranque = (time.perf_counter() - inicio) * 1000
+    try:
+        en_serie = min(timeit.repeat(lambda: ejecutar_a_la_vez(trabajos), number=1, repeat=rondas))
+        en_pool = min(timeit.repeat(lambda: ejecutar_a_la_vez(trabajos, pool), number=1, repeat=rondas))
+    finally:
+        pool.shutdown()
+    return arranque, en_serie * 1000, en_pool * 1000
+
+if __name__ == "__main__":
+    print(f"generar_kardex_pdf: {medir_kardex_pdf():.2f} ms por documento")
+    arranque, en_serie, en_pool = medir_render_a_la_vez()
+    print(f"PDF y Excel con {os.cpu_count()} núcleo(s): {en_serie:.1f} ms en serie, {en_pool:.1f} ms en pool "
+          f"(arrancar el pool y el primer render: {arranque:.0f} ms)")
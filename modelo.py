@@ -0,0 +1,628 @@
+"""Modelo de datos del viaje y la instantánea compartida por las sesiones.
+
+Clientes, pagos y totales, el índice de búsqueda, la conversión desde las tablas del
+almacenamiento y la sincronización por tramos del libro. Está fuera de viaje_san_juan_v3.py
+para poder importarlo (y probarlo) sin ejecutar la app.
+"""
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+
+from almacenamiento import ConflictoVersion, LibroDesfasado, generar_pago_id, marca_actualizacion
+from saldos import (
+    COLUMNAS_CLIENTES, COLUMNAS_PAGOS, COLUMNAS_SALDO, TIPO_PAGO, TIPO_REVERSO,
+    marco_clientes, marco_pagos, pagado_por_cliente, revertidos_en, tabla_desde_registros
+)
+
+# ============================================
+# MODELO DE DATOS
+# ============================================
+@dataclass(slots=True)
+class Pago:
+    """Un evento del libro de pagos de un cliente; los campos siguen COLUMNAS_PAGOS (sin cliente_id).
+
+    Con tipo TIPO_REVERSO el evento anula el pago cuyo pago_id está en revierte.
+    """
+    fecha: str = ''
+    monto: float = 0.0
+    metodo: str = ''
+    referencia: str = ''
+    notas: str = ''
+    timestamp: str = ''
+    pago_id: str = ''
+    tipo: str = TIPO_PAGO
+    revierte: str = ''
+
+    def a_fila(self, cliente_id):
+        """Fila ordenada según COLUMNAS_PAGOS."""
+        return [cliente_id, self.fecha, self.monto, self.metodo, self.referencia, self.notas,
+                self.timestamp, self.pago_id, self.tipo, self.revierte]
+
+    def reverso(self, fecha, timestamp):
+        """Evento que anula este pago (mismo monto con signo contrario, para que el libro sume cero)."""
+        return Pago(
+            fecha, -self.monto, self.metodo, self.referencia, f"Reverso de {self.pago_id}",
+            timestamp, generar_pago_id(), TIPO_REVERSO, self.pago_id
+        )
+
+    def a_dict(self):
+        """Vista compatible con JSON (la misma forma que tenían los pagos como diccionario)."""
+        return {
+            'fecha': self.fecha, 'monto': self.monto, 'metodo': self.metodo, 'referencia': self.referencia,
+            'notas': self.notas, 'timestamp': self.timestamp, 'pago_id': self.pago_id,
+            'tipo': self.tipo, 'revierte': self.revierte
+        }
+
+@dataclass(slots=True)
+class Cliente:
+    """Un cliente con sus reservas y totales; los campos siguen COLUMNAS_CLIENTES (sin cliente_id).
+
+    total_pagado es la instantánea guardada más los eventos del libro posteriores a ella; el
+    historial de pagos no vive aquí, se lee aparte con historial_pagos() cuando se muestra.
+    """
+    nombre: str = ''
+    telefono: str = ''
+    email: str = ''
+    asientos: int = 0
+    hab_sencillas: int = 0
+    hab_dobles: int = 0
+    hab_triples: int = 0
+    total_a_pagar: float = 0.0
+    total_pagado: float = 0.0
+    saldo_pendiente: float = 0.0
+    notas: str = ''
+    fecha_registro: str = ''
+    updated_at: str = ''
+    version: int = 0
+
+    def a_fila(self, cliente_id):
+        """Fila ordenada según COLUMNAS_CLIENTES."""
+        return [cliente_id, self.nombre, self.telefono, self.email, self.asientos,
+                self.hab_sencillas, self.hab_dobles, self.hab_triples,
+                self.total_a_pagar, self.total_pagado, self.saldo_pendiente,
+                self.notas, self.fecha_registro, self.updated_at, self.version]
+
+    def a_dict(self):
+        """Vista compatible con JSON para el respaldo, con habitaciones anidadas como antes."""
+        return {
+            'nombre': self.nombre, 'telefono': self.telefono, 'email': self.email, 'asientos': self.asientos,
+            'habitaciones': {'sencillas': self.hab_sencillas, 'dobles': self.hab_dobles, 'triples': self.hab_triples},
+            'total_a_pagar': self.total_a_pagar, 'total_pagado': self.total_pagado,
+            'saldo_pendiente': self.saldo_pendiente, 'notas': self.notas,
+            'fecha_registro': self.fecha_registro, 'updated_at': self.updated_at, 'version': self.version
+        }
+
+    def recalcular_saldo(self):
+        """Deriva saldo_pendiente de total_a_pagar y total_pagado."""
+        self.saldo_pendiente = round(self.total_a_pagar - self.total_pagado, 2)
+
+    def aplicar_evento(self, evento):
+        """Suma al total pagado un evento del libro (un reverso trae monto negativo) y recalcula el saldo."""
+        self.total_pagado = round(self.total_pagado + evento.monto, 2)
+        self.recalcular_saldo()
+
+def pagos_vigentes(eventos):
+    """Pagos de un historial que ningún reverso anuló, en el orden en que se registraron."""
+    revertidos = {p.revierte for p in eventos if p.tipo == TIPO_REVERSO}
+    return [p for p in eventos if p.tipo != TIPO_REVERSO and p.pago_id not in revertidos]
+
+@dataclass(slots=True)
+class TotalesViaje:
+    """Totales del viaje, calculados una vez al cargar y ajustados cliente por cliente en cada cambio."""
+    clientes: int = 0
+    asientos: int = 0
+    hab_sencillas: int = 0
+    hab_dobles: int = 0
+    hab_triples: int = 0
+    presupuesto: float = 0.0
+    recaudado: float = 0.0
+    liquidados: int = 0
+
+    @property
+    def habitaciones(self):
+        return self.hab_sencillas + self.hab_dobles + self.hab_triples
+
+    @property
+    def pendiente(self):
+        return self.presupuesto - self.recaudado
+
+    @classmethod
+    def calcular(cls, clientes):
+        """Totales de un conjunto de clientes (una sola pasada)."""
+        totales = cls()
+        for cliente in clientes:
+            totales.sumar(cliente)
+        return totales
+
+    def sumar(self, cliente, signo=1):
+        """Suma (o con signo=-1 resta) la aportación de un cliente."""
+        self.clientes += signo
+        self.asientos += signo * cliente.asientos
+        self.hab_sencillas += signo * cliente.hab_sencillas
+        self.hab_dobles += signo * cliente.hab_dobles
+        self.hab_triples += signo * cliente.hab_triples
+        self.presupuesto += signo * cliente.total_a_pagar
+        self.recaudado += signo * cliente.total_pagado
+        if cliente.saldo_pendiente == 0:
+            self.liquidados += signo
+
+    def reemplazar(self, anterior, nuevo):
+        """Cambia la aportación de anterior por la de nuevo; cualquiera de los dos puede ser None."""
+        if anterior is not None:
+            self.sumar(anterior, -1)
+        if nuevo is not None:
+            self.sumar(nuevo)
+
+# ============================================
+# BÚSQUEDA
+# ============================================
+def normalizar_texto(texto):
+    """Texto sin acentos y en minúsculas para comparar búsquedas ("Pérez" -> "perez")."""
+    descompuesto = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(ch for ch in descompuesto if not unicodedata.combining(ch)).casefold()
+
+def trigramas(palabra):
+    """Trigramas de una palabra; una de menos de tres caracteres no tiene ninguno."""
+    return {palabra[i:i + 3] for i in range(len(palabra) - 2)}
+
+class IndiceBusqueda:
+    """Índice de trigramas sin acentos sobre ID, nombre, teléfono y email de los clientes.
+
+    Se construye al cargar y se actualiza cliente por cliente en cada publicación, así
+    que cada búsqueda solo revisa los clientes que comparten todos los trigramas de la consulta.
+    Las palabras de uno o dos caracteres no tienen trigramas y se buscan como subcadena.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._campos = {}      # cliente_id -> (id, nombre, teléfono, solo dígitos, email) normalizados
+        self._textos = {}      # cliente_id -> campos unidos con '\x00' al inicio de cada uno, para puntuar
+        self._trigramas = {}   # trigrama -> conjunto de cliente_id
+
+    @staticmethod
+    def _campos_de(cliente_id, cliente):
+        telefono = normalizar_texto(cliente.telefono)
+        digitos = ''.join(ch for ch in telefono if ch.isdigit())
+        return (normalizar_texto(cliente_id), normalizar_texto(cliente.nombre), telefono, digitos,
+                normalizar_texto(cliente.email))
+
+    def _agregar(self, cliente_id, cliente):
+        campos = self._campos_de(cliente_id, cliente)
+        self._campos[cliente_id] = campos
+        self._textos[cliente_id] = ''.join('\x00' + c for c in campos)
+        for palabra in ' '.join(campos).split():
+            for trigrama in trigramas(palabra):
+                self._trigramas.setdefault(trigrama, set()).add(cliente_id)
+
+    def _quitar(self, cliente_id):
+        campos = self._campos.pop(cliente_id, None)
+        if campos is None:
+            return
+        del self._textos[cliente_id]
+        for palabra in ' '.join(campos).split():
+            for trigrama in trigramas(palabra):
+                ids = self._trigramas.get(trigrama)
+                if ids is not None:
+                    ids.discard(cliente_id)
+                    if not ids:
+                        del self._trigramas[trigrama]
+
+    def reconstruir(self, clientes):
+        with self._lock:
+            self._campos = {}
+            self._textos = {}
+            self._trigramas = {}
+            for cliente_id, cliente in clientes.items():
+                self._agregar(cliente_id, cliente)
+
+    def actualizar(self, cliente_id, cliente):
+        """Reindexa un cliente; con cliente=None lo quita del índice."""
+        with self._lock:
+            self._quitar(cliente_id)
+            if cliente is not None:
+                self._agregar(cliente_id, cliente)
+
+    def buscar(self, consulta):
+        """IDs de los clientes que contienen todas las palabras de la consulta, los mejores primero.
+
+        Cada palabra coincide en cualquier posición ("12" encuentra a CLI012). Pesa más
+        coincidir con el ID completo o con el inicio de un campo.
+        """
+        palabras = normalizar_texto(consulta).split()
+        if not palabras:
+            return []
+        with self._lock:
+            candidatos = None
+            for palabra in (p for p in palabras if len(p) >= 3):
+                for clave in sorted(trigramas(palabra), key=lambda t: len(self._trigramas.get(t, ()))):
+                    ids = self._trigramas.get(clave, set())
+                    candidatos = set(ids) if candidatos is None else candidatos & ids
+                    if not candidatos:
+                        return []
+            for palabra in (p for p in palabras if len(p) < 3):
+                # Sin trigramas: se filtra lo que dejaron las palabras largas, o todos los clientes
+                revisar = self._textos if candidatos is None else candidatos
+                candidatos = {cliente_id for cliente_id in revisar if palabra in self._textos[cliente_id]}
+                if not candidatos:
+                    return []
+            exacto = ' '.join(palabras)
+            inicios_campo = ['\x00' + p for p in palabras]
+            inicios_palabra = [' ' + p for p in palabras]
+            puntuados = []
+            for cliente_id in candidatos:
+                texto = self._textos[cliente_id]
+                puntos = 0
+                for palabra, inicio_campo, inicio_palabra in zip(palabras, inicios_campo, inicios_palabra):
+                    if inicio_campo in texto:
+                        puntos += 3
+                    elif inicio_palabra in texto:
+                        puntos += 2
+                    elif palabra in texto:
+                        puntos += 1
+                    else:
+                        break
+                else:
+                    if self._campos[cliente_id][0] == exacto:
+                        puntos += 10
+                    puntuados.append((-puntos, self._campos[cliente_id][1], cliente_id))
+        puntuados.sort()
+        return [cliente_id for _, _, cliente_id in puntuados]
+
+# ============================================
+# CONVERSIÓN DESDE LAS TABLAS DEL ALMACENAMIENTO
+# ============================================
+def pagos_desde_marco(pagos):
+    """Lista de Pago en el orden del DataFrame (las columnas se convierten a listas una sola vez)."""
+    return [Pago(*valores) for valores in zip(*(pagos[c].tolist() for c in COLUMNAS_PAGOS[1:]))]
+
+def clientes_desde_tablas(tabla_clientes, tabla_pagos, sobre_instantanea=False, revertidos=frozenset()):
+    """{cliente_id: Cliente} con los saldos derivados de tabla_pagos.
+
+    Con sobre_instantanea los eventos son solo el tramo posterior a la instantánea y se suman
+    al total_pagado guardado en cada fila; sin él son el libro completo y el guardado se ignora.
+    revertidos son los pagos ya anulados en la instantánea: sus reversos del tramo no restan otra vez.
+    Del libro solo se tipan las columnas de COLUMNAS_SALDO, y total_pagado y saldo_pendiente
+    se calculan por columnas antes de crear los objetos.
+    """
+    clientes = marco_clientes(tabla_clientes)
+    pagos = marco_pagos(tabla_pagos, COLUMNAS_SALDO)
+    pagado = pagado_por_cliente(pagos, revertidos).reindex(clientes['cliente_id']).fillna(0.0).to_numpy()
+    if sobre_instantanea:
+        pagado = pagado + clientes['total_pagado'].to_numpy()
+    clientes['total_pagado'] = pagado.round(2)
+    clientes['saldo_pendiente'] = (clientes['total_a_pagar'] - clientes['total_pagado']).round(2)
+    
+    columnas = (clientes[c].tolist() for c in COLUMNAS_CLIENTES)
+    return {cid: Cliente(*valores) for cid, *valores in zip(*columnas)}
+
+def clientes_desde_registros(registros_clientes, registros_pagos, sobre_instantanea=False):
+    """Como clientes_desde_tablas, para registros sueltos (cambios de la sincronización, un cliente)."""
+    return clientes_desde_tablas(
+        tabla_desde_registros(registros_clientes, COLUMNAS_CLIENTES),
+        tabla_desde_registros(registros_pagos, COLUMNAS_SALDO), sobre_instantanea
+    )
+
+def historial_desde_registros(registros_pagos):
+    """Lista de Pago de un historial, con los mismos tipos que la carga por columnas."""
+    return pagos_desde_marco(marco_pagos(tabla_desde_registros(registros_pagos, COLUMNAS_PAGOS)))
+
+# ============================================
+# SINCRONIZACIÓN
+# ============================================
+def cargar_datos(almacenamiento, configuracion):
+    """Carga los clientes desde el almacenamiento y los convierte al formato interno.
+
+    Con instantánea de saldos solo se leen los clientes y los eventos posteriores a su marca:
+    el arranque en frío depende del número de clientes, no del tamaño del libro de pagos. Sin
+    instantánea (o si el libro ya no cuadra con su marca) se lee todo y se deriva del libro.
+    configuracion son las tarifas con que se registran los datos.
+    """
+    tabla_clientes, instantanea = almacenamiento.leer_clientes()
+    clientes = None
+    if instantanea is not None:
+        try:
+            registros_pagos, marca, revertidos = almacenamiento.leer_pagos_desde(instantanea)
+            tabla_pagos = tabla_desde_registros(registros_pagos, COLUMNAS_SALDO)
+            clientes = clientes_desde_tablas(tabla_clientes, tabla_pagos, sobre_instantanea=True, revertidos=revertidos)
+        except LibroDesfasado:
+            pass
+    if clientes is None:
+        tabla_clientes, tabla_pagos, marca = almacenamiento.leer_registros()
+        revertidos = set()
+        clientes = clientes_desde_tablas(tabla_clientes, tabla_pagos)
+    
+    # Pagos ya anulados en los saldos cargados: un reverso repetido que llegue después no resta otra vez
+    return {
+        'clientes': clientes, 'totales': TotalesViaje.calcular(clientes.values()),
+        'configuracion': configuracion, 'fecha_viaje': None,
+        'marca_libro': marca, 'instantanea': instantanea,
+        'revertidos': frozenset(revertidos | revertidos_en(tabla_pagos))
+    }
+
+def leer_cambios_datos(almacenamiento, datos):
+    """Pregunta al almacenamiento qué cambió respecto a datos (solo lectura, sin tocar datos)."""
+    marcas = {cid: c.updated_at for cid, c in datos['clientes'].items()}
+    return almacenamiento.leer_cambios(marcas, datos['marca_libro'])
+
+def aplicar_cambios(datos, cambios):
+    """Devuelve una copia de datos con los cambios aplicados; datos no se modifica."""
+    clientes = dict(datos['clientes'])
+    copiados = set()
+    tocados = set(cambios['clientes_eliminados'])
+    
+    for cid in cambios['clientes_eliminados']:
+        clientes.pop(cid, None)
+    for cid, nuevo in clientes_desde_registros(cambios['clientes'], [], sobre_instantanea=True).items():
+        anterior = clientes.get(cid)
+        if anterior is not None:
+            # La fila releída trae la instantánea guardada; el total publicado ya incluye el tramo posterior
+            nuevo.total_pagado = anterior.total_pagado
+            nuevo.recalcular_saldo()
+        clientes[cid] = nuevo
+        copiados.add(cid)
+        tocados.add(cid)
+    
+    # Los eventos nuevos del libro se suman por cliente; los de clientes eliminados se ignoran,
+    # y un reverso de un pago que ya se anuló no resta otra vez
+    tabla_pagos = tabla_desde_registros(cambios['pagos'], COLUMNAS_SALDO)
+    pagos = marco_pagos(tabla_pagos, COLUMNAS_SALDO)
+    for cid, pagado in pagado_por_cliente(pagos, datos['revertidos']).items():
+        if cid not in clientes:
+            continue
+        if cid not in copiados:
+            clientes[cid] = replace(clientes[cid])
+            copiados.add(cid)
+        tocados.add(cid)
+        clientes[cid].total_pagado = round(clientes[cid].total_pagado + pagado, 2)
+        clientes[cid].recalcular_saldo()
+    
+    # Solo los clientes tocados ajustan los totales
+    totales = replace(datos['totales'])
+    for cid in tocados:
+        totales.reemplazar(datos['clientes'].get(cid), clientes.get(cid))
+    return {
+        **datos, 'clientes': clientes, 'totales': totales, 'marca_libro': cambios['marca'],
+        'revertidos': datos['revertidos'] | revertidos_en(tabla_pagos)
+    }
+
+# ============================================
+# ESCRITURA DE CLIENTES
+# ============================================
+class ClienteEliminado(ConflictoVersion):
+    """Otra sesión eliminó al cliente mientras esta lo editaba."""
+
+def guardar_cliente(almacenamiento, cliente_id, cliente, version_leida=None):
+    """Guarda o actualiza un cliente; lanza ConflictoVersion si otra sesión lo cambió desde version_leida.
+
+    Devuelve el comprobante para almacenamiento.confirmar().
+    """
+    cliente.updated_at = marca_actualizacion()
+    cliente.version = (version_leida or 0) + 1
+    return almacenamiento.guardar_cliente(cliente.a_fila(cliente_id), version_leida)
+
+def reintentar_escritura(cliente_id, cliente, modificar, escribir, releer, intentos=3):
+    """Escribe una copia de cliente modificada con modificar(copia) mediante escribir(cliente_id, copia, version_leida).
+
+    Si otra sesión cambió el cliente entre la lectura y la escritura, lo relee con releer(cliente_id),
+    vuelve a aplicar modificar sobre lo releído y reintenta. Devuelve (cliente escrito, comprobante
+    de escribir). Lanza ClienteEliminado si releer devuelve None, o ConflictoVersion si se agotaron
+    los intentos.
+    """
+    for _ in range(intentos):
+        editado = replace(cliente)
+        modificar(editado)
+        try:
+            return editado, escribir(cliente_id, editado, cliente.version)
+        except ConflictoVersion:
+            cliente = releer(cliente_id)
+            if cliente is None:
+                raise ClienteEliminado(cliente_id)
+    raise ConflictoVersion(cliente_id)
+
+# ============================================
+# INSTANTÁNEA COMPARTIDA
+# ============================================
+class CacheHistoriales:
+    """Historiales de pagos por cliente, leídos la primera vez que se muestran y guardados en un LRU acotado.
+
+    Los eventos que registra el proceso se agregan a los historiales guardados; los que llegan
+    de otras sesiones descartan el historial del cliente para que se vuelva a leer.
+    """
+
+    def __init__(self, cargador, maximo=200):
+        self._cargador = cargador
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._historiales = OrderedDict()
+        # Sube con cada cambio: una lectura que se cruzó con uno se devuelve pero no se guarda
+        self._cambios = 0
+
+    def obtener(self, cliente_id):
+        """Lista de eventos del cliente (una copia), del LRU o leída del almacenamiento."""
+        with self._lock:
+            eventos = self._historiales.get(cliente_id)
+            if eventos is not None:
+                self._historiales.move_to_end(cliente_id)
+                return list(eventos)
+        return self.releer(cliente_id)
+
+    def releer(self, cliente_id):
+        """Lee el historial del almacenamiento aunque esté guardado, y lo guarda."""
+        with self._lock:
+            cambios = self._cambios
+        eventos = self._cargador(cliente_id)
+        with self._lock:
+            if self._cambios == cambios:
+                self._historiales[cliente_id] = eventos
+                self._historiales.move_to_end(cliente_id)
+                while len(self._historiales) > self.maximo:
+                    self._historiales.popitem(last=False)
+        return list(eventos)
+
+    def agregar(self, cliente_id, evento):
+        """Agrega un evento al historial guardado del cliente, si lo hay y aún no lo tiene."""
+        with self._lock:
+            self._cambios += 1
+            eventos = self._historiales.get(cliente_id)
+            if eventos is not None and all(e.pago_id != evento.pago_id for e in eventos):
+                eventos.append(evento)
+
+    def descartar(self, cliente_id=None):
+        """Olvida el historial de un cliente, o todos con None."""
+        with self._lock:
+            self._cambios += 1
+            if cliente_id is None:
+                self._historiales.clear()
+            else:
+                self._historiales.pop(cliente_id, None)
+
+class InstantaneaDatos:
+    """Datos del viaje compartidos por todas las sesiones del proceso.
+
+    Cada cambio publica un diccionario nuevo (copia al escribir) y sube la
+    versión; quien ya tenía la instantánea anterior la sigue viendo completa
+    y consistente. Las sesiones solo guardan el número de versión que vieron.
+    El índice de búsqueda es uno solo y sigue siempre a la versión más reciente.
+    Los historiales de pagos no son parte de los datos: se leen al mostrarse (historiales).
+    """
+    
+    def __init__(self, cargador, cargador_historial):
+        self._cargador = cargador
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._version = 0
+        self._datos = None
+        self.indice = IndiceBusqueda()
+        self.historiales = CacheHistoriales(cargador_historial)
+        # pago_id de los eventos que registrar_evento ya sumó y que la sincronización aún no vio
+        self._aplicados = set()
+    
+    def obtener(self):
+        """Devuelve (versión, datos); la primera llamada del proceso carga los datos una sola vez."""
+        with self._lock:
+            if self._datos is not None:
+                return self._version, self._datos
+        with self._lock_carga:
+            with self._lock:
+                if self._datos is not None:
+                    return self._version, self._datos
+            cargados = self._cargador()
+            with self._lock:
+                if self._datos is None:
+                    self._datos = cargados
+                    self._version += 1
+                    self.indice.reconstruir(cargados['clientes'])
+                return self._version, self._datos
+    
+    def _publicar(self, cliente_id, cliente):
+        """Publica una copia de los datos con cliente en cliente_id (None lo quita); requiere el candado."""
+        clientes = dict(self._datos['clientes'])
+        totales = replace(self._datos['totales'])
+        totales.reemplazar(clientes.get(cliente_id), cliente)
+        if cliente is None:
+            clientes.pop(cliente_id, None)
+        else:
+            clientes[cliente_id] = cliente
+        self._datos = {**self._datos, 'clientes': clientes, 'totales': totales}
+        self._version += 1
+        self.indice.actualizar(cliente_id, cliente)
+        return self._version
+    
+    def _modificar(self, cliente_id, cliente):
+        """Publica cliente en cliente_id (None lo quita) con los totales ajustados."""
+        self.obtener()
+        with self._lock:
+            return self._publicar(cliente_id, cliente)
+    
+    def guardar_cliente(self, cliente_id, cliente):
+        """Publica un cliente nuevo o modificado; cliente no debe ser el objeto ya publicado.
+
+        Conserva el total pagado publicado: un pago registrado mientras la sesión editaba no se pierde.
+        """
+        self.obtener()
+        with self._lock:
+            actual = self._datos['clientes'].get(cliente_id)
+            if actual is not None:
+                cliente.total_pagado = actual.total_pagado
+                cliente.recalcular_saldo()
+            return self._publicar(cliente_id, cliente)
+    
+    def eliminar_cliente(self, cliente_id):
+        """Publica los datos sin el cliente indicado."""
+        self.historiales.descartar(cliente_id)
+        return self._modificar(cliente_id, None)
+    
+    def registrar_evento(self, cliente_id, evento):
+        """Aplica un evento del libro de pagos al cliente vigente y devuelve (versión, cliente).
+
+        El evento se suma a lo que esté publicado en ese momento, no a lo que leyó la sesión:
+        dos sesiones que registran pagos a la vez no se pisan. cliente es None si ya no existe.
+        """
+        self.obtener()
+        with self._lock:
+            actual = self._datos['clientes'].get(cliente_id)
+            if actual is None:
+                return self._version, None
+            cliente = replace(actual)
+            if evento.tipo != TIPO_REVERSO:
+                cliente.aplicar_evento(evento)
+            elif evento.revierte not in self._datos['revertidos']:
+                # Si otra sesión ya anuló el pago, este reverso queda en el libro pero no resta otra vez
+                cliente.aplicar_evento(evento)
+                self._datos = {**self._datos, 'revertidos': self._datos['revertidos'] | {evento.revierte}}
+            # La sincronización lo volverá a leer en el tramo del libro: ahí se salta
+            self._aplicados.add(evento.pago_id)
+            self.historiales.agregar(cliente_id, evento)
+            return self._publicar(cliente_id, cliente), cliente
+    
+    def _recargar(self):
+        """Carga todo de nuevo y lo publica; requiere _lock_carga."""
+        cargados = self._cargador()
+        with self._lock:
+            self._datos = cargados
+            self._version += 1
+            self._aplicados.clear()
+            self.indice.reconstruir(cargados['clientes'])
+            self.historiales.descartar()
+            return self._version
+    
+    def recargar(self):
+        """Vuelve a cargar desde la instantánea de saldos (por ejemplo, después de escribir una nueva)."""
+        with self._lock_carga:
+            return self._recargar()
+    
+    def sincronizar(self, leer_cambios, aplicar):
+        """Lee los cambios sin bloquear a los lectores y los aplica sobre la versión vigente al publicar.
+
+        Leer y aplicar van dentro de _lock_carga: dos sincronizaciones que leyeran el mismo tramo
+        del libro sumarían sus eventos dos veces.
+        """
+        self.obtener()
+        with self._lock_carga:
+            with self._lock:
+                datos = self._datos
+            try:
+                cambios = leer_cambios(datos)
+            except LibroDesfasado:
+                cambios = None
+            if cambios is None or cambios['instantanea'] != datos['instantanea']:
+                # Otro proceso escribió una instantánea nueva o el libro se editó a mano: el tramo no cuadra
+                return self._recargar()
+            with self._lock:
+                eventos = []
+                for registro in cambios['pagos']:
+                    pago_id = str(registro['pago_id'])
+                    if pago_id in self._aplicados:
+                        self._aplicados.discard(pago_id)
+                    else:
+                        eventos.append(registro)
+                        self.historiales.descartar(str(registro['cliente_id']))
+                self._datos = aplicar(self._datos, {**cambios, 'pagos': eventos})
+                self._version += 1
+                # Los pagos no cambian lo que se busca: basta reindexar los clientes modificados
+                for cid in set(cambios['clientes_eliminados']) | {str(r['cliente_id']) for r in cambios['clientes']}:
+                    self.indice.actualizar(cid, self._datos['clientes'].get(cid))
+                for cid in cambios['clientes_eliminados']:
+                    self.historiales.descartar(cid)
+                return self._version
@@ -0,0 +1,186 @@
+"""Libro de pagos y saldos: tablas por columnas, DataFrames tipados y conciliación.
+
+Está fuera de viaje_san_juan_v3.py para poder importarlo (y probarlo) sin ejecutar la app:
+el script de Streamlit dibuja la interfaz y se conecta al almacenamiento al importarse.
+"""
+import pandas as pd
+
+# Orden de columnas compartido por la hoja de Google Sheets y la base SQLite
+COLUMNAS_CLIENTES = [
+    'cliente_id', 'nombre', 'telefono', 'email', 'asientos',
+    'hab_sencillas', 'hab_dobles', 'hab_triples',
+    'total_a_pagar', 'total_pagado', 'saldo_pendiente', 'notas', 'fecha_registro', 'updated_at', 'version'
+]
+# La hoja de pagos es un libro de eventos que solo crece: cada fila es un pago o el reverso de uno
+COLUMNAS_PAGOS = [
+    'cliente_id', 'fecha', 'monto', 'metodo', 'referencia', 'notas', 'timestamp', 'pago_id', 'tipo', 'revierte'
+]
+TIPO_PAGO = 'pago'
+TIPO_REVERSO = 'reverso'
+
+# ============================================
+# TABLAS POR COLUMNAS
+# ============================================
+def tabla_desde_matriz(matriz, columnas):
+    """Tabla {columna: lista de valores} a partir de la matriz de una hoja (primera fila = encabezados).
+
+    Cada columna se busca por su encabezado; las que la hoja todavía no tiene quedan vacías.
+    """
+    if not matriz:
+        return {columna: [] for columna in columnas}
+    encabezados = [str(h) for h in matriz[0]]
+    ancho = len(encabezados)
+    relleno = [''] * ancho
+    # La API omite las celdas vacías al final de cada fila: se completan antes de trasponer
+    filas = [fila if len(fila) >= ancho else list(fila) + relleno[len(fila):] for fila in matriz[1:]]
+    por_encabezado = dict(zip(encabezados, map(list, zip(*filas))))
+    return {columna: por_encabezado.get(columna) or [''] * len(filas) for columna in columnas}
+
+def tabla_desde_filas(filas, columnas):
+    """Tabla {columna: lista de valores} a partir de filas ordenadas según columnas (p. ej. de SQLite)."""
+    if not filas:
+        return {columna: [] for columna in columnas}
+    return dict(zip(columnas, map(list, zip(*filas))))
+
+def tabla_desde_registros(registros, columnas):
+    """Tabla {columna: lista de valores} a partir de registros sueltos (cambios, un solo cliente)."""
+    return {columna: [r.get(columna, '') for r in registros] for columna in columnas}
+
+# ============================================
+# DATAFRAMES TIPADOS
+# ============================================
+# Tipo de cada columna al leer: 'texto', un dtype numérico de pandas o ('fecha', formato)
+TIPOS_CLIENTES = {
+    'cliente_id': 'texto', 'nombre': 'texto', 'telefono': 'texto', 'email': 'texto',
+    'asientos': 'int64', 'hab_sencillas': 'int64', 'hab_dobles': 'int64', 'hab_triples': 'int64',
+    'total_a_pagar': 'float64', 'total_pagado': 'float64', 'saldo_pendiente': 'float64',
+    'notas': 'texto', 'fecha_registro': ('fecha', "%d/%m/%Y %H:%M:%S"), 'updated_at': 'texto', 'version': 'int64',
+}
+TIPOS_PAGOS = {
+    'cliente_id': 'texto', 'fecha': ('fecha', "%d/%m/%Y"), 'monto': 'float64', 'metodo': 'texto',
+    'referencia': 'texto', 'notas': 'texto', 'timestamp': ('fecha', "%d/%m/%Y %H:%M:%S"), 'pago_id': 'texto',
+    'tipo': 'texto', 'revierte': 'texto',
+}
+
+# Columnas del libro que bastan para derivar los saldos
+COLUMNAS_SALDO = ['cliente_id', 'monto', 'tipo', 'revierte']
+
+def _texto(valores):
+    # Las celdas vacías llegan como '' y las de SQLite como None
+    return ['' if v is None else v if v.__class__ is str else str(v) for v in valores]
+
+def _a_numero(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _numeros(valores, tipo):
+    # Los números ya llegan como int/float con UNFORMATTED_VALUE; solo el resto pasa por float()
+    return pd.Series(
+        [v if v.__class__ in (int, float) else _a_numero(v) for v in valores], dtype='float64'
+    ).astype(tipo)
+
+def _fechas(valores, formato):
+    """Columna de fechas como texto en formato, con una sola conversión para toda la columna.
+
+    Con UNFORMATTED_VALUE las celdas que Sheets reconoció como fecha llegan como número de
+    serie (días desde el 30/12/1899): solo esas se convierten. El texto ya viene en el
+    formato que escribe la app y las pantallas lo muestran tal cual, así que no se reformatea.
+    """
+    texto = _texto(valores)
+    seriales = [i for i, v in enumerate(valores) if v.__class__ is not str and v is not None]
+    if seriales:
+        fechas = pd.to_datetime(pd.Series([float(valores[i]) for i in seriales]), unit='D', origin='1899-12-30')
+        for i, fecha in zip(seriales, fechas.dt.strftime(formato)):
+            texto[i] = fecha
+    return texto
+
+def marco_tipado(tabla, columnas, tipos):
+    """DataFrame con las columnas pedidas de tabla, cada una convertida al tipo que indica tipos.
+
+    Las columnas se construyen directo de las listas de la tabla, sin pasar por filas. Las
+    celdas vacías (o None de SQLite) quedan como '' en el texto y 0 en los números.
+    """
+    filas = len(next(iter(tabla.values()), []))
+    datos = {}
+    for columna in columnas:
+        valores = tabla.get(columna) or [''] * filas
+        tipo = tipos[columna]
+        if tipo == 'texto':
+            datos[columna] = _texto(valores)
+        elif isinstance(tipo, tuple):
+            datos[columna] = _fechas(valores, tipo[1])
+        else:
+            datos[columna] = _numeros(valores, tipo)
+    return pd.DataFrame(datos, columns=columnas)
+
+def marco_clientes(tabla_clientes):
+    """DataFrame tipado de los clientes."""
+    return marco_tipado(tabla_clientes, COLUMNAS_CLIENTES, TIPOS_CLIENTES)
+
+def marco_pagos(tabla_pagos, columnas=COLUMNAS_PAGOS):
+    """DataFrame tipado del libro; los eventos sin tipo (filas anteriores al libro) son pagos."""
+    pagos = marco_tipado(tabla_pagos, columnas, TIPOS_PAGOS)
+    pagos['tipo'] = pagos['tipo'].replace('', TIPO_PAGO)
+    return pagos
+
+def revertidos_en(tabla_pagos):
+    """pago_id que anulan los reversos de una tabla del libro."""
+    return {str(r) for t, r in zip(tabla_pagos['tipo'], tabla_pagos['revierte']) if t == TIPO_REVERSO}
+
+def pagado_por_cliente(pagos, revertidos=frozenset()):
+    """Serie cliente_id -> suma de los eventos, con un solo groupby.
+
+    Cada reverso resta el monto que anula, así que la suma vale igual para el libro completo
+    que para un tramo posterior. Un reverso repetido se cuenta una sola vez, y uno de un pago
+    que ya está en revertidos (anulado antes del tramo) no se cuenta.
+    """
+    # Los reversos son pocos: solo entre ellos se buscan repetidos
+    reversos = pagos['revierte'][pagos['tipo'] == TIPO_REVERSO]
+    repetidos = reversos.index[reversos.duplicated() | reversos.isin(revertidos)]
+    contados = pagos.drop(repetidos) if len(repetidos) else pagos
+    return contados['monto'].groupby(contados['cliente_id'], sort=False).sum().round(2)
+
+# ============================================
+# CONCILIACIÓN DE SALDOS
+# ============================================
+def conciliar_saldos(tabla_clientes, tabla_pagos, tolerancia=0.005):
+    """Recalcula total_pagado y saldo_pendiente de cada cliente a partir del libro de pagos.
+
+    Ambas tablas pasan a DataFrames tipados y los eventos se suman con un solo groupby.
+    Devuelve (diferencias, pagos_huerfanos): un DataFrame con los clientes cuya instantánea
+    guardada no coincide con el libro, y cuántos eventos son de clientes ya eliminados.
+    """
+    clientes = marco_clientes(tabla_clientes).set_index('cliente_id')
+    pagos = marco_pagos(tabla_pagos, COLUMNAS_SALDO)
+    
+    pagos_huerfanos = int((~pagos['cliente_id'].isin(clientes.index)).sum())
+    pagado = pagado_por_cliente(pagos)
+    
+    clientes['pagado_real'] = pagado.reindex(clientes.index, fill_value=0.0)
+    clientes['saldo_real'] = (clientes['total_a_pagar'] - clientes['pagado_real']).round(2)
+    distinto = (
+        ((clientes['total_pagado'] - clientes['pagado_real']).abs() > tolerancia) |
+        ((clientes['saldo_pendiente'] - clientes['saldo_real']).abs() > tolerancia)
+    )
+    diferencias = clientes.loc[
+        distinto, ['nombre', 'total_a_pagar', 'total_pagado', 'pagado_real', 'saldo_pendiente', 'saldo_real']
+    ].reset_index()
+    return diferencias, pagos_huerfanos
+
+def revisar_saldos(almacenamiento):
+    """Lee el almacenamiento completo; devuelve (diferencias, pagos_huerfanos, marca del libro leído)."""
+    tabla_clientes, tabla_pagos, marca = almacenamiento.leer_registros()
+    return (*conciliar_saldos(tabla_clientes, tabla_pagos), marca)
+
+def corregir_saldos(almacenamiento, diferencias, marca):
+    """Escribe en un solo lote los saldos corregidos y la marca hasta la que el libro quedó revisado.
+
+    Los clientes que no están en diferencias ya coinciden con el libro hasta esa marca.
+    """
+    saldos = {
+        cid: (float(pagado), float(saldo))
+        for cid, pagado, saldo in zip(diferencias['cliente_id'], diferencias['pagado_real'], diferencias['saldo_real'])
+    }
+    almacenamiento.guardar_instantanea(saldos, marca)
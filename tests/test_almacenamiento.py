@@ -0,0 +1,257 @@
+"""Pruebas del almacenamiento SQLite con la instantánea compartida, la sincronización y la reserva de IDs.
+
+Cada prueba usa una base nueva; dos AlmacenamientoSQLite sobre el mismo archivo hacen de dos procesos.
+Uso, desde la raíz del repositorio: python -m pytest -q
+"""
+import pytest
+
+from almacenamiento import AlmacenamientoSQLite, ConflictoVersion, ReservaIds
+from modelo import (
+    Cliente, ClienteEliminado, InstantaneaDatos, Pago, aplicar_cambios, cargar_datos, clientes_desde_registros,
+    guardar_cliente, historial_desde_registros, leer_cambios_datos, pagos_vigentes, reintentar_escritura
+)
+from saldos import corregir_saldos, revisar_saldos
+
+TARIFAS = {'transporte': 400, 'habitacion_sencilla': 900, 'habitacion_doble': 1100, 'habitacion_triple': 1300}
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / 'viaje.db')
+
+@pytest.fixture
+def almacenamiento(ruta):
+    return AlmacenamientoSQLite(ruta)
+
+def alta(almacenamiento, cliente_id, total=1000.0, nombre=''):
+    cliente = Cliente(
+        nombre=nombre or f'Cliente {cliente_id}', asientos=1, total_a_pagar=total, saldo_pendiente=total,
+        fecha_registro='01/03/2026 10:00:00'
+    )
+    guardar_cliente(almacenamiento, cliente_id, cliente)
+    return cliente
+
+def pagar(almacenamiento, cliente_id, monto, pago_id):
+    pago = Pago('02/03/2026', monto, 'Efectivo', timestamp='02/03/2026 10:00:00', pago_id=pago_id)
+    almacenamiento.agregar_pago(pago.a_fila(cliente_id))
+    return pago
+
+def anular(almacenamiento, cliente_id, pago):
+    reverso = pago.reverso('03/03/2026', '03/03/2026 10:00:00')
+    almacenamiento.agregar_pago(reverso.a_fila(cliente_id))
+    return reverso
+
+def instantanea_de(almacenamiento):
+    return InstantaneaDatos(
+        lambda: cargar_datos(almacenamiento, TARIFAS),
+        lambda cliente_id: historial_desde_registros(almacenamiento.leer_pagos_cliente(cliente_id))
+    )
+
+def sincronizar(instantanea, almacenamiento):
+    return instantanea.sincronizar(lambda vistos: leer_cambios_datos(almacenamiento, vistos), aplicar_cambios)
+
+def releer(almacenamiento):
+    def releer_cliente(cliente_id):
+        registro = almacenamiento.leer_cliente(cliente_id)
+        if registro is None:
+            return None
+        return clientes_desde_registros([registro], [], sobre_instantanea=True)[cliente_id]
+    return releer_cliente
+
+def saldos(instantanea):
+    _, datos = instantanea.obtener()
+    return {cid: (c.total_pagado, c.saldo_pendiente) for cid, c in datos['clientes'].items()}
+
+def escribir_instantanea(almacenamiento):
+    diferencias, _, marca = revisar_saldos(almacenamiento)
+    corregir_saldos(almacenamiento, diferencias, marca)
+    return marca
+
+def test_pago_y_reverso(almacenamiento):
+    alta(almacenamiento, 'CLI001')
+    pago = pagar(almacenamiento, 'CLI001', 300, 'a')
+    pagar(almacenamiento, 'CLI001', 200, 'b')
+    anular(almacenamiento, 'CLI001', pago)
+
+    instantanea = instantanea_de(almacenamiento)
+    assert saldos(instantanea) == {'CLI001': (200.0, 800.0)}
+    historial = instantanea.historiales.obtener('CLI001')
+    assert [p.pago_id for p in pagos_vigentes(historial)] == ['b']
+    _, datos = instantanea.obtener()
+    assert datos['totales'].recaudado == 200.0
+
+def test_reverso_repetido_resta_una_vez(almacenamiento):
+    alta(almacenamiento, 'CLI001')
+    pago = pagar(almacenamiento, 'CLI001', 300, 'a')
+    anular(almacenamiento, 'CLI001', pago)
+    # Otra sesión anuló el mismo pago a la vez
+    anular(almacenamiento, 'CLI001', pago)
+    assert saldos(instantanea_de(almacenamiento)) == {'CLI001': (0.0, 1000.0)}
+
+    # Con la instantánea escrita, el reverso ya contado tampoco resta si vuelve a llegar después de su marca
+    escribir_instantanea(almacenamiento)
+    instantanea = instantanea_de(almacenamiento)
+    anular(almacenamiento, 'CLI001', pago)
+    assert saldos(instantanea_de(almacenamiento)) == {'CLI001': (0.0, 1000.0)}
+    sincronizar(instantanea, almacenamiento)
+    assert saldos(instantanea) == {'CLI001': (0.0, 1000.0)}
+    # Ni uno registrado por esta misma sesión
+    _, cliente = instantanea.registrar_evento('CLI001', pago.reverso('04/03/2026', '04/03/2026 10:00:00'))
+    assert (cliente.total_pagado, cliente.saldo_pendiente) == (0.0, 1000.0)
+
+def test_sincronizar_aplica_solo_lo_nuevo(almacenamiento, ruta):
+    for cliente_id in ('CLI001', 'CLI002', 'CLI003'):
+        alta(almacenamiento, cliente_id)
+    pagar(almacenamiento, 'CLI001', 100, 'a')
+    instantanea = instantanea_de(almacenamiento)
+    version, _ = instantanea.obtener()
+
+    # Lo que hace otro proceso con su propia conexión
+    otro = AlmacenamientoSQLite(ruta)
+    pagar(otro, 'CLI002', 250, 'b')
+    pagar(otro, 'CLI003', 40, 'c')
+    registro = otro.leer_cliente('CLI001')
+    editado = releer(otro)('CLI001')
+    editado.nombre = 'Renombrado'
+    guardar_cliente(otro, 'CLI001', editado, registro['version'])
+    otro.eliminar_cliente('CLI003')
+    alta(otro, 'CLI004', total=500.0)
+
+    # Un pago de esta sesión ya aplicado no se suma otra vez al leerlo del libro
+    propio = pagar(almacenamiento, 'CLI001', 50, 'd')
+    instantanea.registrar_evento('CLI001', propio)
+
+    assert sincronizar(instantanea, almacenamiento) > version
+    _, datos = instantanea.obtener()
+    assert saldos(instantanea) == {
+        'CLI001': (150.0, 850.0), 'CLI002': (250.0, 750.0), 'CLI004': (0.0, 500.0)
+    }
+    assert datos['clientes']['CLI001'].nombre == 'Renombrado'
+    assert datos['totales'].clientes == 3
+    assert datos['totales'].recaudado == 400.0
+    assert datos['totales'].presupuesto == 2500.0
+    assert instantanea.indice.buscar('renombrado') == ['CLI001']
+    assert instantanea.indice.buscar('CLI003') == []
+
+    # Sin cambios nuevos, otra sincronización no mueve nada
+    sincronizar(instantanea, almacenamiento)
+    assert saldos(instantanea)['CLI001'] == (150.0, 850.0)
+
+def test_instantanea_y_arranque_en_frio(almacenamiento, ruta):
+    alta(almacenamiento, 'CLI001')
+    alta(almacenamiento, 'CLI002')
+    pago = pagar(almacenamiento, 'CLI001', 300, 'a')
+    pagar(almacenamiento, 'CLI002', 100, 'b')
+    anular(almacenamiento, 'CLI001', pago)
+    marca = escribir_instantanea(almacenamiento)
+
+    tabla_clientes, instantanea_guardada = almacenamiento.leer_clientes()
+    assert instantanea_guardada == marca
+    assert dict(zip(tabla_clientes['cliente_id'], tabla_clientes['total_pagado'])) == {'CLI001': 0.0, 'CLI002': 100.0}
+
+    pagar(almacenamiento, 'CLI001', 70, 'c')
+    # El arranque en frío solo lee el tramo del libro posterior a la marca
+    eventos, _, revertidos = almacenamiento.leer_pagos_desde(marca)
+    assert [e['pago_id'] for e in eventos] == ['c']
+    assert revertidos == {'a'}
+    instantanea = instantanea_de(almacenamiento)
+    assert saldos(instantanea) == {'CLI001': (70.0, 930.0), 'CLI002': (100.0, 900.0)}
+
+    # Una instantánea nueva escrita por otro proceso hace que la sincronización recargue desde ella
+    otro = AlmacenamientoSQLite(ruta)
+    pagar(otro, 'CLI002', 10, 'd')
+    escribir_instantanea(otro)
+    sincronizar(instantanea, almacenamiento)
+    assert saldos(instantanea) == {'CLI001': (70.0, 930.0), 'CLI002': (110.0, 890.0)}
+    _, datos = instantanea.obtener()
+    assert datos['instantanea'] == almacenamiento.leer_clientes()[1]
+
+def test_conflicto_de_version_y_reintento(almacenamiento, ruta):
+    alta(almacenamiento, 'CLI001')
+    otro = AlmacenamientoSQLite(ruta)
+    leido_aqui = releer(almacenamiento)('CLI001')
+    leido_alla = releer(otro)('CLI001')
+
+    def renombrar(cliente):
+        cliente.nombre = 'Desde otra sesión'
+    escrito, _ = reintentar_escritura('CLI001', leido_alla, renombrar, lambda *a: guardar_cliente(otro, *a), releer(otro))
+    assert escrito.version == 2
+
+    # La versión leída aquí ya no es la guardada: comparar y asignar no escribe
+    with pytest.raises(ConflictoVersion):
+        guardar_cliente(almacenamiento, 'CLI001', releer(almacenamiento)('CLI001'), leido_aqui.version)
+
+    def agregar_asiento(cliente):
+        cliente.asientos += 1
+    escrito, _ = reintentar_escritura(
+        'CLI001', leido_aqui, agregar_asiento, lambda *a: guardar_cliente(almacenamiento, *a), releer(almacenamiento)
+    )
+    registro = almacenamiento.leer_cliente('CLI001')
+    assert (registro['nombre'], registro['asientos'], registro['version']) == ('Desde otra sesión', 2, 3)
+    assert escrito.version == 3
+
+    # Un alta con un ID que ya existe también es un conflicto
+    with pytest.raises(ConflictoVersion):
+        alta(otro, 'CLI001')
+
+    otro.eliminar_cliente('CLI001')
+    with pytest.raises(ClienteEliminado):
+        reintentar_escritura(
+            'CLI001', escrito, agregar_asiento, lambda *a: guardar_cliente(almacenamiento, *a), releer(almacenamiento)
+        )
+
+def test_reserva_de_ids(almacenamiento, ruta):
+    # Sin contador, el primer bloque empieza después del mayor ID existente
+    alta(almacenamiento, 'CLI007')
+    alta(almacenamiento, 'ESPECIAL')
+    aqui = ReservaIds(almacenamiento, tam_bloque=3)
+    alla = ReservaIds(AlmacenamientoSQLite(ruta), tam_bloque=3)
+
+    ids_aqui, ids_alla = [], []
+    for _ in range(4):
+        ids_aqui.append(aqui.siguiente())
+        ids_alla.append(alla.siguiente())
+    assert ids_aqui == ['CLI008', 'CLI009', 'CLI010', 'CLI014']
+    assert ids_alla == ['CLI011', 'CLI012', 'CLI013', 'CLI017']
+    assert not set(ids_aqui) & set(ids_alla)
+    # Un proceso nuevo sigue después de todo lo reservado, aunque haya huecos sin usar
+    assert ReservaIds(AlmacenamientoSQLite(ruta)).siguiente() == 'CLI020'
+
+def test_reserva_de_ids_no_reutiliza_los_eliminados(almacenamiento):
+    alta(almacenamiento, 'CLI001')
+    alta(almacenamiento, 'CLI002')
+    pagar(almacenamiento, 'CLI002', 100, 'a')
+    # Sin contador todavía (base anterior a la reserva de IDs), se elimina el mayor
+    almacenamiento.eliminar_cliente('CLI002')
+    assert ReservaIds(almacenamiento).siguiente() == 'CLI003'
+
+def test_turno_de_conciliacion(almacenamiento, ruta):
+    otro = AlmacenamientoSQLite(ruta)
+    assert almacenamiento.tomar_turno_conciliacion('aqui', 60)
+    assert not otro.tomar_turno_conciliacion('alla', 60)
+    # El mismo titular lo renueva; soltar un turno ajeno no hace nada
+    assert almacenamiento.tomar_turno_conciliacion('aqui', 60)
+    otro.soltar_turno_conciliacion('alla')
+    assert not otro.tomar_turno_conciliacion('alla', 60)
+    almacenamiento.soltar_turno_conciliacion('aqui')
+    assert otro.tomar_turno_conciliacion('alla', -1)
+    # Un turno vencido (su proceso murió sin soltarlo) lo puede tomar otro
+    assert almacenamiento.tomar_turno_conciliacion('aqui', 60)
+
+def test_busqueda_por_fragmentos(almacenamiento):
+    alta(almacenamiento, 'CLI012', nombre='José Pérez')
+    alta(almacenamiento, 'CLI001', nombre='Ana Luisa')
+    alta(almacenamiento, 'CLI120', nombre='Juana Torres')
+    instantanea = instantanea_de(almacenamiento)
+    instantanea.obtener()
+    indice = instantanea.indice
+    # Fragmentos de uno o dos caracteres coinciden en cualquier posición, como los largos
+    assert set(indice.buscar('12')) == {'CLI012', 'CLI120'}
+    assert set(indice.buscar('01')) == {'CLI012', 'CLI001'}
+    assert indice.buscar('CLI012') == ['CLI012']
+    assert indice.buscar('perez') == ['CLI012']
+    assert indice.buscar('uan') == ['CLI120']
+    # Con palabras largas, la corta filtra a sus candidatos
+    assert indice.buscar('ana 01') == ['CLI001']
+    assert indice.buscar('ana 9') == []
+    # Lo que empieza un campo va primero
+    assert indice.buscar('an') == ['CLI001', 'CLI120']
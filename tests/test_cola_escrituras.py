@@ -0,0 +1,232 @@
+"""Pruebas de la cola de escritura y del motor de Google Sheets con un libro falso en memoria.
+
+Uso, desde la raíz del repositorio: python -m pytest -q
+"""
+import re
+import threading
+from types import SimpleNamespace
+
+import gspread
+import pytest
+
+from almacenamiento import (
+    AlmacenamientoSheets, ColaEscrituras, ConflictoVersion, EscrituraFallida, IndiceFilas, ReservaIds
+)
+from saldos import COLUMNAS_CLIENTES
+
+class HojaFalsa:
+    def __init__(self, titulo):
+        self.titulo = titulo
+        self.filas = [['encabezado']]
+        self.actualizaciones = []
+        self.fallar = False
+        # Si está puesto, cada envío espera a que se libere (una red lenta)
+        self.pausa = None
+        self.enviando = threading.Event()
+
+    def _enviar(self):
+        self.enviando.set()
+        if self.pausa is not None:
+            self.pausa.wait(5)
+        if self.fallar:
+            raise RuntimeError('cuota agotada')
+
+    def append_rows(self, filas, **opciones):
+        self._enviar()
+        primera = len(self.filas) + 1
+        self.filas.extend(list(f) for f in filas)
+        return {'updates': {'updatedRange': f"{self.titulo}!A{primera}:O{len(self.filas)}"}}
+
+    def batch_update(self, datos):
+        self._enviar()
+        self.actualizaciones.extend(datos)
+        for dato in datos:
+            self.escribir(dato['range'], dato['values'])
+
+    def escribir(self, rango, valores):
+        columna, fila = re.match(r'([A-Z])(\d+)', rango).groups()
+        inicio = ord(columna) - ord('A')
+        for desplazamiento, fila_valores in enumerate(valores):
+            while len(self.filas) < int(fila) + desplazamiento:
+                self.filas.append([])
+            destino = self.filas[int(fila) - 1 + desplazamiento]
+            destino.extend([''] * (inicio + len(fila_valores) - len(destino)))
+            destino[inicio:inicio + len(fila_valores)] = fila_valores
+
+    def get(self, rango, value_render_option=None):
+        columna, primera, ultima_columna, ultima = re.match(r'([A-Z])(\d+)(?::([A-Z])(\d+))?', rango).groups()
+        inicio, fin = ord(columna) - ord('A'), ord(ultima_columna or columna) - ord('A') + 1
+        return [list(fila[inicio:fin]) for fila in self.filas[int(primera) - 1:int(ultima or primera)]]
+
+    def acell(self, celda, value_render_option=None):
+        fila = self.get(celda)
+        return SimpleNamespace(value=fila[0][0] if fila and fila[0] else None)
+
+    def col_values(self, columna):
+        return [fila[columna - 1] if len(fila) >= columna else '' for fila in self.filas]
+
+class LibroFalso:
+    def __init__(self, hojas):
+        self.hojas = hojas
+
+    def batch_update(self, cuerpo):
+        for solicitud in cuerpo['requests']:
+            if 'addSheet' in solicitud:
+                titulo = solicitud['addSheet']['properties']['title']
+                self.hojas[titulo] = HojaFalsa(titulo)
+                self.hojas[titulo].filas = []
+            else:
+                filas = solicitud['updateCells']['rows']
+                self.hojas[titulo].filas = [
+                    [list(celda['userEnteredValue'].values())[0] for celda in fila['values']] for fila in filas
+                ]
+
+    def values_batch_update(self, cuerpo):
+        for dato in cuerpo['data']:
+            titulo, rango = dato['range'].split('!')
+            self.hojas[titulo].escribir(rango, dato['values'])
+
+class CacheFalsa:
+    def __init__(self, *titulos):
+        self.hojas = {titulo: HojaFalsa(titulo) for titulo in titulos}
+
+    def hoja(self, titulo):
+        if titulo not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def libro(self):
+        return LibroFalso(self.hojas)
+
+    def llamar(self, funcion, *args, prioridad=None, **kwargs):
+        return funcion(*args, **kwargs)
+
+    def ejecutar(self, operacion, *args):
+        return operacion(*args)
+
+@pytest.fixture
+def cache():
+    return CacheFalsa('clientes', 'pagos', 'contadores')
+
+def test_lote_por_hoja_e_indice(cache):
+    filas = IndiceFilas()
+    cola = ColaEscrituras(cache, indices={'clientes': [(0, filas)]}, max_espera=60)
+    comprobantes = [cola.encolar_alta('clientes', [f'CLI00{n}', 'x']) for n in (1, 2)]
+    comprobantes.append(cola.encolar_actualizaciones('clientes', {'A2:B2': [['CLI001', 'y']]}))
+    cola.confirmar(comprobantes)
+    # Las altas van antes que las actualizaciones de la misma hoja
+    assert cache.hojas['clientes'].filas[1:] == [['CLI001', 'y'], ['CLI002', 'x']]
+    assert (filas.obtener('CLI001'), filas.obtener('CLI002')) == (2, 3)
+    assert cola.pendientes() == 0
+
+def test_lote_fallido_se_reporta_una_vez(cache):
+    cola = ColaEscrituras(cache, max_espera=60)
+    comprobante = cola.encolar_alta('pagos', ['CLI001', 100])
+    cache.hojas['pagos'].fallar = True
+    cola.vaciar()
+    assert cola.pendientes() == 0
+    with pytest.raises(EscrituraFallida):
+        cola.confirmar([comprobante])
+    cola.confirmar([comprobante])
+
+def test_corregir_alta_en_cola(cache):
+    cola = ColaEscrituras(cache, max_espera=60)
+    comprobante = cola.encolar_alta('clientes', ['CLI001', 'x'])
+
+    def fallar(fila):
+        fila[1] = 'a medias'
+        raise ValueError
+    with pytest.raises(ValueError):
+        cola.corregir_alta('clientes', 'CLI001', fallar)
+
+    def corregir(fila):
+        fila[1] = 'y'
+    assert cola.corregir_alta('clientes', 'CLI001', corregir) == comprobante
+    assert cola.corregir_alta('clientes', 'CLI002', corregir) is None
+    cola.confirmar([comprobante])
+    assert cache.hojas['clientes'].filas[1:] == [['CLI001', 'y']]
+
+def test_encolar_no_espera_al_envio(cache):
+    cola = ColaEscrituras(cache, max_espera=60)
+    hoja = cache.hojas['clientes']
+    hoja.pausa = threading.Event()
+    cola.encolar_alta('clientes', ['CLI001', 'x'])
+    envio = threading.Thread(target=cola.vaciar)
+    envio.start()
+    assert hoja.enviando.wait(5)
+
+    # Con el envío detenido en la red, otra sesión encola y corrige sin esperar
+    terminado = threading.Event()
+    def otra_sesion():
+        cola.encolar_alta('clientes', ['CLI002', 'x'])
+        # El alta en vuelo ya no está en la cola: no se corrige a la vez que se envía
+        assert cola.corregir_alta('clientes', 'CLI001', lambda fila: None) is None
+        assert cola.corregir_alta('clientes', 'CLI002', lambda fila: fila.__setitem__(1, 'y')) is not None
+        terminado.set()
+    threading.Thread(target=otra_sesion, daemon=True).start()
+    assert terminado.wait(2)
+    assert cola.pendientes() == 1
+
+    hoja.pausa.set()
+    envio.join(5)
+    cola.vaciar()
+    assert hoja.filas[1:] == [['CLI001', 'x'], ['CLI002', 'y']]
+
+def test_umbral_vacia_en_segundo_plano(cache):
+    cola = ColaEscrituras(cache, max_pendientes=2, max_espera=60)
+    hoja = cache.hojas['pagos']
+    hoja.pausa = threading.Event()
+    cola.encolar_alta('pagos', ['CLI001', 1])
+    cola.encolar_alta('pagos', ['CLI001', 2])
+    # Quien llenó la cola vuelve enseguida; el envío sigue en otro hilo
+    assert hoja.enviando.wait(5)
+    hoja.pausa.set()
+    cola.vaciar()
+    assert hoja.filas[1:] == [['CLI001', 1], ['CLI001', 2]]
+
+def fila_cliente(cliente_id, nombre, version):
+    fila = [''] * len(COLUMNAS_CLIENTES)
+    fila[0], fila[1], fila[-1] = cliente_id, nombre, version
+    return fila
+
+def test_version_de_un_lote_fallido_no_bloquea_la_siguiente_edicion(cache):
+    almacenamiento = AlmacenamientoSheets(cache)
+    almacenamiento.confirmar([almacenamiento.guardar_cliente(fila_cliente('CLI001', 'Ana', 1), None)])
+    hoja = cache.hojas['clientes']
+
+    hoja.fallar = True
+    comprobante = almacenamiento.guardar_cliente(fila_cliente('CLI001', 'Ana María', 2), 1)
+    with pytest.raises(EscrituraFallida):
+        almacenamiento.confirmar([comprobante])
+
+    # La hoja sigue en la versión 1: la sesión que la releyó puede volver a escribir
+    hoja.fallar = False
+    almacenamiento.confirmar([almacenamiento.guardar_cliente(fila_cliente('CLI001', 'Ana María', 2), 1)])
+    assert (hoja.filas[1][1], hoja.filas[1][-1]) == ('Ana María', 2)
+    with pytest.raises(ConflictoVersion):
+        almacenamiento.guardar_cliente(fila_cliente('CLI001', 'Otra', 2), 1)
+
+def test_turno_de_conciliacion_entre_procesos(cache, monkeypatch):
+    monkeypatch.setattr(AlmacenamientoSheets, 'espera_turno', 0)
+    aqui, alla = AlmacenamientoSheets(cache), AlmacenamientoSheets(cache)
+    assert aqui.tomar_turno_conciliacion('aqui', 60)
+    assert not alla.tomar_turno_conciliacion('alla', 60)
+    # Soltar un turno ajeno no hace nada
+    alla.soltar_turno_conciliacion('alla')
+    assert not alla.tomar_turno_conciliacion('alla', 60)
+    aqui.soltar_turno_conciliacion('aqui')
+    assert alla.tomar_turno_conciliacion('alla', -1)
+    # Un turno vencido (su proceso murió sin soltarlo) lo puede tomar otro
+    assert aqui.tomar_turno_conciliacion('aqui', 60)
+
+def test_turno_escrito_a_la_vez_lo_gana_el_ultimo(cache, monkeypatch):
+    aqui, alla = AlmacenamientoSheets(cache), AlmacenamientoSheets(cache)
+    # Mientras aquí espera para releer, el otro proceso (que leyó el turno libre) escribe el suyo
+    monkeypatch.setattr('almacenamiento.time.sleep', lambda _: alla._escribir_turno('alla', 10**10))
+    assert not aqui.tomar_turno_conciliacion('aqui', 60)
+
+def test_reserva_de_ids_no_reutiliza_los_eliminados(cache):
+    # Libro anterior a la reserva de IDs: sin contador, y CLI005 eliminado con pagos en el libro
+    cache.hojas['clientes'].filas += [fila_cliente('CLI001', 'Ana', 1), fila_cliente('CLI003', 'Luis', 1)]
+    cache.hojas['pagos'].filas += [['CLI001', 100], ['CLI005', 50]]
+    assert ReservaIds(AlmacenamientoSheets(cache), tam_bloque=3).siguiente() == 'CLI006'
@@ -0,0 +1,115 @@
+"""Pruebas de la conciliación de saldos contra el libro de pagos.
+
+Uso, desde la raíz del repositorio: python -m pytest -q
+"""
+import pytest
+
+from saldos import (
+    COLUMNAS_CLIENTES, COLUMNAS_PAGOS, TIPO_REVERSO, conciliar_saldos, marco_pagos, tabla_desde_matriz,
+    tabla_desde_registros
+)
+
+def cliente(cliente_id, total_a_pagar, total_pagado, saldo_pendiente, nombre=''):
+    return {
+        'cliente_id': cliente_id, 'nombre': nombre or f'Cliente {cliente_id}', 'asientos': 1,
+        'total_a_pagar': total_a_pagar, 'total_pagado': total_pagado, 'saldo_pendiente': saldo_pendiente,
+        'version': 1,
+    }
+
+def pago(cliente_id, monto, pago_id, tipo='pago', revierte=''):
+    return {'cliente_id': cliente_id, 'monto': monto, 'pago_id': pago_id, 'tipo': tipo, 'revierte': revierte}
+
+def conciliar(clientes, pagos, **kwargs):
+    return conciliar_saldos(
+        tabla_desde_registros(clientes, COLUMNAS_CLIENTES), tabla_desde_registros(pagos, COLUMNAS_PAGOS), **kwargs
+    )
+
+def test_instantanea_que_coincide_no_tiene_diferencias():
+    diferencias, huerfanos = conciliar(
+        [cliente('CLI001', 1000, 300, 700), cliente('CLI002', 500, 0, 500)],
+        [pago('CLI001', 100, 'a'), pago('CLI001', 200, 'b')],
+    )
+    assert diferencias.empty
+    assert huerfanos == 0
+
+def test_detecta_instantanea_atrasada():
+    diferencias, _ = conciliar(
+        [cliente('CLI001', 1000, 100, 900), cliente('CLI002', 500, 0, 500)],
+        [pago('CLI001', 100, 'a'), pago('CLI001', 250.5, 'b')],
+    )
+    assert list(diferencias['cliente_id']) == ['CLI001']
+    fila = diferencias.iloc[0]
+    assert fila['pagado_real'] == pytest.approx(350.5)
+    assert fila['saldo_real'] == pytest.approx(649.5)
+    assert fila['total_pagado'] == pytest.approx(100)
+
+def test_saldo_incoherente_con_el_total_pagado_es_diferencia():
+    diferencias, _ = conciliar([cliente('CLI001', 1000, 100, 800)], [pago('CLI001', 100, 'a')])
+    assert list(diferencias['cliente_id']) == ['CLI001']
+    assert diferencias.iloc[0]['saldo_real'] == pytest.approx(900)
+
+def test_cuenta_pagos_de_clientes_eliminados():
+    diferencias, huerfanos = conciliar(
+        [cliente('CLI001', 1000, 100, 900)],
+        [pago('CLI001', 100, 'a'), pago('CLI009', 40, 'b'), pago('CLI009', 60, 'c')],
+    )
+    assert diferencias.empty
+    assert huerfanos == 2
+
+def test_reverso_resta_el_pago_una_sola_vez():
+    pagos = [
+        pago('CLI001', 300, 'a'),
+        pago('CLI001', 200, 'b'),
+        pago('CLI001', -300, 'r1', TIPO_REVERSO, 'a'),
+        # Otro proceso reintentó el mismo reverso
+        pago('CLI001', -300, 'r2', TIPO_REVERSO, 'a'),
+    ]
+    diferencias, _ = conciliar([cliente('CLI001', 1000, 200, 800)], pagos)
+    assert diferencias.empty
+    diferencias, _ = conciliar([cliente('CLI001', 1000, 500, 500)], pagos)
+    assert diferencias.iloc[0]['pagado_real'] == pytest.approx(200)
+
+def test_tolerancia_de_centavos():
+    clientes = [cliente('CLI001', 1000, 100.004, 899.996)]
+    diferencias, _ = conciliar(clientes, [pago('CLI001', 100, 'a')])
+    assert diferencias.empty
+    diferencias, _ = conciliar(clientes, [pago('CLI001', 100, 'a')], tolerancia=0.001)
+    assert list(diferencias['cliente_id']) == ['CLI001']
+
+def test_celdas_vacias_y_none_cuentan_como_cero():
+    clientes = [cliente('CLI001', '', '', None)]
+    pagos = [pago('CLI001', '', 'a'), pago('CLI001', None, 'b')]
+    diferencias, huerfanos = conciliar(clientes, pagos)
+    assert diferencias.empty
+    assert huerfanos == 0
+
+def test_libro_vacio():
+    diferencias, huerfanos = conciliar([cliente('CLI001', 1000, 100, 900)], [])
+    assert list(diferencias['cliente_id']) == ['CLI001']
+    assert diferencias.iloc[0]['pagado_real'] == 0
+    assert huerfanos == 0
+
+def test_desde_matriz_de_la_hoja():
+    # La API recorta las celdas vacías al final de cada fila y la hoja vieja no tiene tipo ni revierte
+    encabezados = ['cliente_id', 'fecha', 'monto', 'metodo', 'referencia', 'notas', 'timestamp', 'pago_id']
+    matriz_pagos = [
+        encabezados,
+        ['CLI001', '01/02/2026', 100, 'Efectivo', '', '', '01/02/2026 10:00:00', 'a'],
+        ['CLI001', '02/02/2026', '50', 'Efectivo'],
+    ]
+    matriz_clientes = [COLUMNAS_CLIENTES, ['CLI001', 'Ana', '', '', 1, 0, 0, 0, 1000, 150, 850]]
+    tabla_pagos = tabla_desde_matriz(matriz_pagos, COLUMNAS_PAGOS)
+    assert tabla_pagos['pago_id'] == ['a', '']
+    assert tabla_pagos['tipo'] == ['', '']
+    diferencias, huerfanos = conciliar_saldos(tabla_desde_matriz(matriz_clientes, COLUMNAS_CLIENTES), tabla_pagos)
+    assert diferencias.empty
+    assert huerfanos == 0
+
+def test_fechas_seriales_de_sheets():
+    tabla = tabla_desde_registros(
+        [{'cliente_id': 'CLI001', 'fecha': 46054, 'timestamp': 46054.5, 'monto': 1}], COLUMNAS_PAGOS
+    )
+    pagos = marco_pagos(tabla)
+    assert pagos.loc[0, 'fecha'] == '01/02/2026'
+    assert pagos.loc[0, 'timestamp'] == '01/02/2026 12:00:00'
+    assert pagos.loc[0, 'tipo'] == 'pago'
@@ -12,6 +12,7 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 import gspread
 from google.oauth2.service_account import Credentials
 import hashlib
+import threading
 
 # ============================================
 # CONFIGURACIÓN DE AUTENTICACIÓN
@@ -197,6 +198,37 @@ TARIFAS = {
 # FUNCIONES DE DATOS CON GOOGLE SHEETS
 # ============================================
 
+@st.cache_resource
+def indice_filas_clientes():
+    """Índice compartido ID de cliente → número de fila en la hoja Clientes"""
+    return {}
+
+@st.cache_resource
+def lock_indice_clientes():
+    """Lock del índice de filas; todas las sesiones del proceso comparten el mismo diccionario"""
+    return threading.Lock()
+
+def reconstruir_indice_clientes(ids, primera_fila=2):
+    """Reconstruye el índice de filas a partir de la columna de IDs"""
+    nuevo = {str(cid): fila for fila, cid in enumerate(ids, start=primera_fila) if cid}
+    indice = indice_filas_clientes()
+    with lock_indice_clientes():
+        indice.clear()
+        indice.update(nuevo)
+
+def buscar_fila_cliente(worksheet, cliente_id):
+    """Devuelve la fila del cliente validando la celda de ID; si no está o no coincide, reconstruye el índice y reintenta"""
+    indice = indice_filas_clientes()
+    with lock_indice_clientes():
+        fila = indice.get(cliente_id)
+    if fila is not None and str(worksheet.cell(fila, 1).value) == cliente_id:
+        return fila
+    # Índice vacío, desfasado o sin el cliente (otra instancia pudo agregarlo): releer solo
+    # la columna de IDs antes de darlo por nuevo, para no duplicar su fila
+    reconstruir_indice_clientes(worksheet.col_values(1)[1:])
+    with lock_indice_clientes():
+        return indice.get(cliente_id)
+
 @st.cache_data(ttl=60)
 def cargar_clientes():
     """Carga clientes desde Google Sheets"""
@@ -211,6 +243,8 @@ def cargar_clientes():
         if not data:
             return {}
         
+        reconstruir_indice_clientes([row.get('ID') for row in data])
+        
         clientes = {}
         for row in data:
             cliente_id = row.get('ID')
@@ -231,7 +265,7 @@ def cargar_clientes():
                     'saldo_pendiente': float(row.get('Saldo_Pendiente', 0)),
                     'notas': row.get('Notas', ''),
                     'fecha_registro': row.get('Fecha_Registro', ''),
-                    'pagos': []  # Los pagos se cargan por separado
+                    'pagos': []  # Esta edición no muestra historiales: los totales vienen de la hoja
                 }
         
         return clientes
@@ -265,25 +299,26 @@ def guardar_cliente(cliente_id, cliente):
             cliente['fecha_registro']
         ]
         
-        # Buscar si el cliente ya existe
-        all_values = worksheet.get_all_values()
+        # Buscar fila del cliente en el índice en memoria
+        fila = buscar_fila_cliente(worksheet, cliente_id)
         
-        if len(all_values) == 0:
-            # Primera vez - crear headers
-            headers = ['ID', 'Nombre', 'Telefono', 'Email', 'Asientos', 'Hab_Sencillas', 
-                      'Hab_Dobles', 'Hab_Triples', 'Total_Pagar', 'Total_Pagado', 
-                      'Saldo_Pendiente', 'Notas', 'Fecha_Registro']
-            worksheet.append_row(headers)
-            worksheet.append_row(row_data)
+        if fila:
+            # Actualizar fila existente
+            worksheet.update(range_name=f'A{fila}:M{fila}', values=[row_data])
         else:
-            # Buscar fila del cliente
-            cell = worksheet.find(cliente_id)
-            if cell:
-                # Actualizar fila existente
-                worksheet.update(f'A{cell.row}:M{cell.row}', [row_data])
-            else:
-                # Agregar nuevo cliente
-                worksheet.append_row(row_data)
+            filas_nuevas = [row_data]
+            if not indice_filas_clientes() and not worksheet.row_values(1):
+                # Primera vez - crear headers
+                headers = ['ID', 'Nombre', 'Telefono', 'Email', 'Asientos', 'Hab_Sencillas', 
+                          'Hab_Dobles', 'Hab_Triples', 'Total_Pagar', 'Total_Pagado', 
+                          'Saldo_Pendiente', 'Notas', 'Fecha_Registro']
+                filas_nuevas.insert(0, headers)
+            # Agregar nuevo cliente
+            respuesta = worksheet.append_rows(filas_nuevas)
+            rango = respuesta['updates']['updatedRange'].split('!')[-1]
+            ultima_fila = int(''.join(ch for ch in rango.split(':')[-1] if ch.isdigit()))
+            with lock_indice_clientes():
+                indice_filas_clientes()[cliente_id] = ultima_fila
         
         # Limpiar cache
         cargar_clientes.clear()
@@ -300,10 +335,17 @@ def eliminar_cliente_sheets(cliente_id):
             return False
         
         worksheet = spreadsheet.worksheet("Clientes")
-        cell = worksheet.find(cliente_id)
-        
-        if cell:
-            worksheet.delete_rows(cell.row)
+        fila = buscar_fila_cliente(worksheet, cliente_id)
+        
+        if fila:
+            worksheet.delete_rows(fila)
+            # Recorrer las filas que estaban debajo del cliente eliminado
+            indice = indice_filas_clientes()
+            with lock_indice_clientes():
+                indice.pop(cliente_id, None)
+                for cid, f in indice.items():
+                    if f > fila:
+                        indice[cid] = f - 1
             cargar_clientes.clear()
             return True
         return False
@@ -311,40 +353,6 @@ def eliminar_cliente_sheets(cliente_id):
         st.error(f"Error al eliminar cliente: {str(e)}")
         return False
 
-@st.cache_data(ttl=60)
-def cargar_pagos():
-    """Carga todos los pagos desde Google Sheets"""
-    try:
-        spreadsheet = get_spreadsheet()
-        if not spreadsheet:
-            return {}
-        
-        worksheet = spreadsheet.worksheet("Pagos")
-        data = worksheet.get_all_records()
-        
-        # Organizar pagos por cliente
-        pagos_por_cliente = {}
-        for row in data:
-            cliente_id = row.get('Cliente_ID')
-            if cliente_id:
-                if cliente_id not in pagos_por_cliente:
-                    pagos_por_cliente[cliente_id] = []
-                
-                pago = {
-                    'fecha': row.get('Fecha', ''),
-                    'monto': float(row.get('Monto', 0)),
-                    'metodo': row.get('Metodo', ''),
-                    'referencia': row.get('Referencia', ''),
-                    'notas': row.get('Notas', ''),
-                    'timestamp': row.get('Timestamp', '')
-                }
-                pagos_por_cliente[cliente_id].append(pago)
-        
-        return pagos_por_cliente
-    except Exception as e:
-        st.error(f"Error al cargar pagos: {str(e)}")
-        return {}
-
 def guardar_pago(cliente_id, pago):
     """Guarda un pago en Google Sheets"""
     try:
@@ -364,14 +372,12 @@ def guardar_pago(cliente_id, pago):
             pago['timestamp']
         ]
         
-        # Verificar si hay headers
-        all_values = worksheet.get_all_values()
-        if len(all_values) == 0:
+        # Verificar si hay headers (solo la primera fila, no la hoja completa)
+        if not worksheet.row_values(1):
             headers = ['Cliente_ID', 'Fecha', 'Monto', 'Metodo', 'Referencia', 'Notas', 'Timestamp']
             worksheet.append_row(headers)
         
         worksheet.append_row(row_data)
-        cargar_pagos.clear()
         return True
     except Exception as e:
         st.error(f"Error al guardar pago: {str(e)}")
@@ -379,9 +385,9 @@ def guardar_pago(cliente_id, pago):
 
 # Función para generar ID único
 def generar_id(clientes):
-    if not clientes:
-        return "CLI001"
-    ultimo_id = max([int(k[3:]) for k in clientes.keys()])
+    # Los IDs que no siguen el formato CLI### se ignoran en lugar de romper el registro
+    numeros = [int(k[3:]) for k in clientes.keys() if str(k).startswith("CLI") and str(k)[3:].isdigit()]
+    ultimo_id = max(numeros, default=0)
     return f"CLI{str(ultimo_id + 1).zfill(3)}"
 
 # Función para calcular total
@@ -392,13 +398,8 @@ def calcular_total(asientos, hab_sencillas, hab_dobles, hab_triples):
              hab_triples * TARIFAS['habitacion_triple'])
     return total
 
-# Cargar datos
+# Cargar datos (los totales vienen en la hoja Clientes; la hoja Pagos solo se escribe)
 clientes = cargar_clientes()
-pagos_data = cargar_pagos()
-
-# Combinar clientes con sus pagos
-for cliente_id in clientes:
-    clientes[cliente_id]['pagos'] = pagos_data.get(cliente_id, [])
 
 # Título principal
 st.title("🚌 Viaje a San Juan de los Lagos")
@@ -1,16 +1,35 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, date
+from concurrent.futures import BrokenExecutor
+from dataclasses import asdict
+from datetime import datetime, date, timedelta
+from importlib.machinery import ModuleSpec
 import json
-from io import BytesIO
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+import sqlite3
+import tempfile
+import threading
+import uuid
 import gspread
 from google.oauth2.service_account import Credentials
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from almacenamiento import (
+    AlmacenamientoSheets, AlmacenamientoSQLite, CacheHojas, ConflictoVersion, LimitadorCuota, ReservaIds,
+    TurnoOcupado, generar_pago_id
+)
+from kardex import CacheKardex, crear_pool_render, kardex_cacheados, kardex_zip, nombre_kardex
+from modelo import (
+    Cliente, ClienteEliminado, InstantaneaDatos, Pago, TotalesViaje, aplicar_cambios, cargar_datos,
+    clientes_desde_registros, guardar_cliente, historial_desde_registros, leer_cambios_datos,
+    normalizar_texto, pagos_desde_marco, pagos_vigentes, reintentar_escritura
+)
+from saldos import TIPO_REVERSO, corregir_saldos, marco_pagos, revisar_saldos
+
+# Streamlit ejecuta este script como __main__, y multiprocessing lo volvería a ejecutar entero en
+# cada proceso de los pools de kardex. Un __main__ cuyo __spec__ se llama así no se reimporta en
+# los hijos: lo que corre en los pools está en kardex, que el servidor de forkserver ya cargó
+__spec__ = ModuleSpec("__main__", None)
 
 # Configuración de la página
 st.set_page_config(
@@ -52,7 +71,7 @@ TARIFAS = {
 }
 
 # ============================================
-# CONEXIÓN A GOOGLE SHEETS
+# CONEXIÓN Y MOTORES DE ALMACENAMIENTO
 # ============================================
 @st.cache_resource
 def conectar_google_sheets():
@@ -68,191 +87,401 @@ def conectar_google_sheets():
     client = gspread.authorize(creds)
     return client
 
-def obtener_hojas():
-    """Obtiene las hojas de clientes y pagos."""
-    client = conectar_google_sheets()
-    spreadsheet = client.open("viaje_san_juan_data")
-    hoja_clientes = spreadsheet.worksheet("clientes")
-    hoja_pagos = spreadsheet.worksheet("pagos")
-    return hoja_clientes, hoja_pagos
+@st.cache_resource
+def obtener_limitador():
+    """Limitador de cuota compartido por todas las sesiones del proceso."""
+    return LimitadorCuota()
+
+@st.cache_resource
+def obtener_cache_hojas():
+    """Cache de handles compartido por todas las sesiones del proceso."""
+    return CacheHojas("viaje_san_juan_data", obtener_limitador(), conectar_google_sheets, conectar_google_sheets.clear)
+
+@st.cache_resource
+def obtener_almacenamiento():
+    """Crea el motor de almacenamiento elegido en st.secrets (sección [almacenamiento])."""
+    config = st.secrets.get("almacenamiento", {})
+    motor = config.get("motor", "sheets")
+    if motor == "sheets":
+        return AlmacenamientoSheets(obtener_cache_hojas())
+    if motor == "sqlite":
+        return AlmacenamientoSQLite(config.get("ruta", "viaje_san_juan.db"))
+    raise ValueError(f"Motor de almacenamiento desconocido: {motor}")
+
+@st.cache_resource
+def obtener_reserva_ids():
+    """Reserva de IDs compartida por todas las sesiones del proceso."""
+    return ReservaIds(obtener_almacenamiento())
 
 # ============================================
 # FUNCIONES DE LECTURA/ESCRITURA EN GOOGLE SHEETS
 # ============================================
 def cargar_datos_sheets():
-    """Carga todos los datos desde Google Sheets y los convierte al formato interno."""
-    try:
-        hoja_clientes, hoja_pagos = obtener_hojas()
-        
-        # Leer clientes
-        registros_clientes = hoja_clientes.get_all_records()
-        
-        # Leer pagos
-        registros_pagos = hoja_pagos.get_all_records()
-        
-        # Construir estructura de datos interna
-        clientes = {}
-        for row in registros_clientes:
-            cid = str(row['cliente_id'])
-            clientes[cid] = {
-                'nombre': str(row.get('nombre', '')),
-                'telefono': str(row.get('telefono', '')),
-                'email': str(row.get('email', '')),
-                'asientos': int(row.get('asientos', 0)),
-                'habitaciones': {
-                    'sencillas': int(row.get('hab_sencillas', 0)),
-                    'dobles': int(row.get('hab_dobles', 0)),
-                    'triples': int(row.get('hab_triples', 0)),
-                },
-                'total_a_pagar': float(row.get('total_a_pagar', 0)),
-                'total_pagado': float(row.get('total_pagado', 0)),
-                'saldo_pendiente': float(row.get('saldo_pendiente', 0)),
-                'notas': str(row.get('notas', '')),
-                'fecha_registro': str(row.get('fecha_registro', '')),
-                'pagos': []
-            }
-        
-        # Asignar pagos a cada cliente
-        for pago_row in registros_pagos:
-            cid = str(pago_row['cliente_id'])
-            if cid in clientes:
-                clientes[cid]['pagos'].append({
-                    'fecha': str(pago_row.get('fecha', '')),
-                    'monto': float(pago_row.get('monto', 0)),
-                    'metodo': str(pago_row.get('metodo', '')),
-                    'referencia': str(pago_row.get('referencia', '')),
-                    'notas': str(pago_row.get('notas', '')),
-                    'timestamp': str(pago_row.get('timestamp', ''))
-                })
-        
-        return {'clientes': clientes, 'configuracion': TARIFAS, 'fecha_viaje': None}
-    
-    except Exception as e:
-        st.error(f"❌ Error al conectar con Google Sheets: {e}")
-        return {'clientes': {}, 'configuracion': TARIFAS, 'fecha_viaje': None}
+    """Carga los datos del viaje del almacenamiento elegido (ver modelo.cargar_datos)."""
+    return cargar_datos(obtener_almacenamiento(), TARIFAS)
 
-def guardar_cliente_sheets(cliente_id, cliente):
-    """Guarda o actualiza un cliente en Google Sheets."""
-    hoja_clientes, _ = obtener_hojas()
-    
-    fila = [
-        cliente_id,
-        cliente['nombre'],
-        cliente['telefono'],
-        cliente['email'],
-        cliente['asientos'],
-        cliente['habitaciones']['sencillas'],
-        cliente['habitaciones']['dobles'],
-        cliente['habitaciones']['triples'],
-        cliente['total_a_pagar'],
-        cliente['total_pagado'],
-        cliente['saldo_pendiente'],
-        cliente['notas'],
-        cliente['fecha_registro']
-    ]
-    
-    # Buscar si el cliente ya existe
+def cargar_historial(cliente_id):
+    """Lee del almacenamiento el libro de eventos de un solo cliente."""
+    return historial_desde_registros(obtener_almacenamiento().leer_pagos_cliente(cliente_id))
+
+def leer_libro_completo():
+    """{cliente_id: [Pago]} con el libro de pagos completo, para exportaciones y respaldos."""
+    _, tabla_pagos, _ = obtener_almacenamiento().leer_registros()
+    pagos = marco_pagos(tabla_pagos)
+    lista_pagos = pagos_desde_marco(pagos)
+    return {
+        cid: [lista_pagos[i] for i in posiciones]
+        for cid, posiciones in pagos.groupby('cliente_id', sort=False).indices.items()
+    }
+
+def datos_vacios():
+    """Estructura de datos sin clientes, para cuando no se pudo cargar nada."""
+    return {'clientes': {}, 'totales': TotalesViaje(), 'configuracion': TARIFAS, 'fecha_viaje': None}
+
+def datos_a_json(datos, libro):
+    """Vista de datos con clientes y pagos como diccionarios, lista para json.dumps (respaldo).
+
+    libro es {cliente_id: [Pago]} con el libro completo (leer_libro_completo()).
+    """
+    return {
+        'clientes': {
+            cid: {**c.a_dict(), 'pagos': [p.a_dict() for p in libro.get(cid, [])]}
+            for cid, c in datos['clientes'].items()
+        },
+        'configuracion': datos['configuracion'],
+        'fecha_viaje': datos['fecha_viaje']
+    }
+
+# Formato de número de las celdas de dinero en los reportes de Excel
+FORMATO_MONEDA = '"$"#,##0.00'
+
+def escribir_reporte_excel(destino, datos):
+    """Escribe en destino (archivo abierto en modo binario) el reporte completo del viaje.
+
+    El libro de Excel es de solo escritura: cada fila se manda al archivo al agregarla, y el
+    libro de pagos se recorre una vez por bloques con iterar_pagos(), así que la memoria no
+    crece con el número de pagos. Los montos son celdas numéricas con formato de moneda.
+    """
+    libro = Workbook(write_only=True)
+    negritas = Font(bold=True)
+
+    def encabezados(hoja, titulos):
+        fila = []
+        for titulo in titulos:
+            celda = WriteOnlyCell(hoja, value=titulo)
+            celda.font = negritas
+            fila.append(celda)
+        hoja.append(fila)
+
+    def moneda(hoja, valor):
+        celda = WriteOnlyCell(hoja, value=valor)
+        celda.number_format = FORMATO_MONEDA
+        return celda
+
+    hoja = libro.create_sheet('Clientes')
+    encabezados(hoja, ['ID', 'Nombre', 'Teléfono', 'Email', 'Asientos', 'Hab. Sencillas', 'Hab. Dobles',
+                       'Hab. Triples', 'Total a Pagar', 'Total Pagado', 'Saldo Pendiente', 'Fecha Registro'])
+    for cid, c in datos['clientes'].items():
+        hoja.append([
+            cid, c.nombre, c.telefono, c.email, c.asientos, c.hab_sencillas, c.hab_dobles, c.hab_triples,
+            moneda(hoja, c.total_a_pagar), moneda(hoja, c.total_pagado), moneda(hoja, c.saldo_pendiente),
+            c.fecha_registro
+        ])
+
+    # Una hoja de solo escritura no permite quitar filas ya escritas, y un pago puede revertirse
+    # más adelante en el libro. El libro se lee una sola vez: los pagos se apartan en una base
+    # SQLite temporal (ruta '': vive en disco y se borra al cerrarla) mientras se juntan los
+    # revertidos (solo sus IDs), y después se escriben los vigentes en el orden del libro.
+    apartados = sqlite3.connect('')
     try:
-        celda = hoja_clientes.find(cliente_id, in_column=1)
-        # Actualizar fila existente
-        rango = f"A{celda.row}:M{celda.row}"
-        hoja_clientes.update(rango, [fila])
-    except Exception:
-        # Agregar nueva fila
-        hoja_clientes.append_row(fila)
+        apartados.execute(
+            "CREATE TABLE pagos (pago_id, cliente_id, nombre, fecha, monto, metodo, referencia, notas, timestamp)"
+        )
+        revertidos = set()
+        for bloque in obtener_almacenamiento().iterar_pagos():
+            filas = []
+            for registro, pago in zip(bloque, historial_desde_registros(bloque)):
+                if pago.tipo == TIPO_REVERSO:
+                    revertidos.add(pago.revierte)
+                    continue
+                cliente = datos['clientes'].get(str(registro['cliente_id']))
+                if cliente is not None:
+                    filas.append((
+                        pago.pago_id, str(registro['cliente_id']), cliente.nombre, pago.fecha, pago.monto,
+                        pago.metodo, pago.referencia, pago.notas, pago.timestamp
+                    ))
+            apartados.executemany("INSERT INTO pagos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", filas)
+        hoja = libro.create_sheet('Pagos')
+        encabezados(hoja, ['Cliente ID', 'Cliente', 'Fecha', 'Monto', 'Método', 'Referencia', 'Notas', 'Timestamp'])
+        for pago_id, cid, nombre, fecha, monto, metodo, referencia, notas, timestamp in apartados.execute(
+            "SELECT * FROM pagos ORDER BY rowid"
+        ):
+            if pago_id not in revertidos:
+                hoja.append([cid, nombre, fecha, moneda(hoja, monto), metodo, referencia, notas, timestamp])
+    finally:
+        apartados.close()
+
+    totales = datos['totales']
+    hoja = libro.create_sheet('Resumen Financiero')
+    encabezados(hoja, ['Concepto', 'Cantidad', 'Tarifa', 'Total'])
+    for concepto, cantidad, tarifa in (
+        ('Transporte', totales.asientos, TARIFAS['transporte']),
+        ('Habitaciones Sencillas', totales.hab_sencillas, TARIFAS['habitacion_sencilla']),
+        ('Habitaciones Dobles', totales.hab_dobles, TARIFAS['habitacion_doble']),
+        ('Habitaciones Triples', totales.hab_triples, TARIFAS['habitacion_triple']),
+    ):
+        hoja.append([concepto, cantidad, moneda(hoja, tarifa), moneda(hoja, cantidad * tarifa)])
+    hoja.append(['TOTAL', '-', '-', moneda(hoja, totales.presupuesto)])
+
+    libro.save(destino)
+
+def guardar_cliente_sheets(cliente_id, cliente, version_leida=None):
+    """Guarda o actualiza un cliente; lanza ConflictoVersion si otra sesión lo cambió desde version_leida.
+
+    Devuelve el comprobante que se pasa a confirmar_escrituras().
+    """
+    return guardar_cliente(obtener_almacenamiento(), cliente_id, cliente, version_leida)
 
 def eliminar_cliente_sheets(cliente_id):
-    """Elimina un cliente y sus pagos de Google Sheets."""
-    hoja_clientes, hoja_pagos = obtener_hojas()
-    
-    # Eliminar de hoja clientes
-    try:
-        celda = hoja_clientes.find(cliente_id, in_column=1)
-        hoja_clientes.delete_rows(celda.row)
-    except Exception:
-        pass
-    
-    # Eliminar pagos del cliente
-    try:
-        registros_pagos = hoja_pagos.get_all_records()
-        filas_a_eliminar = []
-        for idx, pago in enumerate(registros_pagos, start=2):  # start=2 porque fila 1 son encabezados
-            if str(pago['cliente_id']) == cliente_id:
-                filas_a_eliminar.append(idx)
-        
-        # Eliminar de abajo hacia arriba para no alterar los índices
-        for fila in sorted(filas_a_eliminar, reverse=True):
-            hoja_pagos.delete_rows(fila)
-    except Exception:
-        pass
+    """Elimina un cliente del almacenamiento; sus eventos se quedan en el libro de pagos."""
+    obtener_almacenamiento().eliminar_cliente(cliente_id)
 
 def agregar_pago_sheets(cliente_id, pago):
-    """Agrega un pago a Google Sheets."""
-    _, hoja_pagos = obtener_hojas()
-    
-    fila = [
-        cliente_id,
-        pago['fecha'],
-        pago['monto'],
-        pago['metodo'],
-        pago['referencia'],
-        pago['notas'],
-        pago.get('timestamp', '')
-    ]
-    
-    hoja_pagos.append_row(fila)
+    """Agrega un evento (pago o reverso) al libro de pagos; devuelve el comprobante para confirmar_escrituras()."""
+    return obtener_almacenamiento().agregar_pago(pago.a_fila(cliente_id))
 
-def eliminar_pago_sheets(cliente_id, indice_pago):
-    """Elimina un pago específico de Google Sheets."""
-    _, hoja_pagos = obtener_hojas()
-    
-    registros_pagos = hoja_pagos.get_all_records()
-    contador = 0
-    for idx, pago in enumerate(registros_pagos, start=2):
-        if str(pago['cliente_id']) == cliente_id:
-            if contador == indice_pago:
-                hoja_pagos.delete_rows(idx)
-                return
-            contador += 1
-
-def actualizar_totales_cliente(cliente_id, total_pagado, saldo_pendiente):
-    """Actualiza solo los totales de pago de un cliente."""
-    hoja_clientes, _ = obtener_hojas()
-    
+def confirmar_escrituras(comprobantes=()):
+    """Envía las escrituras pendientes; muestra el error y devuelve False si alguna de comprobantes no se guardó.
+
+    Sin comprobantes solo vacía la cola: los errores de escrituras ajenas los ve quien las hizo.
+    """
     try:
-        celda = hoja_clientes.find(cliente_id, in_column=1)
-        # Columnas J (total_pagado) y K (saldo_pendiente) = columnas 10 y 11
-        hoja_clientes.update_cell(celda.row, 10, total_pagado)
-        hoja_clientes.update_cell(celda.row, 11, saldo_pendiente)
-    except Exception:
-        pass
+        obtener_almacenamiento().confirmar([c for c in comprobantes if c is not None])
+        return True
+    except Exception as e:
+        st.error(f"❌ Error al guardar en el almacenamiento: {e}")
+        return False
 
 # ============================================
 # INICIALIZAR DATOS
 # ============================================
+@st.cache_resource
+def obtener_instantanea():
+    """Instantánea de datos única para todo el proceso."""
+    return InstantaneaDatos(cargar_datos_sheets, cargar_historial)
+
 def recargar_datos():
-    """Recarga datos desde Google Sheets al session_state."""
-    st.session_state.datos = cargar_datos_sheets()
+    """Trae a la instantánea compartida solo lo que cambió en el almacenamiento."""
+    try:
+        st.session_state.version_datos = obtener_instantanea().sincronizar(
+            lambda vistos: leer_cambios_datos(obtener_almacenamiento(), vistos), aplicar_cambios
+        )
+    except Exception as e:
+        st.error(f"❌ Error al sincronizar los datos: {e}")
+
+def publicar_cliente(cliente_id, cliente):
+    """Publica el cliente en la instantánea compartida y recuerda la versión en la sesión."""
+    st.session_state.version_datos = obtener_instantanea().guardar_cliente(cliente_id, cliente)
+
+def retirar_cliente(cliente_id):
+    """Quita el cliente de la instantánea compartida y recuerda la versión en la sesión."""
+    st.session_state.version_datos = obtener_instantanea().eliminar_cliente(cliente_id)
 
-if 'datos' not in st.session_state:
-    recargar_datos()
+def refrescar_cliente(cliente_id):
+    """Relee del almacenamiento solo la fila de este cliente y la publica; None si ya no existe."""
+    registro = obtener_almacenamiento().leer_cliente(cliente_id)
+    if registro is None:
+        retirar_cliente(cliente_id)
+        return None
+    # publicar_cliente conserva el total pagado publicado, que va más adelante que la instantánea
+    cliente = clientes_desde_registros([registro], [], sobre_instantanea=True)[cliente_id]
+    publicar_cliente(cliente_id, cliente)
+    return cliente
 
-datos = st.session_state.datos
+def historial_pagos(cliente_id):
+    """Libro de eventos de un cliente; se lee del almacenamiento solo si no está en el LRU."""
+    return obtener_instantanea().historiales.obtener(cliente_id)
+
+@st.cache_resource
+def obtener_cache_kardex():
+    """Caché de kardex generados del proceso; se ajusta en st.secrets ([kardex] cache_mb, directorio, disco_mb)."""
+    config = st.secrets.get("kardex", {})
+    return CacheKardex(
+        int(config.get("cache_mb", 64)) * 1024 * 1024,
+        config.get("directorio"),
+        int(config.get("disco_mb", 512)) * 1024 * 1024
+    )
+
+@st.cache_resource
+def obtener_pool_render():
+    """Pool de procesos del proceso para generar varios archivos a la vez; None con un solo núcleo."""
+    return crear_pool_render()
+
+def kardex_de_cliente(formatos, cliente_id, cliente):
+    """{formato: bytes} del kardex del cliente ('pdf', 'excel'); solo se genera lo que cambió
+    desde la última vez, y varios formatos se generan al mismo tiempo."""
+    pagos = [asdict(p) for p in pagos_vigentes(historial_pagos(cliente_id))]
+    argumentos = (obtener_cache_kardex(), formatos, cliente_id, asdict(cliente), pagos, TARIFAS)
+    try:
+        return kardex_cacheados(*argumentos, pool=obtener_pool_render())
+    except BrokenExecutor:
+        # Murió un proceso del pool (por ejemplo, sin memoria): se cambia por uno nuevo y esta vez se genera aquí
+        obtener_pool_render().shutdown(wait=False)
+        obtener_pool_render.clear()
+        return kardex_cacheados(*argumentos)
+
+def registrar_evento(cliente_id, evento):
+    """Agrega un evento al libro de pagos con una sola escritura y lo aplica al cliente publicado.
+
+    No compara versiones: agregar al libro no pisa a nadie. Devuelve el cliente con el saldo
+    recalculado, o None si no se pudo guardar (el error ya se mostró).
+    """
+    comprobante = agregar_pago_sheets(cliente_id, evento)
+    if not confirmar_escrituras([comprobante]):
+        return None
+    st.session_state.version_datos, cliente = obtener_instantanea().registrar_evento(cliente_id, evento)
+    return cliente
+
+def escribir_cliente(cliente_id, cliente, modificar, escribir, intentos=3):
+    """Escribe una copia de cliente modificada con modificar(copia) mediante escribir(cliente_id, copia, version_leida).
+
+    Si otra sesión cambió el cliente entre la lectura y la escritura, relee solo ese cliente,
+    vuelve a aplicar modificar sobre lo releído y reintenta. Devuelve (cliente escrito, comprobante
+    de escribir); si otra sesión lo eliminó o se agotaron los intentos, muestra el error y devuelve (None, None).
+    """
+    try:
+        return reintentar_escritura(cliente_id, cliente, modificar, escribir, refrescar_cliente, intentos)
+    except ClienteEliminado:
+        st.error("❌ Otra sesión eliminó este cliente")
+    except ConflictoVersion:
+        st.error("❌ Otra sesión sigue modificando este cliente; intenta de nuevo")
+    return None, None
+
+# ============================================
+# CONCILIACIÓN DE SALDOS
+# ============================================
+# El libro de pagos es la fuente de verdad; total_pagado y saldo_pendiente de la hoja de
+# clientes son una instantánea que se pone al día aquí, no en cada pago. La carga en frío
+# parte de ella y solo lee los eventos posteriores a su marca.
+def conciliar_y_corregir():
+    """Escribe una instantánea nueva desde el libro completo y recarga los datos compartidos a partir de ella.
+
+    Devuelve (clientes corregidos, eventos de clientes eliminados).
+    """
+    almacenamiento = obtener_almacenamiento()
+    diferencias, pagos_huerfanos, marca = revisar_saldos(almacenamiento)
+    # La marca avanza aunque no haya diferencias: el siguiente arranque lee menos del libro
+    corregir_saldos(almacenamiento, diferencias, marca)
+    obtener_instantanea().recargar()
+    return len(diferencias), pagos_huerfanos
+
+def segundos_hasta(hora):
+    """Segundos desde ahora hasta la próxima vez que el reloj marque hora:00."""
+    ahora = datetime.now()
+    siguiente = ahora.replace(hour=hora, minute=0, second=0, microsecond=0)
+    if siguiente <= ahora:
+        siguiente += timedelta(days=1)
+    return (siguiente - ahora).total_seconds()
+
+class ConciliacionNocturna:
+    """Ejecuta conciliar_y_corregir() una vez al día a la hora indicada, en un hilo de fondo.
+
+    Es el punto de control periódico de la instantánea de saldos en la hoja de clientes.
+    Cada proceso programa la suya; el turno de conciliación del almacenamiento deja escribir
+    a uno solo y los demás se saltan esa noche. Con hora=None no programa nada y solo queda
+    conciliar() para los botones de Configuración.
+    """
+    # Más que lo que tarda una conciliación; si el proceso muere, el turno se libera al vencer
+    DURACION_TURNO = 30 * 60
+
+    def __init__(self, hora=None):
+        self.hora = hora
+        self.ultimo_resultado = None
+        self.ultimo_error = None
+        self._temporizador = None
+        # Dos instantáneas escritas a la vez podrían dejar la marca de una con los saldos de la otra
+        self._lock = threading.Lock()
+        self._titular = uuid.uuid4().hex
+        if hora is not None:
+            self._programar()
+
+    def conciliar(self):
+        """conciliar_y_corregir() sin cruzarse con la ejecución programada, otra sesión ni otro proceso.
+
+        Lanza TurnoOcupado si otro proceso está conciliando.
+        """
+        with self._lock:
+            almacenamiento = obtener_almacenamiento()
+            if not almacenamiento.tomar_turno_conciliacion(self._titular, self.DURACION_TURNO):
+                raise TurnoOcupado()
+            try:
+                return conciliar_y_corregir()
+            finally:
+                almacenamiento.soltar_turno_conciliacion(self._titular)
+
+    def _programar(self):
+        self._temporizador = threading.Timer(segundos_hasta(self.hora), self._ejecutar)
+        self._temporizador.daemon = True
+        self._temporizador.start()
+
+    def _ejecutar(self):
+        try:
+            self.ultimo_resultado = (datetime.now(), *self.conciliar())
+            self.ultimo_error = None
+        except TurnoOcupado:
+            # Otro proceso escribe la instantánea de esta noche; la sincronización la trae aquí
+            pass
+        except Exception as e:
+            # Se vuelve a intentar la noche siguiente; el error queda visible en Configuración
+            self.ultimo_error = e
+        self._programar()
+
+@st.cache_resource
+def obtener_conciliacion_nocturna():
+    """Conciliación del proceso; la nocturna va por defecto a las 3 ([conciliacion] hora en st.secrets).
+
+    Cada proceso que importa la app crea la suya y todas se turnan en el almacenamiento.
+    Se desactiva con [conciliacion] nocturna = false.
+    """
+    config = st.secrets.get("conciliacion", {})
+    # Los pagos ya no escriben totales: sin este punto de control la marca de la instantánea no
+    # avanza y cada arranque en frío lee un tramo del libro más largo
+    if not config.get("nocturna", True):
+        return ConciliacionNocturna()
+    return ConciliacionNocturna(int(config.get("hora", 3)))
+
+try:
+    version_datos, datos = obtener_instantanea().obtener()
+except Exception as e:
+    st.error(f"❌ Error al cargar los datos: {e}")
+    version_datos, datos = None, datos_vacios()
+
+# Otra sesión publicó cambios desde la última vez que esta sesión vio los datos
+if version_datos is not None:
+    version_vista = st.session_state.get('version_datos')
+    if version_vista is not None and version_vista != version_datos:
+        st.toast("🔄 Se cargaron cambios hechos desde otra sesión")
+    st.session_state.version_datos = version_datos
+
+obtener_conciliacion_nocturna()
+# El pool de render (y con él el servidor de forkserver) arranca con la app, una vez por proceso
+obtener_pool_render()
 
 # Función para generar ID único
 def generar_id():
-    if not datos['clientes']:
-        return "CLI001"
-    ids_numericos = []
-    for k in datos['clientes'].keys():
-        try:
-            ids_numericos.append(int(k[3:]))
-        except ValueError:
-            continue
-    if not ids_numericos:
-        return "CLI001"
-    ultimo_id = max(ids_numericos)
-    return f"CLI{str(ultimo_id + 1).zfill(3)}"
+    """Siguiente ID de cliente del bloque reservado (sin recorrer los clientes existentes)."""
+    return obtener_reserva_ids().siguiente()
+
+def clave_fecha_registro(fecha_registro):
+    """Clave ordenable de una fecha "%d/%m/%Y %H:%M:%S" sin convertirla a datetime."""
+    return fecha_registro[6:10] + fecha_registro[3:5] + fecha_registro[0:2] + fecha_registro[10:]
+
+# Órdenes de la lista de clientes: etiqueta -> (clave(cliente_id, cliente), descendente)
+ORDENES_CLIENTES = {
+    "Saldo pendiente": (lambda cid, c: c.saldo_pendiente, True),
+    "Nombre": (lambda cid, c: normalizar_texto(c.nombre), False),
+    "Fecha de registro": (lambda cid, c: clave_fecha_registro(c.fecha_registro), True),
+}
 
 # Función para calcular total
 def calcular_total(asientos, hab_sencillas, hab_dobles, hab_triples):
@@ -262,298 +491,6 @@ def calcular_total(asientos, hab_sencillas, hab_dobles, hab_triples):
              hab_triples * TARIFAS['habitacion_triple'])
     return total
 
-# Función para generar PDF de kardex
-def generar_kardex_pdf(cliente_id, cliente):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
-    
-    styles = getSampleStyleSheet()
-    titulo_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        textColor=colors.HexColor('#1f4788'),
-        spaceAfter=20,
-        alignment=TA_CENTER,
-        fontName='Helvetica-Bold'
-    )
-    
-    subtitulo_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor('#2c5aa0'),
-        spaceAfter=12,
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = styles['Normal']
-    
-    story = []
-    
-    titulo = Paragraph("🚌 KARDEX DE CLIENTE", titulo_style)
-    story.append(titulo)
-    story.append(Spacer(1, 0.2*inch))
-    
-    subtitulo = Paragraph(f"Viaje San Juan de los Lagos dia Miercoles 01 abril 2026", subtitulo_style)
-    story.append(subtitulo)
-    story.append(Spacer(1, 0.1*inch))
-    
-    fecha_generacion = Paragraph(f"<i>Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</i>", normal_style)
-    story.append(fecha_generacion)
-    story.append(Spacer(1, 0.3*inch))
-    
-    # SECCIÓN 1: INFORMACIÓN GENERAL
-    story.append(Paragraph("📋 INFORMACIÓN GENERAL", subtitulo_style))
-    story.append(Spacer(1, 0.1*inch))
-    
-    info_data = [
-        ['Campo', 'Información'],
-        ['ID Cliente:', cliente_id],
-        ['Nombre:', cliente['nombre']],
-        ['Teléfono:', cliente['telefono']],
-        ['Email:', cliente['email']],
-        ['Fecha de Registro:', cliente['fecha_registro']]
-    ]
-    
-    info_table = Table(info_data, colWidths=[2*inch, 4*inch])
-    info_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 11),
-        ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-    ]))
-    
-    story.append(info_table)
-    story.append(Spacer(1, 0.3*inch))
-    
-    # SECCIÓN 2: RESERVAS Y COSTOS
-    story.append(Paragraph("🎫 RESERVAS Y COSTOS", subtitulo_style))
-    story.append(Spacer(1, 0.1*inch))
-    
-    reservas_data = [
-        ['Concepto', 'Cantidad', 'Precio Unitario', 'Subtotal'],
-        ['Asientos de Transporte', 
-         str(cliente['asientos']), 
-         f"${TARIFAS['transporte']:,.2f}", 
-         f"${cliente['asientos'] * TARIFAS['transporte']:,.2f}"],
-        ['Habitaciones Sencillas', 
-         str(cliente['habitaciones']['sencillas']), 
-         f"${TARIFAS['habitacion_sencilla']:,.2f}", 
-         f"${cliente['habitaciones']['sencillas'] * TARIFAS['habitacion_sencilla']:,.2f}"],
-        ['Habitaciones Dobles', 
-         str(cliente['habitaciones']['dobles']), 
-         f"${TARIFAS['habitacion_doble']:,.2f}", 
-         f"${cliente['habitaciones']['dobles'] * TARIFAS['habitacion_doble']:,.2f}"],
-        ['Habitaciones Triples', 
-         str(cliente['habitaciones']['triples']), 
-         f"${TARIFAS['habitacion_triple']:,.2f}", 
-         f"${cliente['habitaciones']['triples'] * TARIFAS['habitacion_triple']:,.2f}"]
-    ]
-    
-    reservas_table = Table(reservas_data, colWidths=[2.5*inch, 1*inch, 1.5*inch, 1.5*inch])
-    reservas_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('ALIGN', (0, 1), (0, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-    ]))
-    
-    story.append(reservas_table)
-    story.append(Spacer(1, 0.3*inch))
-    
-    # SECCIÓN 3: ESTADO DE CUENTA
-    story.append(Paragraph("💰 ESTADO DE CUENTA", subtitulo_style))
-    story.append(Spacer(1, 0.1*inch))
-    
-    porcentaje_pagado = (cliente['total_pagado']/cliente['total_a_pagar']*100) if cliente['total_a_pagar'] > 0 else 0
-    porcentaje_pendiente = (cliente['saldo_pendiente']/cliente['total_a_pagar']*100) if cliente['total_a_pagar'] > 0 else 0
-    
-    cuenta_data = [
-        ['Concepto', 'Monto', 'Porcentaje'],
-        ['Total a Pagar', f"${cliente['total_a_pagar']:,.2f}", '100%'],
-        ['Total Pagado', f"${cliente['total_pagado']:,.2f}", f"{porcentaje_pagado:.1f}%"],
-        ['Saldo Pendiente', f"${cliente['saldo_pendiente']:,.2f}", f"{porcentaje_pendiente:.1f}%"]
-    ]
-    
-    cuenta_table = Table(cuenta_data, colWidths=[2.5*inch, 2*inch, 1.5*inch])
-    cuenta_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('ALIGN', (0, 1), (0, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 1), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (0, 1), colors.lightblue),
-        ('BACKGROUND', (0, 2), (0, 2), colors.lightgreen),
-        ('BACKGROUND', (0, 3), (0, 3), colors.lightyellow),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
-    
-    story.append(cuenta_table)
-    story.append(Spacer(1, 0.3*inch))
-    
-    # SECCIÓN 4: HISTORIAL DE PAGOS
-    if cliente['pagos']:
-        story.append(Paragraph("📜 HISTORIAL DE PAGOS", subtitulo_style))
-        story.append(Spacer(1, 0.1*inch))
-        
-        pagos_data = [['No.', 'Fecha', 'Monto', 'Método', 'Referencia', 'Saldo Restante']]
-        
-        saldo_acumulado = cliente['total_a_pagar']
-        for i, pago in enumerate(cliente['pagos'], 1):
-            saldo_acumulado -= pago['monto']
-            pagos_data.append([
-                str(i),
-                pago['fecha'],
-                f"${pago['monto']:,.2f}",
-                pago['metodo'],
-                pago['referencia'] or '-',
-                f"${saldo_acumulado:,.2f}"
-            ])
-        
-        pagos_table = Table(pagos_data, colWidths=[0.4*inch, 1*inch, 1.2*inch, 1.2*inch, 1.2*inch, 1.2*inch])
-        pagos_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 9),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-        ]))
-        
-        story.append(pagos_table)
-        story.append(Spacer(1, 0.2*inch))
-    
-    # Notas del cliente
-    if cliente.get('notas'):
-        story.append(Spacer(1, 0.2*inch))
-        story.append(Paragraph("📝 NOTAS DEL CLIENTE", subtitulo_style))
-        story.append(Spacer(1, 0.1*inch))
-        story.append(Paragraph(cliente['notas'], normal_style))
-    
-    # Footer
-    story.append(Spacer(1, 0.5*inch))
-    footer_style = ParagraphStyle(
-        'Footer',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=colors.grey,
-        alignment=TA_CENTER
-    )
-    story.append(Paragraph("_______________________________________________", footer_style))
-    story.append(Paragraph("Sistema de Gestión de Viajes - Viaje San Juan de los Lagos dia Miercoles 01 abril 2026 ", footer_style))
-    
-    doc.build(story)
-    buffer.seek(0)
-    return buffer
-
-# Función para generar Kardex de cliente en Excel
-def generar_kardex_cliente(cliente_id, cliente):
-    output = BytesIO()
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Hoja 1: Información General
-        info_general = {
-            'Campo': ['ID Cliente', 'Nombre', 'Teléfono', 'Email', 'Fecha de Registro'],
-            'Valor': [
-                cliente_id,
-                cliente['nombre'],
-                cliente['telefono'],
-                cliente['email'],
-                cliente['fecha_registro']
-            ]
-        }
-        pd.DataFrame(info_general).to_excel(writer, sheet_name='Información General', index=False)
-        
-        # Hoja 2: Resumen de Reservas
-        reservas = {
-            'Concepto': ['Asientos de Transporte', 'Habitaciones Sencillas', 'Habitaciones Dobles', 'Habitaciones Triples'],
-            'Cantidad': [
-                cliente['asientos'],
-                cliente['habitaciones']['sencillas'],
-                cliente['habitaciones']['dobles'],
-                cliente['habitaciones']['triples']
-            ],
-            'Precio Unitario': [
-                f"${TARIFAS['transporte']:,.2f}",
-                f"${TARIFAS['habitacion_sencilla']:,.2f}",
-                f"${TARIFAS['habitacion_doble']:,.2f}",
-                f"${TARIFAS['habitacion_triple']:,.2f}"
-            ],
-            'Subtotal': [
-                f"${cliente['asientos'] * TARIFAS['transporte']:,.2f}",
-                f"${cliente['habitaciones']['sencillas'] * TARIFAS['habitacion_sencilla']:,.2f}",
-                f"${cliente['habitaciones']['dobles'] * TARIFAS['habitacion_doble']:,.2f}",
-                f"${cliente['habitaciones']['triples'] * TARIFAS['habitacion_triple']:,.2f}"
-            ]
-        }
-        pd.DataFrame(reservas).to_excel(writer, sheet_name='Reservas y Costos', index=False)
-        
-        # Hoja 3: Estado de Cuenta
-        estado_cuenta = {
-            'Concepto': ['Total a Pagar', 'Total Pagado', 'Saldo Pendiente'],
-            'Monto': [
-                f"${cliente['total_a_pagar']:,.2f}",
-                f"${cliente['total_pagado']:,.2f}",
-                f"${cliente['saldo_pendiente']:,.2f}"
-            ],
-            'Porcentaje': [
-                '100%',
-                f"{(cliente['total_pagado']/cliente['total_a_pagar']*100):.1f}%" if cliente['total_a_pagar'] > 0 else '0%',
-                f"{(cliente['saldo_pendiente']/cliente['total_a_pagar']*100):.1f}%" if cliente['total_a_pagar'] > 0 else '0%'
-            ]
-        }
-        pd.DataFrame(estado_cuenta).to_excel(writer, sheet_name='Estado de Cuenta', index=False)
-        
-        # Hoja 4: Historial de Pagos
-        if cliente['pagos']:
-            pagos_detalle = []
-            saldo_acumulado = cliente['total_a_pagar']
-            
-            for i, pago in enumerate(cliente['pagos'], 1):
-                saldo_acumulado -= pago['monto']
-                pagos_detalle.append({
-                    'No.': i,
-                    'Fecha': pago['fecha'],
-                    'Monto Pagado': f"${pago['monto']:,.2f}",
-                    'Método': pago['metodo'],
-                    'Referencia': pago['referencia'],
-                    'Saldo Restante': f"${saldo_acumulado:,.2f}",
-                    'Notas': pago['notas']
-                })
-            
-            pd.DataFrame(pagos_detalle).to_excel(writer, sheet_name='Historial de Pagos', index=False)
-        
-        # Hoja 5: Notas del Cliente
-        if cliente.get('notas'):
-            notas_df = pd.DataFrame({
-                'Notas del Cliente': [cliente['notas']]
-            })
-            notas_df.to_excel(writer, sheet_name='Notas', index=False)
-    
-    output.seek(0)
-    return output
-
 # ============================================
 # INTERFAZ PRINCIPAL
 # ============================================
@@ -568,6 +505,10 @@ with st.sidebar:
         recargar_datos()
         st.success("✅ Datos actualizados")
         st.rerun()
+    
+    pendientes = obtener_almacenamiento().pendientes()
+    if pendientes:
+        st.caption(f"⏳ {pendientes} operaciones en espera de enviarse a Google Sheets")
 
 # Menú lateral
 menu = st.sidebar.selectbox(
@@ -587,18 +528,14 @@ if menu == "🏠 Dashboard":
     else:
         col1, col2, col3, col4 = st.columns(4)
         
-        total_clientes = len(datos['clientes'])
-        total_asientos = sum(c['asientos'] for c in datos['clientes'].values())
-        total_habitaciones = sum(
-            c['habitaciones']['sencillas'] + 
-            c['habitaciones']['dobles'] + 
-            c['habitaciones']['triples'] 
-            for c in datos['clientes'].values()
-        )
+        totales = datos['totales']
+        total_clientes = totales.clientes
+        total_asientos = totales.asientos
+        total_habitaciones = totales.habitaciones
         
-        presupuesto_total = sum(c['total_a_pagar'] for c in datos['clientes'].values())
-        total_recaudado = sum(c['total_pagado'] for c in datos['clientes'].values())
-        saldo_pendiente = presupuesto_total - total_recaudado
+        presupuesto_total = totales.presupuesto
+        total_recaudado = totales.recaudado
+        saldo_pendiente = totales.pendiente
         
         with col1:
             st.metric("👥 Total Clientes", total_clientes)
@@ -627,15 +564,15 @@ if menu == "🏠 Dashboard":
         
         clientes_list = []
         for cliente_id, cliente in datos['clientes'].items():
-            porcentaje_pago = (cliente['total_pagado'] / cliente['total_a_pagar'] * 100) if cliente['total_a_pagar'] > 0 else 0
+            porcentaje_pago = (cliente.total_pagado / cliente.total_a_pagar * 100) if cliente.total_a_pagar > 0 else 0
             clientes_list.append({
                 'ID': cliente_id,
-                'Cliente': cliente['nombre'],
-                'Total': f"${cliente['total_a_pagar']:,.2f}",
-                'Pagado': f"${cliente['total_pagado']:,.2f}",
-                'Pendiente': f"${cliente['saldo_pendiente']:,.2f}",
+                'Cliente': cliente.nombre,
+                'Total': f"${cliente.total_a_pagar:,.2f}",
+                'Pagado': f"${cliente.total_pagado:,.2f}",
+                'Pendiente': f"${cliente.saldo_pendiente:,.2f}",
                 'Avance': f"{porcentaje_pago:.1f}%",
-                'Estado': '✅ Liquidado' if cliente['saldo_pendiente'] == 0 else '⏳ Pendiente'
+                'Estado': '✅ Liquidado' if cliente.saldo_pendiente == 0 else '⏳ Pendiente'
             })
         
         df_clientes = pd.DataFrame(clientes_list)
@@ -644,8 +581,8 @@ if menu == "🏠 Dashboard":
         st.markdown("---")
         st.subheader("⚠️ Clientes con Saldo Pendiente")
         
-        pendientes = [c for c in clientes_list if '⏳' in c['Estado']]
-        if pendientes:
+        if totales.liquidados < totales.clientes:
+            pendientes = [c for c in clientes_list if '⏳' in c['Estado']]
             df_pendientes = pd.DataFrame(pendientes)
             st.dataframe(df_pendientes, use_container_width=True, hide_index=True)
         else:
@@ -686,31 +623,35 @@ elif menu == "➕ Nuevo Cliente":
                 st.error("❌ Debe seleccionar al menos un asiento o una habitación")
             else:
                 cliente_id = generar_id()
-                nuevo_cliente = {
-                    'nombre': nombre,
-                    'telefono': telefono,
-                    'email': email,
-                    'asientos': asientos,
-                    'habitaciones': {
-                        'sencillas': hab_sencillas,
-                        'dobles': hab_dobles,
-                        'triples': hab_triples
-                    },
-                    'total_a_pagar': total,
-                    'total_pagado': 0,
-                    'saldo_pendiente': total,
-                    'pagos': [],
-                    'notas': notas,
-                    'fecha_registro': datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                }
+                nuevo_cliente = Cliente(
+                    nombre=nombre,
+                    telefono=telefono,
+                    email=email,
+                    asientos=asientos,
+                    hab_sencillas=hab_sencillas,
+                    hab_dobles=hab_dobles,
+                    hab_triples=hab_triples,
+                    total_a_pagar=total,
+                    total_pagado=0,
+                    saldo_pendiente=total,
+                    notas=notas,
+                    fecha_registro=datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                )
                 
                 # Guardar en Google Sheets
                 with st.spinner("Guardando en Google Sheets..."):
-                    guardar_cliente_sheets(cliente_id, nuevo_cliente)
-                    datos['clientes'][cliente_id] = nuevo_cliente
+                    try:
+                        comprobante = guardar_cliente_sheets(cliente_id, nuevo_cliente)
+                        guardado = confirmar_escrituras([comprobante])
+                    except ConflictoVersion:
+                        # Otra sesión ya guardó un cliente con este ID; el siguiente intento toma otro
+                        st.error(f"❌ Ya existe un cliente con el ID {cliente_id}; intenta registrarlo de nuevo")
+                        guardado = False
                 
-                st.success(f"✅ Cliente {nombre} registrado exitosamente con ID: {cliente_id}")
-                st.balloons()
+                if guardado:
+                    publicar_cliente(cliente_id, nuevo_cliente)
+                    st.success(f"✅ Cliente {nombre} registrado exitosamente con ID: {cliente_id}")
+                    st.balloons()
 
 # ============================================
 # EDITAR/ELIMINAR CLIENTE
@@ -721,7 +662,7 @@ elif menu == "✏️ Editar/Eliminar Cliente":
     if not datos['clientes']:
         st.warning("⚠️ No hay clientes registrados.")
     else:
-        clientes_opciones = {f"{cid} - {c['nombre']}": cid for cid, c in datos['clientes'].items()}
+        clientes_opciones = {f"{cid} - {c.nombre}": cid for cid, c in datos['clientes'].items()}
         cliente_seleccionado = st.selectbox("👤 Seleccionar Cliente", list(clientes_opciones.keys()))
         cliente_id = clientes_opciones[cliente_seleccionado]
         cliente = datos['clientes'][cliente_id]
@@ -735,24 +676,24 @@ elif menu == "✏️ Editar/Eliminar Cliente":
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    nuevo_nombre = st.text_input("👤 Nombre Completo", value=cliente['nombre'])
-                    nuevo_telefono = st.text_input("📱 Teléfono", value=cliente['telefono'])
-                    nuevo_email = st.text_input("📧 Email", value=cliente['email'])
+                    nuevo_nombre = st.text_input("👤 Nombre Completo", value=cliente.nombre)
+                    nuevo_telefono = st.text_input("📱 Teléfono", value=cliente.telefono)
+                    nuevo_email = st.text_input("📧 Email", value=cliente.email)
                 
                 with col2:
-                    nuevos_asientos = st.number_input("🪑 Número de Asientos", min_value=0, value=cliente['asientos'], step=1)
+                    nuevos_asientos = st.number_input("🪑 Número de Asientos", min_value=0, value=cliente.asientos, step=1)
                     st.markdown("**🏨 Habitaciones:**")
-                    nuevas_sencillas = st.number_input("Sencillas", min_value=0, value=cliente['habitaciones']['sencillas'], step=1)
-                    nuevas_dobles = st.number_input("Dobles", min_value=0, value=cliente['habitaciones']['dobles'], step=1)
-                    nuevas_triples = st.number_input("Triples", min_value=0, value=cliente['habitaciones']['triples'], step=1)
+                    nuevas_sencillas = st.number_input("Sencillas", min_value=0, value=cliente.hab_sencillas, step=1)
+                    nuevas_dobles = st.number_input("Dobles", min_value=0, value=cliente.hab_dobles, step=1)
+                    nuevas_triples = st.number_input("Triples", min_value=0, value=cliente.hab_triples, step=1)
                 
-                nuevas_notas = st.text_area("📝 Notas", value=cliente.get('notas', ''))
+                nuevas_notas = st.text_area("📝 Notas", value=cliente.notas)
                 
                 nuevo_total = calcular_total(nuevos_asientos, nuevas_sencillas, nuevas_dobles, nuevas_triples)
                 st.info(f"💰 **Nuevo total a pagar: ${nuevo_total:,.2f}**")
                 
-                if nuevo_total != cliente['total_a_pagar']:
-                    st.warning(f"⚠️ El total cambió de ${cliente['total_a_pagar']:,.2f} a ${nuevo_total:,.2f}")
+                if nuevo_total != cliente.total_a_pagar:
+                    st.warning(f"⚠️ El total cambió de ${cliente.total_a_pagar:,.2f} a ${nuevo_total:,.2f}")
                 
                 submitted_editar = st.form_submit_button("💾 Guardar Cambios", type="primary", use_container_width=True)
                 
@@ -762,31 +703,36 @@ elif menu == "✏️ Editar/Eliminar Cliente":
                     elif nuevo_total == 0:
                         st.error("❌ Debe seleccionar al menos un asiento o una habitación")
                     else:
-                        datos['clientes'][cliente_id]['nombre'] = nuevo_nombre
-                        datos['clientes'][cliente_id]['telefono'] = nuevo_telefono
-                        datos['clientes'][cliente_id]['email'] = nuevo_email
-                        datos['clientes'][cliente_id]['asientos'] = nuevos_asientos
-                        datos['clientes'][cliente_id]['habitaciones']['sencillas'] = nuevas_sencillas
-                        datos['clientes'][cliente_id]['habitaciones']['dobles'] = nuevas_dobles
-                        datos['clientes'][cliente_id]['habitaciones']['triples'] = nuevas_triples
-                        datos['clientes'][cliente_id]['total_a_pagar'] = nuevo_total
-                        datos['clientes'][cliente_id]['saldo_pendiente'] = nuevo_total - cliente['total_pagado']
-                        datos['clientes'][cliente_id]['notas'] = nuevas_notas
+                        def aplicar_edicion(editado):
+                            editado.nombre = nuevo_nombre
+                            editado.telefono = nuevo_telefono
+                            editado.email = nuevo_email
+                            editado.asientos = nuevos_asientos
+                            editado.hab_sencillas = nuevas_sencillas
+                            editado.hab_dobles = nuevas_dobles
+                            editado.hab_triples = nuevas_triples
+                            editado.total_a_pagar = nuevo_total
+                            # Con el total pagado del libro, que otra sesión pudo haber cambiado
+                            editado.recalcular_saldo()
+                            editado.notas = nuevas_notas
                         
                         with st.spinner("Actualizando en Google Sheets..."):
-                            guardar_cliente_sheets(cliente_id, datos['clientes'][cliente_id])
+                            editado, comprobante = escribir_cliente(cliente_id, cliente, aplicar_edicion, guardar_cliente_sheets)
+                            guardado = editado is not None and confirmar_escrituras([comprobante])
                         
-                        st.success(f"✅ Cliente {nuevo_nombre} actualizado exitosamente")
-                        st.rerun()
+                        if guardado:
+                            publicar_cliente(cliente_id, editado)
+                            st.success(f"✅ Cliente {nuevo_nombre} actualizado exitosamente")
+                            st.rerun()
         
         with tab2:
             st.subheader("⚠️ Eliminar Cliente")
             
-            st.warning(f"**¿Estás seguro de eliminar al cliente {cliente['nombre']}?**")
+            st.warning(f"**¿Estás seguro de eliminar al cliente {cliente.nombre}?**")
             st.write(f"- ID: {cliente_id}")
-            st.write(f"- Total pagado: ${cliente['total_pagado']:,.2f}")
-            st.write(f"- Saldo pendiente: ${cliente['saldo_pendiente']:,.2f}")
-            st.write(f"- Pagos registrados: {len(cliente['pagos'])}")
+            st.write(f"- Total pagado: ${cliente.total_pagado:,.2f}")
+            st.write(f"- Saldo pendiente: ${cliente.saldo_pendiente:,.2f}")
+            st.write(f"- Pagos registrados: {len(pagos_vigentes(historial_pagos(cliente_id)))}")
             
             col1, col2 = st.columns(2)
             
@@ -795,11 +741,15 @@ elif menu == "✏️ Editar/Eliminar Cliente":
             
             with col2:
                 if st.button("🗑️ ELIMINAR CLIENTE", type="secondary", disabled=not confirmar, use_container_width=True):
-                    with st.spinner("Eliminando de Google Sheets..."):
-                        eliminar_cliente_sheets(cliente_id)
-                        del datos['clientes'][cliente_id]
-                    st.success(f"✅ Cliente eliminado exitosamente")
-                    st.rerun()
+                    try:
+                        with st.spinner("Eliminando de Google Sheets..."):
+                            eliminar_cliente_sheets(cliente_id)
+                    except Exception as e:
+                        st.error(f"❌ Error al eliminar el cliente: {e}")
+                    else:
+                        retirar_cliente(cliente_id)
+                        st.success(f"✅ Cliente eliminado exitosamente")
+                        st.rerun()
 
 # ============================================
 # REGISTRAR PAGO
@@ -810,8 +760,8 @@ elif menu == "💰 Registrar Pago":
     if not datos['clientes']:
         st.warning("⚠️ No hay clientes registrados. Primero agrega un cliente.")
     else:
-        clientes_opciones = {f"{cid} - {c['nombre']} (Saldo: ${c['saldo_pendiente']:,.2f})": cid 
-                            for cid, c in datos['clientes'].items() if c['saldo_pendiente'] > 0}
+        clientes_opciones = {f"{cid} - {c.nombre} (Saldo: ${c.saldo_pendiente:,.2f})": cid 
+                            for cid, c in datos['clientes'].items() if c.saldo_pendiente > 0}
         
         if not clientes_opciones:
             st.success("🎉 ¡Todos los clientes están liquidados!")
@@ -822,11 +772,11 @@ elif menu == "💰 Registrar Pago":
             
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("💵 Total a Pagar", f"${cliente['total_a_pagar']:,.2f}")
+                st.metric("💵 Total a Pagar", f"${cliente.total_a_pagar:,.2f}")
             with col2:
-                st.metric("✅ Total Pagado", f"${cliente['total_pagado']:,.2f}")
+                st.metric("✅ Total Pagado", f"${cliente.total_pagado:,.2f}")
             with col3:
-                st.metric("⏳ Saldo Pendiente", f"${cliente['saldo_pendiente']:,.2f}")
+                st.metric("⏳ Saldo Pendiente", f"${cliente.saldo_pendiente:,.2f}")
             
             st.markdown("---")
             
@@ -837,8 +787,8 @@ elif menu == "💰 Registrar Pago":
                     monto = st.number_input(
                         "💰 Monto del Pago", 
                         min_value=0.01, 
-                        max_value=float(cliente['saldo_pendiente']),
-                        value=float(cliente['saldo_pendiente']),
+                        max_value=float(cliente.saldo_pendiente),
+                        value=float(cliente.saldo_pendiente),
                         step=50.0
                     )
                     fecha_pago = st.date_input("📅 Fecha del Pago", value=date.today())
@@ -855,32 +805,30 @@ elif menu == "💰 Registrar Pago":
                 submitted_pago = st.form_submit_button("💾 Registrar Pago", type="primary", use_container_width=True)
                 
                 if submitted_pago:
-                    pago = {
-                        'fecha': fecha_pago.strftime("%d/%m/%Y"),
-                        'monto': monto,
-                        'metodo': metodo_pago,
-                        'referencia': referencia,
-                        'notas': notas_pago,
-                        'timestamp': datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    }
-                    
-                    cliente['pagos'].append(pago)
-                    cliente['total_pagado'] += monto
-                    cliente['saldo_pendiente'] = cliente['total_a_pagar'] - cliente['total_pagado']
+                    pago = Pago(
+                        fecha=fecha_pago.strftime("%d/%m/%Y"),
+                        monto=monto,
+                        metodo=metodo_pago,
+                        referencia=referencia,
+                        notas=notas_pago,
+                        timestamp=datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+                        pago_id=generar_pago_id()
+                    )
                     
                     with st.spinner("Guardando pago en Google Sheets..."):
-                        agregar_pago_sheets(cliente_id, pago)
-                        actualizar_totales_cliente(cliente_id, cliente['total_pagado'], cliente['saldo_pendiente'])
+                        # Una sola fila nueva en el libro de pagos; el saldo se deriva en memoria
+                        cliente = registrar_evento(cliente_id, pago)
                     
-                    st.success(f"✅ Pago de ${monto:,.2f} registrado exitosamente")
-                    
-                    if cliente['saldo_pendiente'] == 0:
-                        st.balloons()
-                        st.success(f"🎉 ¡{cliente['nombre']} ha liquidado completamente su viaje!")
-                    else:
-                        st.info(f"Saldo pendiente: ${cliente['saldo_pendiente']:,.2f}")
-                    
-                    st.rerun()
+                    if cliente is not None:
+                        st.success(f"✅ Pago de ${monto:,.2f} registrado exitosamente")
+                        
+                        if cliente.saldo_pendiente == 0:
+                            st.balloons()
+                            st.success(f"🎉 ¡{cliente.nombre} ha liquidado completamente su viaje!")
+                        else:
+                            st.info(f"Saldo pendiente: ${cliente.saldo_pendiente:,.2f}")
+                        
+                        st.rerun()
 
 # ============================================
 # ELIMINAR PAGO
@@ -891,8 +839,9 @@ elif menu == "🗑️ Eliminar Pago":
     if not datos['clientes']:
         st.warning("⚠️ No hay clientes registrados.")
     else:
-        clientes_con_pagos = {f"{cid} - {c['nombre']}": cid 
-                             for cid, c in datos['clientes'].items() if len(c['pagos']) > 0}
+        # Un total pagado positivo implica pagos vigentes; el historial se lee solo del cliente elegido
+        clientes_con_pagos = {f"{cid} - {c.nombre}": cid 
+                             for cid, c in datos['clientes'].items() if c.total_pagado > 0}
         
         if not clientes_con_pagos:
             st.info("ℹ️ No hay pagos registrados para eliminar.")
@@ -901,37 +850,39 @@ elif menu == "🗑️ Eliminar Pago":
             cliente_id = clientes_con_pagos[cliente_seleccionado]
             cliente = datos['clientes'][cliente_id]
             
-            st.subheader(f"Pagos de {cliente['nombre']}")
+            st.subheader(f"Pagos de {cliente.nombre}")
             
-            for idx, pago in enumerate(cliente['pagos']):
-                with st.expander(f"Pago #{idx+1} - ${pago['monto']:,.2f} - {pago['fecha']}"):
+            for idx, pago in enumerate(pagos_vigentes(historial_pagos(cliente_id))):
+                with st.expander(f"Pago #{idx+1} - ${pago.monto:,.2f} - {pago.fecha}"):
                     col1, col2 = st.columns([3, 1])
                     
                     with col1:
-                        st.write(f"**Fecha:** {pago['fecha']}")
-                        st.write(f"**Monto:** ${pago['monto']:,.2f}")
-                        st.write(f"**Método:** {pago['metodo']}")
-                        st.write(f"**Referencia:** {pago['referencia']}")
-                        st.write(f"**Notas:** {pago['notas']}")
-                        if pago.get('timestamp'):
-                            st.write(f"**Registrado:** {pago['timestamp']}")
+                        st.write(f"**Fecha:** {pago.fecha}")
+                        st.write(f"**Monto:** ${pago.monto:,.2f}")
+                        st.write(f"**Método:** {pago.metodo}")
+                        st.write(f"**Referencia:** {pago.referencia}")
+                        st.write(f"**Notas:** {pago.notas}")
+                        if pago.timestamp:
+                            st.write(f"**Registrado:** {pago.timestamp}")
                     
                     with col2:
-                        if st.button(f"🗑️ Eliminar", key=f"del_pago_{idx}", type="secondary"):
-                            monto_eliminado = pago['monto']
-                            
-                            with st.spinner("Eliminando pago de Google Sheets..."):
-                                eliminar_pago_sheets(cliente_id, idx)
-                            
-                            cliente['pagos'].pop(idx)
-                            cliente['total_pagado'] -= monto_eliminado
-                            cliente['saldo_pendiente'] = cliente['total_a_pagar'] - cliente['total_pagado']
+                        if st.button(f"🗑️ Eliminar", key=f"del_pago_{pago.pago_id}", type="secondary"):
+                            ahora = datetime.now()
+                            reverso = pago.reverso(ahora.strftime("%d/%m/%Y"), ahora.strftime("%d/%m/%Y %H:%M:%S"))
                             
-                            with st.spinner("Actualizando totales..."):
-                                actualizar_totales_cliente(cliente_id, cliente['total_pagado'], cliente['saldo_pendiente'])
+                            with st.spinner("Registrando el reverso en Google Sheets..."):
+                                # El historial guardado pudo quedar atrás: otra sesión pudo anular el pago ya
+                                vigentes = pagos_vigentes(obtener_instantanea().historiales.releer(cliente_id))
+                                if all(p.pago_id != pago.pago_id for p in vigentes):
+                                    guardado = False
+                                    st.warning("⚠️ Otra sesión ya eliminó este pago")
+                                else:
+                                    # El pago queda en el libro; el reverso lo anula con una sola fila nueva
+                                    guardado = registrar_evento(cliente_id, reverso) is not None
                             
-                            st.success(f"✅ Pago de ${monto_eliminado:,.2f} eliminado")
-                            st.rerun()
+                            if guardado:
+                                st.success(f"✅ Pago de ${pago.monto:,.2f} eliminado")
+                                st.rerun()
 
 # ============================================
 # VER CLIENTES
@@ -942,66 +893,116 @@ elif menu == "👥 Ver Clientes":
     if not datos['clientes']:
         st.info("👋 No hay clientes registrados aún.")
     else:
-        col1, col2 = st.columns([3, 1])
+        col1, col2, col3 = st.columns([3, 1, 1])
         with col1:
-            buscar = st.text_input("🔍 Buscar cliente", placeholder="Nombre, ID o teléfono...")
+            buscar = st.text_input("🔍 Buscar cliente", placeholder="Nombre, ID, teléfono o email...")
         with col2:
             filtro_estado = st.selectbox("Estado", ["Todos", "Liquidados", "Pendientes"])
+        with col3:
+            ordenes = list(ORDENES_CLIENTES)
+            if buscar:
+                ordenes.insert(0, "Relevancia")
+            orden = st.selectbox("Ordenar por", ordenes)
         
-        clientes_filtrados = datos['clientes'].copy()
-        
+        clientes = datos['clientes']
         if buscar:
-            clientes_filtrados = {
-                k: v for k, v in clientes_filtrados.items()
-                if buscar.lower() in v['nombre'].lower() or 
-                   buscar.lower() in k.lower() or
-                   buscar in v['telefono']
-            }
+            # Resultados ordenados por relevancia; el índice puede conocer clientes de una versión más nueva
+            ids = [cid for cid in obtener_instantanea().indice.buscar(buscar) if cid in clientes]
+        else:
+            ids = list(clientes)
         
         if filtro_estado == "Liquidados":
-            clientes_filtrados = {k: v for k, v in clientes_filtrados.items() if v['saldo_pendiente'] == 0}
+            ids = [cid for cid in ids if clientes[cid].saldo_pendiente == 0]
         elif filtro_estado == "Pendientes":
-            clientes_filtrados = {k: v for k, v in clientes_filtrados.items() if v['saldo_pendiente'] > 0}
+            ids = [cid for cid in ids if clientes[cid].saldo_pendiente > 0]
+        
+        if orden in ORDENES_CLIENTES:
+            clave, descendente = ORDENES_CLIENTES[orden]
+            ids.sort(key=lambda cid: clave(cid, clientes[cid]), reverse=descendente)
         
         st.markdown("---")
         
-        for cliente_id, cliente in clientes_filtrados.items():
-            with st.expander(f"**{cliente['nombre']}** - ID: {cliente_id} | Saldo: ${cliente['saldo_pendiente']:,.2f}"):
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    st.markdown("### 📋 Información General")
-                    st.write(f"**ID:** {cliente_id}")
-                    st.write(f"**Nombre:** {cliente['nombre']}")
-                    st.write(f"**Teléfono:** {cliente['telefono']}")
-                    st.write(f"**Email:** {cliente['email']}")
-                    st.write(f"**Fecha de registro:** {cliente['fecha_registro']}")
-                    if cliente['notas']:
-                        st.write(f"**Notas:** {cliente['notas']}")
-                    
-                    st.markdown("### 🪑 Reservas")
-                    st.write(f"**Asientos:** {cliente['asientos']}")
-                    st.write(f"**Habitaciones Sencillas:** {cliente['habitaciones']['sencillas']}")
-                    st.write(f"**Habitaciones Dobles:** {cliente['habitaciones']['dobles']}")
-                    st.write(f"**Habitaciones Triples:** {cliente['habitaciones']['triples']}")
+        if not ids:
+            st.info("No hay clientes que coincidan con la búsqueda")
+        else:
+            # Solo la página visible se convierte en tabla
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                tam_pagina = st.selectbox("Clientes por página", [25, 50, 100])
+            total_paginas = (len(ids) + tam_pagina - 1) // tam_pagina
+            with col2:
+                pagina = st.number_input("Página", min_value=1, max_value=total_paginas, value=1, step=1)
+            with col3:
+                inicio = (pagina - 1) * tam_pagina
+                st.caption(f"Mostrando {inicio + 1}-{min(inicio + tam_pagina, len(ids))} de {len(ids)} clientes")
+            ids_pagina = ids[inicio:inicio + tam_pagina]
+            
+            resumen = []
+            for cid in ids_pagina:
+                c = clientes[cid]
+                porcentaje = (c.total_pagado / c.total_a_pagar * 100) if c.total_a_pagar > 0 else 0
+                resumen.append({
+                    'ID': cid,
+                    'Cliente': c.nombre,
+                    'Teléfono': c.telefono,
+                    'Asientos': c.asientos,
+                    'Habitaciones': c.hab_sencillas + c.hab_dobles + c.hab_triples,
+                    'Total': f"${c.total_a_pagar:,.2f}",
+                    'Pagado': f"${c.total_pagado:,.2f}",
+                    'Pendiente': f"${c.saldo_pendiente:,.2f}",
+                    'Avance': f"{porcentaje:.1f}%",
+                    'Registro': c.fecha_registro
+                })
+            st.dataframe(pd.DataFrame(resumen), use_container_width=True, hide_index=True)
+            
+            st.markdown("---")
+            
+            # El detalle y el historial de pagos se construyen solo para el cliente elegido
+            opciones = {f"{cid} - {clientes[cid].nombre}": cid for cid in ids_pagina}
+            seleccion = st.selectbox("🔎 Ver detalle de", list(opciones.keys()))
+            cliente_id = opciones[seleccion]
+            cliente = clientes[cliente_id]
+            
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                st.markdown("### 📋 Información General")
+                st.write(f"**ID:** {cliente_id}")
+                st.write(f"**Nombre:** {cliente.nombre}")
+                st.write(f"**Teléfono:** {cliente.telefono}")
+                st.write(f"**Email:** {cliente.email}")
+                st.write(f"**Fecha de registro:** {cliente.fecha_registro}")
+                if cliente.notas:
+                    st.write(f"**Notas:** {cliente.notas}")
                 
-                with col2:
-                    st.markdown("### 💰 Estado Financiero")
-                    st.metric("Total a Pagar", f"${cliente['total_a_pagar']:,.2f}")
-                    st.metric("Total Pagado", f"${cliente['total_pagado']:,.2f}")
-                    st.metric("Saldo Pendiente", f"${cliente['saldo_pendiente']:,.2f}")
-                    
-                    porcentaje = (cliente['total_pagado'] / cliente['total_a_pagar'] * 100) if cliente['total_a_pagar'] > 0 else 0
-                    st.progress(porcentaje / 100, text=f"Pagado: {porcentaje:.1f}%")
+                st.markdown("### 🪑 Reservas")
+                st.write(f"**Asientos:** {cliente.asientos}")
+                st.write(f"**Habitaciones Sencillas:** {cliente.hab_sencillas}")
+                st.write(f"**Habitaciones Dobles:** {cliente.hab_dobles}")
+                st.write(f"**Habitaciones Triples:** {cliente.hab_triples}")
+            
+            with col2:
+                st.markdown("### 💰 Estado Financiero")
+                st.metric("Total a Pagar", f"${cliente.total_a_pagar:,.2f}")
+                st.metric("Total Pagado", f"${cliente.total_pagado:,.2f}")
+                st.metric("Saldo Pendiente", f"${cliente.saldo_pendiente:,.2f}")
                 
-                if cliente['pagos']:
-                    st.markdown("### 📜 Historial de Pagos")
-                    df_pagos = pd.DataFrame(cliente['pagos'])
-                    df_pagos['monto'] = df_pagos['monto'].apply(lambda x: f"${x:,.2f}")
-                    st.dataframe(df_pagos[['fecha', 'monto', 'metodo', 'referencia', 'notas']], 
-                               use_container_width=True, hide_index=True)
-                else:
-                    st.info("Sin pagos registrados aún")
+                porcentaje = (cliente.total_pagado / cliente.total_a_pagar * 100) if cliente.total_a_pagar > 0 else 0
+                st.progress(min(porcentaje / 100, 1.0), text=f"Pagado: {porcentaje:.1f}%")
+            
+            pagos = pagos_vigentes(historial_pagos(cliente_id))
+            if pagos:
+                st.markdown("### 📜 Historial de Pagos")
+                df_pagos = pd.DataFrame({
+                    'fecha': [p.fecha for p in pagos],
+                    'monto': [f"${p.monto:,.2f}" for p in pagos],
+                    'metodo': [p.metodo for p in pagos],
+                    'referencia': [p.referencia for p in pagos],
+                    'notas': [p.notas for p in pagos]
+                })
+                st.dataframe(df_pagos, use_container_width=True, hide_index=True)
+            else:
+                st.info("Sin pagos registrados aún")
 
 # ============================================
 # REPORTES
@@ -1014,14 +1015,16 @@ elif menu == "📊 Reportes":
     else:
         tab1, tab2, tab3 = st.tabs(["📈 Resumen General", "💰 Financiero", "🎫 Ocupación"])
         
+        totales = datos['totales']
+        total_asientos = totales.asientos
+        total_hab_sencillas = totales.hab_sencillas
+        total_hab_dobles = totales.hab_dobles
+        total_hab_triples = totales.hab_triples
+        
         with tab1:
             st.subheader("Resumen General del Viaje")
             
-            total_clientes = len(datos['clientes'])
-            total_asientos = sum(c['asientos'] for c in datos['clientes'].values())
-            total_hab_sencillas = sum(c['habitaciones']['sencillas'] for c in datos['clientes'].values())
-            total_hab_dobles = sum(c['habitaciones']['dobles'] for c in datos['clientes'].values())
-            total_hab_triples = sum(c['habitaciones']['triples'] for c in datos['clientes'].values())
+            total_clientes = totales.clientes
             
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -1038,9 +1041,9 @@ elif menu == "📊 Reportes":
         with tab2:
             st.subheader("Reporte Financiero")
             
-            presupuesto_total = sum(c['total_a_pagar'] for c in datos['clientes'].values())
-            total_recaudado = sum(c['total_pagado'] for c in datos['clientes'].values())
-            saldo_pendiente = presupuesto_total - total_recaudado
+            presupuesto_total = totales.presupuesto
+            total_recaudado = totales.recaudado
+            saldo_pendiente = totales.pendiente
             
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -1053,11 +1056,6 @@ elif menu == "📊 Reportes":
             st.markdown("---")
             st.subheader("💵 Desglose de Ingresos")
             
-            total_asientos = sum(c['asientos'] for c in datos['clientes'].values())
-            total_hab_sencillas = sum(c['habitaciones']['sencillas'] for c in datos['clientes'].values())
-            total_hab_dobles = sum(c['habitaciones']['dobles'] for c in datos['clientes'].values())
-            total_hab_triples = sum(c['habitaciones']['triples'] for c in datos['clientes'].values())
-            
             ingresos_transporte = total_asientos * TARIFAS['transporte']
             ingresos_sencillas = total_hab_sencillas * TARIFAS['habitacion_sencilla']
             ingresos_dobles = total_hab_dobles * TARIFAS['habitacion_doble']
@@ -1082,65 +1080,27 @@ elif menu == "📊 Reportes":
             
             st.markdown("---")
             if st.button("📥 Exportar Reporte Completo a Excel"):
-                output = BytesIO()
-                
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    clientes_export = []
-                    for cid, c in datos['clientes'].items():
-                        clientes_export.append({
-                            'ID': cid,
-                            'Nombre': c['nombre'],
-                            'Teléfono': c['telefono'],
-                            'Email': c['email'],
-                            'Asientos': c['asientos'],
-                            'Hab. Sencillas': c['habitaciones']['sencillas'],
-                            'Hab. Dobles': c['habitaciones']['dobles'],
-                            'Hab. Triples': c['habitaciones']['triples'],
-                            'Total a Pagar': c['total_a_pagar'],
-                            'Total Pagado': c['total_pagado'],
-                            'Saldo Pendiente': c['saldo_pendiente'],
-                            'Fecha Registro': c['fecha_registro']
-                        })
-                    pd.DataFrame(clientes_export).to_excel(writer, sheet_name='Clientes', index=False)
-                    
-                    pagos_export = []
-                    for cid, c in datos['clientes'].items():
-                        for pago in c['pagos']:
-                            pagos_export.append({
-                                'Cliente ID': cid,
-                                'Cliente': c['nombre'],
-                                'Fecha': pago['fecha'],
-                                'Monto': pago['monto'],
-                                'Método': pago['metodo'],
-                                'Referencia': pago['referencia'],
-                                'Notas': pago['notas'],
-                                'Timestamp': pago.get('timestamp', '')
-                            })
-                    if pagos_export:
-                        pd.DataFrame(pagos_export).to_excel(writer, sheet_name='Pagos', index=False)
-                    
-                    df_ingresos.to_excel(writer, sheet_name='Resumen Financiero', index=False)
-                
-                output.seek(0)
-                
-                st.download_button(
-                    label="⬇️ Descargar Reporte Excel",
-                    data=output,
-                    file_name=f"reporte_viaje_san_juan_{datetime.now().strftime('%d-%m-%Y')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-                st.success("✅ Reporte generado exitosamente")
+                try:
+                    # El reporte se escribe en un archivo temporal conforme se recorre el libro de pagos
+                    with tempfile.TemporaryFile() as archivo_reporte:
+                        with st.spinner("Generando reporte..."):
+                            escribir_reporte_excel(archivo_reporte, datos)
+                        archivo_reporte.seek(0)
+                        st.download_button(
+                            label="⬇️ Descargar Reporte Excel",
+                            data=archivo_reporte,
+                            file_name=f"reporte_viaje_san_juan_{datetime.now().strftime('%d-%m-%Y')}.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        )
+                    st.success("✅ Reporte generado exitosamente")
+                except Exception as e:
+                    st.error(f"❌ Error al generar el reporte: {e}")
         
         with tab3:
             st.subheader("🎫 Ocupación y Disponibilidad")
             
             st.info("📌 Esta sección te permitirá establecer capacidades máximas y ver disponibilidad")
             
-            total_asientos = sum(c['asientos'] for c in datos['clientes'].values())
-            total_hab_sencillas = sum(c['habitaciones']['sencillas'] for c in datos['clientes'].values())
-            total_hab_dobles = sum(c['habitaciones']['dobles'] for c in datos['clientes'].values())
-            total_hab_triples = sum(c['habitaciones']['triples'] for c in datos['clientes'].values())
-            
             col1, col2 = st.columns(2)
             with col1:
                 st.markdown("### 🚌 Transporte")
@@ -1169,7 +1129,7 @@ elif menu == "📄 Kardex Individual":
     if not datos['clientes']:
         st.warning("⚠️ No hay clientes registrados.")
     else:
-        clientes_opciones = {f"{cid} - {c['nombre']}": cid for cid, c in datos['clientes'].items()}
+        clientes_opciones = {f"{cid} - {c.nombre}": cid for cid, c in datos['clientes'].items()}
         cliente_seleccionado = st.selectbox("👤 Seleccionar Cliente para Kardex", list(clientes_opciones.keys()))
         cliente_id = clientes_opciones[cliente_seleccionado]
         cliente = datos['clientes'][cliente_id]
@@ -1177,11 +1137,11 @@ elif menu == "📄 Kardex Individual":
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("💵 Total a Pagar", f"${cliente['total_a_pagar']:,.2f}")
+            st.metric("💵 Total a Pagar", f"${cliente.total_a_pagar:,.2f}")
         with col2:
-            st.metric("✅ Total Pagado", f"${cliente['total_pagado']:,.2f}")
+            st.metric("✅ Total Pagado", f"${cliente.total_pagado:,.2f}")
         with col3:
-            st.metric("⏳ Saldo Pendiente", f"${cliente['saldo_pendiente']:,.2f}")
+            st.metric("⏳ Saldo Pendiente", f"${cliente.saldo_pendiente:,.2f}")
         
         st.markdown("---")
         
@@ -1216,62 +1176,116 @@ elif menu == "📄 Kardex Individual":
         
         col1, col2, col3 = st.columns(3)
         
+        # El botón solo marca qué se pidió: las descargas se vuelven a mostrar en cada rerun
+        # desde el caché de kardex, sin generar de nuevo mientras el cliente no cambie
         if formato == "📄 Solo PDF":
             with col2:
                 if st.button("📥 Generar PDF", type="primary", use_container_width=True):
+                    st.session_state.kardex_pedido = (cliente_id, formato)
+                if st.session_state.get('kardex_pedido') == (cliente_id, formato):
                     with st.spinner("Generando PDF..."):
-                        kardex_pdf = generar_kardex_pdf(cliente_id, cliente)
-                        
-                        st.download_button(
-                            label="⬇️ Descargar Kardex PDF",
-                            data=kardex_pdf,
-                            file_name=f"kardex_{cliente_id}_{cliente['nombre'].replace(' ', '_')}_{datetime.now().strftime('%d-%m-%Y')}.pdf",
-                            mime="application/pdf"
-                        )
-                        st.success(f"✅ Kardex PDF de {cliente['nombre']} generado exitosamente")
+                        kardex_pdf = kardex_de_cliente(['pdf'], cliente_id, cliente)['pdf']
+                    
+                    st.download_button(
+                        label="⬇️ Descargar Kardex PDF",
+                        data=kardex_pdf,
+                        file_name=nombre_kardex(cliente_id, cliente.nombre, 'pdf'),
+                        mime="application/pdf"
+                    )
+                    st.success(f"✅ Kardex PDF de {cliente.nombre} generado exitosamente")
         
         elif formato == "📊 Solo Excel":
             with col2:
                 if st.button("📥 Generar Excel", type="primary", use_container_width=True):
+                    st.session_state.kardex_pedido = (cliente_id, formato)
+                if st.session_state.get('kardex_pedido') == (cliente_id, formato):
                     with st.spinner("Generando Excel..."):
-                        kardex_excel = generar_kardex_cliente(cliente_id, cliente)
-                        
-                        st.download_button(
-                            label="⬇️ Descargar Kardex Excel",
-                            data=kardex_excel,
-                            file_name=f"kardex_{cliente_id}_{cliente['nombre'].replace(' ', '_')}_{datetime.now().strftime('%d-%m-%Y')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
-                        st.success(f"✅ Kardex Excel de {cliente['nombre']} generado exitosamente")
+                        kardex_excel = kardex_de_cliente(['excel'], cliente_id, cliente)['excel']
+                    
+                    st.download_button(
+                        label="⬇️ Descargar Kardex Excel",
+                        data=kardex_excel,
+                        file_name=nombre_kardex(cliente_id, cliente.nombre, 'xlsx'),
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    )
+                    st.success(f"✅ Kardex Excel de {cliente.nombre} generado exitosamente")
         
         else:
             with col2:
                 if st.button("📥 Generar Ambos Formatos", type="primary", use_container_width=True):
+                    st.session_state.kardex_pedido = (cliente_id, formato)
+                if st.session_state.get('kardex_pedido') == (cliente_id, formato):
                     with st.spinner("Generando PDF y Excel..."):
-                        kardex_pdf = generar_kardex_pdf(cliente_id, cliente)
-                        kardex_excel = generar_kardex_cliente(cliente_id, cliente)
-                        
-                        col_a, col_b = st.columns(2)
-                        
-                        with col_a:
-                            st.download_button(
-                                label="⬇️ Descargar PDF",
-                                data=kardex_pdf,
-                                file_name=f"kardex_{cliente_id}_{cliente['nombre'].replace(' ', '_')}_{datetime.now().strftime('%d-%m-%Y')}.pdf",
-                                mime="application/pdf",
-                                use_container_width=True
-                            )
-                        
-                        with col_b:
-                            st.download_button(
-                                label="⬇️ Descargar Excel",
-                                data=kardex_excel,
-                                file_name=f"kardex_{cliente_id}_{cliente['nombre'].replace(' ', '_')}_{datetime.now().strftime('%d-%m-%Y')}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                use_container_width=True
-                            )
-                        
-                        st.success(f"✅ Kardex de {cliente['nombre']} generado en ambos formatos exitosamente")
+                        generados = kardex_de_cliente(['pdf', 'excel'], cliente_id, cliente)
+                    
+                    col_a, col_b = st.columns(2)
+                    
+                    with col_a:
+                        st.download_button(
+                            label="⬇️ Descargar PDF",
+                            data=generados['pdf'],
+                            file_name=nombre_kardex(cliente_id, cliente.nombre, 'pdf'),
+                            mime="application/pdf",
+                            use_container_width=True
+                        )
+                    
+                    with col_b:
+                        st.download_button(
+                            label="⬇️ Descargar Excel",
+                            data=generados['excel'],
+                            file_name=nombre_kardex(cliente_id, cliente.nombre, 'xlsx'),
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                            use_container_width=True
+                        )
+                    
+                    st.success(f"✅ Kardex de {cliente.nombre} generado en ambos formatos exitosamente")
+        
+        st.markdown("---")
+        st.subheader("📦 Kardex de Varios Clientes")
+        st.write("Genera el kardex de todos los clientes elegidos en un solo archivo ZIP")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            filtro_masivo = st.selectbox("Clientes a incluir", ["Todos", "Con saldo pendiente", "Liquidados"])
+        with col2:
+            formato_masivo = st.radio("Formato", ["📄 PDF", "📊 Excel", "📄📊 PDF y Excel"], horizontal=True, key="formato_masivo")
+        
+        ids_masivo = list(datos['clientes'])
+        if filtro_masivo == "Con saldo pendiente":
+            ids_masivo = [cid for cid in ids_masivo if datos['clientes'][cid].saldo_pendiente > 0]
+        elif filtro_masivo == "Liquidados":
+            ids_masivo = [cid for cid in ids_masivo if datos['clientes'][cid].saldo_pendiente == 0]
+        
+        if st.button(f"📦 Generar ZIP ({len(ids_masivo)} clientes)", disabled=not ids_masivo, use_container_width=True):
+            formatos = {"📄 PDF": ['pdf'], "📊 Excel": ['excel'], "📄📊 PDF y Excel": ['pdf', 'excel']}[formato_masivo]
+            barra = st.progress(0.0, text="Leyendo el libro de pagos...")
+            try:
+                # Una sola lectura del libro completo en lugar de un historial por cliente
+                libro = leer_libro_completo()
+                # Los procesos reciben diccionarios: los dataclasses del script no se pueden importar allá
+                trabajos = (
+                    (cid, asdict(datos['clientes'][cid]), [asdict(p) for p in pagos_vigentes(libro.get(cid, []))],
+                     TARIFAS, formatos)
+                    for cid in ids_masivo
+                )
+                # El ZIP crece en un archivo temporal conforme terminan los procesos, no en memoria
+                with tempfile.TemporaryFile() as archivo_zip:
+                    kardex_zip(
+                        archivo_zip, trabajos, len(ids_masivo),
+                        progreso=lambda hechos, total: barra.progress(
+                            hechos / total, text=f"Generando kardex {hechos} de {total}..."
+                        )
+                    )
+                    archivo_zip.seek(0)
+                    st.download_button(
+                        label="⬇️ Descargar ZIP",
+                        data=archivo_zip,
+                        file_name=f"kardex_{datetime.now().strftime('%d-%m-%Y')}.zip",
+                        mime="application/zip"
+                    )
+                st.success(f"✅ Se generaron los kardex de {len(ids_masivo)} clientes")
+            except Exception as e:
+                st.error(f"❌ Error al generar los kardex: {e}")
         
         st.markdown("---")
         st.info("💡 **Tip:** El PDF es ideal para enviar por WhatsApp o email. El Excel te permite editar o imprimir con formato personalizado.")
@@ -1297,22 +1311,76 @@ elif menu == "⚙️ Configuración":
     st.subheader("🔗 Estado de Conexión")
     
     try:
-        client = conectar_google_sheets()
-        spreadsheet = client.open("viaje_san_juan_data")
-        st.success(f"✅ Conectado a Google Sheets: **{spreadsheet.title}**")
-        st.write(f"📄 URL: {spreadsheet.url}")
-        
-        hojas = spreadsheet.worksheets()
-        for hoja in hojas:
-            st.write(f"  - Hoja: **{hoja.title}** ({hoja.row_count} filas)")
+        almacenamiento = obtener_almacenamiento()
+        if almacenamiento.nombre == AlmacenamientoSQLite.nombre:
+            st.success(f"✅ Usando base de datos local SQLite: **{almacenamiento.ruta}**")
+            st.write(f"  - Clientes: **{len(datos['clientes'])}**")
+        else:
+            spreadsheet = obtener_cache_hojas().libro()
+            st.success(f"✅ Conectado a Google Sheets: **{spreadsheet.title}**")
+            st.write(f"📄 URL: {spreadsheet.url}")
+            
+            hojas = obtener_cache_hojas().llamar(spreadsheet.worksheets)
+            for hoja in hojas:
+                st.write(f"  - Hoja: **{hoja.title}** ({hoja.row_count} filas)")
+            
+            limitador = obtener_limitador()
+            st.write(f"⏱️ Cuota: {limitador.en_espera()} llamadas en espera, "
+                     f"{limitador.reintentos} reintentos por límite de Google desde el arranque")
     except Exception as e:
         st.error(f"❌ Error de conexión: {e}")
     
+    st.markdown("---")
+    st.subheader("🧮 Conciliación de Saldos")
+    st.write("Los saldos de la app salen del libro de pagos; la hoja de clientes guarda una instantánea "
+             "de total pagado y saldo que se pone al día con estos botones o en la conciliación nocturna.")
+    
+    conciliacion = obtener_conciliacion_nocturna()
+    if conciliacion.ultimo_error is not None:
+        st.warning(f"⚠️ La última conciliación nocturna falló: {conciliacion.ultimo_error}")
+    elif conciliacion.ultimo_resultado is not None:
+        fecha, corregidos, huerfanos = conciliacion.ultimo_resultado
+        st.caption(f"🌙 Última conciliación nocturna: {fecha.strftime('%d/%m/%Y %H:%M')} — "
+                   f"{corregidos} corregidos, {huerfanos} pagos de clientes eliminados")
+    elif conciliacion.hora is not None:
+        st.caption(f"🌙 Conciliación nocturna programada a las {conciliacion.hora:02d}:00")
+    else:
+        st.caption("🌙 Conciliación nocturna desactivada ([conciliacion] nocturna = false en los secrets)")
+    
+    if st.button("🔍 Revisar saldos", use_container_width=True):
+        try:
+            with st.spinner("Comparando totales con los pagos..."):
+                st.session_state.conciliacion = revisar_saldos(obtener_almacenamiento())
+        except Exception as e:
+            st.error(f"❌ Error al revisar los saldos: {e}")
+    
+    if 'conciliacion' in st.session_state:
+        diferencias, pagos_huerfanos, _ = st.session_state.conciliacion
+        if pagos_huerfanos:
+            st.info(f"ℹ️ {pagos_huerfanos} eventos del libro son de clientes eliminados y no cuentan en ningún saldo")
+        if diferencias.empty:
+            st.success("✅ La instantánea de saldos coincide con el libro de pagos")
+        else:
+            st.info(f"ℹ️ {len(diferencias)} clientes tienen pagos posteriores a la última instantánea de saldos")
+            st.dataframe(diferencias, use_container_width=True, hide_index=True)
+            if st.button(f"✅ Actualizar {len(diferencias)} clientes", type="primary"):
+                del st.session_state.conciliacion
+                try:
+                    # Se vuelve a leer todo: entre la revisión y el clic pudieron llegar más pagos
+                    with st.spinner("Escribiendo la instantánea de saldos..."):
+                        corregidos, _ = conciliacion.conciliar()
+                    st.session_state.version_datos, _ = obtener_instantanea().obtener()
+                    st.success(f"✅ Se actualizaron {corregidos} clientes")
+                except TurnoOcupado:
+                    st.warning("⚠️ Otro proceso está escribiendo la instantánea de saldos; intenta en unos minutos")
+                except Exception as e:
+                    st.error(f"❌ Error al escribir la instantánea: {e}")
+    
     st.markdown("---")
     st.subheader("📥 Respaldar Datos")
     
     if st.button("📥 Descargar Respaldo JSON", use_container_width=True):
-        backup_data = json.dumps(datos, indent=2, ensure_ascii=False)
+        backup_data = json.dumps(datos_a_json(datos, leer_libro_completo()), indent=2, ensure_ascii=False)
         st.download_button(
             label="⬇️ Descargar Respaldo",
             data=backup_data,
@@ -1320,6 +1388,9 @@ elif menu == "⚙️ Configuración":
             mime="application/json"
         )
 
+# Enviar lo que haya quedado en la cola de escritura al terminar el script
+confirmar_escrituras()
+
 # Footer
 st.markdown("---")
 st.markdown(